@@ -0,0 +1,41 @@
+"""Add indexes and submission kind
+
+Revision ID: 2f363b3d680e
+Revises: 0ca2cc448074
+Create Date: 2018-12-10 14:22:41.512310
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2f363b3d680e'
+down_revision = '0ca2cc448074'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('submissions', sa.Column('kind', sa.String(length=7), nullable=True))
+    op.execute("UPDATE submissions SET kind = CASE WHEN filename LIKE '%-msg.gpg' "
+               "THEN 'message' ELSE 'file' END")
+
+    op.create_index('ix_submissions_source_id', 'submissions', ['source_id'])
+    op.create_index('ix_submissions_kind_not_downloaded', 'submissions', ['kind'],
+                    sqlite_where=sa.text('is_downloaded = 0'))
+    op.create_index('ix_replies_source_id', 'replies', ['source_id'])
+    op.create_index('ix_replies_journalist_id', 'replies', ['journalist_id'])
+    op.create_index('ix_replies_not_downloaded', 'replies', ['is_downloaded'],
+                    sqlite_where=sa.text('is_downloaded = 0'))
+
+
+def downgrade():
+    op.drop_index('ix_replies_not_downloaded', table_name='replies')
+    op.drop_index('ix_replies_journalist_id', table_name='replies')
+    op.drop_index('ix_replies_source_id', table_name='replies')
+    op.drop_index('ix_submissions_kind_not_downloaded', table_name='submissions')
+    op.drop_index('ix_submissions_source_id', table_name='submissions')
+
+    with op.batch_alter_table('submissions', schema=None) as batch_op:
+        batch_op.drop_column('kind')
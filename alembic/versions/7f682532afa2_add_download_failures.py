@@ -0,0 +1,42 @@
+"""Add download failures
+
+Revision ID: 7f682532afa2
+Revises: 2f363b3d680e
+Create Date: 2018-12-12 11:05:27.804912
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7f682532afa2'
+down_revision = '2f363b3d680e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    for table in ['submissions', 'replies']:
+        op.add_column(table, sa.Column('download_attempts', sa.Integer(), nullable=False,
+                                       server_default='0'))
+        op.add_column(table, sa.Column('download_error', sa.Text(), nullable=True))
+        op.add_column(table, sa.Column('download_next_attempt', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    # Batch mode recreates the tables, losing the WHERE clause of partial
+    # indexes, so these are recreated afterwards.
+    op.drop_index('ix_replies_not_downloaded', table_name='replies')
+    op.drop_index('ix_submissions_kind_not_downloaded', table_name='submissions')
+
+    for table in ['replies', 'submissions']:
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.drop_column('download_next_attempt')
+            batch_op.drop_column('download_error')
+            batch_op.drop_column('download_attempts')
+
+    op.create_index('ix_submissions_kind_not_downloaded', 'submissions', ['kind'],
+                    sqlite_where=sa.text('is_downloaded = 0'))
+    op.create_index('ix_replies_not_downloaded', 'replies', ['is_downloaded'],
+                    sqlite_where=sa.text('is_downloaded = 0'))
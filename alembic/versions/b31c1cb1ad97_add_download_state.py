@@ -0,0 +1,39 @@
+"""Add download state
+
+Revision ID: b31c1cb1ad97
+Revises: 7f682532afa2
+Create Date: 2018-12-13 16:48:02.117405
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b31c1cb1ad97'
+down_revision = '7f682532afa2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    for table in ['submissions', 'replies']:
+        op.add_column(table, sa.Column('download_state', sa.String(length=10), nullable=True))
+        op.execute("UPDATE {} SET download_state = 'decrypted' "
+                   "WHERE is_downloaded = 1".format(table))
+
+
+def downgrade():
+    # Batch mode recreates the tables, losing the WHERE clause of partial
+    # indexes, so these are recreated afterwards.
+    op.drop_index('ix_replies_not_downloaded', table_name='replies')
+    op.drop_index('ix_submissions_kind_not_downloaded', table_name='submissions')
+
+    for table in ['replies', 'submissions']:
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.drop_column('download_state')
+
+    op.create_index('ix_submissions_kind_not_downloaded', 'submissions', ['kind'],
+                    sqlite_where=sa.text('is_downloaded = 0'))
+    op.create_index('ix_replies_not_downloaded', 'replies', ['is_downloaded'],
+                    sqlite_where=sa.text('is_downloaded = 0'))
@@ -0,0 +1,25 @@
+"""Add source public key hash
+
+Revision ID: c5d4a6b2e1f3
+Revises: b31c1cb1ad97
+Create Date: 2018-12-14 10:21:37.503518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5d4a6b2e1f3'
+down_revision = 'b31c1cb1ad97'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('sources', sa.Column('public_key_hash', sa.String(length=64), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('sources', schema=None) as batch_op:
+        batch_op.drop_column('public_key_hash')
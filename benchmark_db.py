@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Measure how well the local database copes with concurrent access, with and
+without the PRAGMAs set by make_engine. One thread keeps committing small
+write transactions (as the sync and download threads do) while reader
+threads keep querying (as the GUI does), for a few seconds each.
+
+Usage: ./benchmark_db.py [seconds]
+"""
+import sys
+import tempfile
+import threading
+import time
+
+from datetime import datetime
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+from securedrop_client.db import Base, make_engine, Source, SQLITE_PRAGMAS
+
+DURATION = float(sys.argv[1]) if len(sys.argv) > 1 else 3.0
+READERS = 3
+
+
+def run(pragmas):
+    engine = make_engine(tempfile.mkdtemp(), pragmas)
+    Base.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine)
+    counts = {'writes': 0, 'reads': 0, 'errors': 0}
+    lock = threading.Lock()
+    deadline = time.monotonic() + DURATION
+
+    def count(key):
+        with lock:
+            counts[key] += 1
+
+    def writer():
+        session = Session()
+        i = 0
+        while time.monotonic() < deadline:
+            i += 1
+            session.add(Source(uuid=str(i), journalist_designation='foo',
+                               is_flagged=False, public_key=None,
+                               interaction_count=0, is_starred=False,
+                               last_updated=datetime.now(), document_count=0))
+            try:
+                session.commit()
+                count('writes')
+            except OperationalError:
+                session.rollback()
+                count('errors')
+
+    def reader():
+        session = Session()
+        while time.monotonic() < deadline:
+            try:
+                session.query(Source).count()
+                session.commit()
+                count('reads')
+            except OperationalError:
+                session.rollback()
+                count('errors')
+
+    threads = [threading.Thread(target=writer)]
+    threads += [threading.Thread(target=reader) for _ in range(READERS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return counts
+
+
+for name, pragmas in [('SQLite defaults', None), ('make_engine', SQLITE_PRAGMAS)]:
+    counts = run(pragmas)
+    print('{:<16} {:>8.0f} writes/s {:>8.0f} reads/s {:>6} errors'.format(
+        name, counts['writes'] / DURATION, counts['reads'] / DURATION,
+        counts['errors']))
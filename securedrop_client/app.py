@@ -23,7 +23,6 @@ import signal
 import sys
 import socket
 from argparse import ArgumentParser
-from sqlalchemy.orm import sessionmaker
 from PyQt5.QtWidgets import QApplication, QMessageBox
 from PyQt5.QtCore import Qt, QTimer
 from logging.handlers import TimedRotatingFileHandler
@@ -31,7 +30,7 @@ from securedrop_client import __version__
 from securedrop_client.logic import Client
 from securedrop_client.gui.main import Window
 from securedrop_client.resources import load_icon, load_css
-from securedrop_client.db import make_engine
+from securedrop_client.db import make_session_maker
 from securedrop_client.utils import safe_mkdir
 
 DEFAULT_SDC_HOME = '~/.securedrop_client'
@@ -164,8 +163,7 @@ def start_app(args, qt_args) -> None:
     app.setWindowIcon(load_icon(gui.icon))
     app.setStyleSheet(load_css('sdclient.css'))
 
-    engine = make_engine(args.sdc_home)
-    Session = sessionmaker(bind=engine)
+    Session = make_session_maker(args.sdc_home)
     session = Session()
 
     client = Client("http://localhost:8081/", gui, session,
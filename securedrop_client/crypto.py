@@ -16,21 +16,25 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import gzip
+import hashlib
 import logging
 import os
 import shutil
 import subprocess
 import tempfile
+import zlib
 
-from sqlalchemy.orm import sessionmaker
 from uuid import UUID
 
 from securedrop_client.config import Config
-from securedrop_client.db import make_engine, Source
+from securedrop_client.db import make_session_maker, Source
 from securedrop_client.utils import safe_mkdir
 
 logger = logging.getLogger(__name__)
 
+# Bytes of plaintext copied from gpg at a time.
+DECRYPT_CHUNK_SIZE = 64 * 1024
+
 
 class CryptoError(Exception):
 
@@ -47,57 +51,161 @@ class GpgHelper:
         safe_mkdir(os.path.join(sdc_home), "gpg")
         self.sdc_home = sdc_home
         self.is_qubes = is_qubes
-        engine = make_engine(sdc_home)
-        Session = sessionmaker(bind=engine)
-        self.session = Session()
+        # The registry provides the session of whichever thread this is used in.
+        self.session = make_session_maker(sdc_home)
 
         config = Config.from_home_dir(self.sdc_home)
         self.journalist_key_fingerprint = config.journalist_key_fingerprint
 
     def decrypt_submission_or_reply(self, filepath, target_filename, is_doc=False) -> None:
-        err = tempfile.NamedTemporaryFile(suffix=".message-error", delete=False)
-        with tempfile.NamedTemporaryFile(suffix=".message") as out:
-            cmd = self._gpg_cmd_base()
-            cmd.extend(["--decrypt", filepath])
-            res = subprocess.call(cmd, stdout=out, stderr=err)
-
-            os.unlink(filepath)  # original file
-
-            if res != 0:
-                # The err tempfile was created with delete=False, so needs to
-                # be explicitly cleaned up. We will do that after we've read the file.
-                err.close()
+        """
+        Decrypt the file at filepath into the data directory, then delete it.
+        If decryption fails, the file is kept so that it can be decrypted
+        again without downloading it again.
+
+        The plaintext is streamed from gpg through a pipe (and gunzipped, for
+        documents) straight into the destination, so it is only written once.
+        """
+        if is_doc:
+            # Need to split twice as filename is e.g.
+            # 1-impractical_thing-doc.gz.gpg
+            fn_no_ext, _ = os.path.splitext(
+                os.path.splitext(os.path.basename(filepath))[0])
+        else:
+            fn_no_ext, _ = os.path.splitext(target_filename)
+        dest = os.path.join(self.sdc_home, "data", fn_no_ext)
 
-                with open(err.name) as e:
-                    msg = "GPG Error: {}".format(e.read())
+        cmd = self._gpg_cmd_base()
+        cmd.extend(["--decrypt", filepath])
 
-                logger.error(msg)
-                os.unlink(err.name)
+        with open(dest, 'wb') as outfile, tempfile.TemporaryFile() as err:
+            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=err)
+            copy_error = None
+            try:
+                if is_doc:
+                    # Docs are gzipped, so gunzip them as they arrive
+                    with gzip.GzipFile(fileobj=process.stdout) as infile:
+                        shutil.copyfileobj(infile, outfile, DECRYPT_CHUNK_SIZE)
+                else:
+                    shutil.copyfileobj(process.stdout, outfile, DECRYPT_CHUNK_SIZE)
+            except (OSError, EOFError, zlib.error) as e:
+                copy_error = e
+            finally:
+                # If we stopped reading early, closing the pipe ends gpg
+                process.stdout.close()
+                res = process.wait()
 
-                raise CryptoError(msg)
+            if res != 0:
+                err.seek(0)
+                msg = "GPG Error: {}".format(err.read().decode('utf-8', 'replace'))
+            elif copy_error:
+                msg = "Could not write the plaintext of {}: {}".format(filepath, copy_error)
+
+        if res != 0 or copy_error:
+            os.unlink(dest)
+            logger.error(msg)
+            raise CryptoError(msg)
+
+        logger.info("Downloaded and decrypted: {}".format(dest))
+
+        os.unlink(filepath)  # original file
+
+        return dest
+
+    def decrypt_files(self, filepaths, on_decrypted=None) -> dict:
+        """
+        Decrypt the messages or replies at filepaths with a single gpg process,
+        each into the same directory without its .gpg extension, then delete
+        them. Return the CryptoError for each file which could not be
+        decrypted, by filepath; those files are kept.
+
+        gpg's status lines are read as they arrive, so each file is finished
+        with as soon as gpg is. If given, on_decrypted is then called with its
+        filepath and CryptoError (or None, if it was decrypted).
+
+        Split GPG on Qubes OS only pipes data in and out of gpg, so there each
+        file is decrypted by a process of its own.
+        """
+        errors = {}
+
+        def finished(filepath, error):
+            if error:
+                errors[filepath] = error
+            if on_decrypted:
+                on_decrypted(filepath, error)
+
+        batch = []
+        for filepath in filepaths:
+            if self.is_qubes or not filepath.endswith('.gpg'):
+                try:
+                    self.decrypt_submission_or_reply(filepath, os.path.basename(filepath))
+                except CryptoError as e:
+                    finished(filepath, e)
+                else:
+                    finished(filepath, None)
             else:
-                # Cleanup err file
-                err.close()
-                os.unlink(err.name)
+                batch.append(filepath)
 
-                if is_doc:
-                    # Need to split twice as filename is e.g.
-                    # 1-impractical_thing-doc.gz.gpg
-                    fn_no_ext, _ = os.path.splitext(
-                        os.path.splitext(os.path.basename(filepath))[0])
-                    dest = os.path.join(self.sdc_home, "data", fn_no_ext)
-
-                    # Docs are gzipped, so gunzip the file
-                    with gzip.open(out.name, 'rb') as infile, \
-                            open(dest, 'wb') as outfile:
-                        shutil.copyfileobj(infile, outfile)
-                else:
-                    fn_no_ext, _ = os.path.splitext(target_filename)
-                    dest = os.path.join(self.sdc_home, "data", fn_no_ext)
-                    shutil.copy(out.name, dest)
-                logger.info("Downloaded and decrypted: {}".format(dest))
+        if not batch:
+            return errors
 
-                return dest
+        cmd = self._gpg_cmd_base()
+        cmd.extend(['--batch', '--yes', '--status-fd', '1', '--decrypt-files'] + batch)
+        # The exit status is not 0 if any of the files could not be decrypted,
+        # so the status lines tell which ones were: gpg reports each file from
+        # FILE_START to FILE_DONE.
+        remaining = set(batch)
+        with tempfile.TemporaryFile() as err:
+            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=err)
+            try:
+                filepath = None
+                decrypted = False
+                for line in process.stdout:
+                    fields = line.decode('utf-8', 'replace').rstrip('\n').split(' ', 3)
+                    if fields[1:2] == ['FILE_START'] and len(fields) == 4:
+                        filepath = fields[3]
+                        decrypted = False
+                    elif fields[1:2] == ['DECRYPTION_OKAY']:
+                        decrypted = True
+                    elif fields[1:2] == ['DECRYPTION_FAILED']:
+                        decrypted = False
+                    elif fields[1:2] == ['FILE_DONE'] and filepath in remaining:
+                        remaining.discard(filepath)
+                        finished(filepath, self._finish_decrypting(filepath, decrypted, err))
+                        filepath = None
+            finally:
+                process.stdout.close()
+                process.wait()
+
+            # Files gpg did not get to, e.g. because it was killed.
+            for filepath in batch:
+                if filepath in remaining:
+                    finished(filepath, self._finish_decrypting(filepath, False, err))
+
+        return errors
+
+    def _finish_decrypting(self, filepath, decrypted, err):
+        """
+        Delete the file decrypted by decrypt_files, or if it could not be
+        decrypted, any partial plaintext, returning the CryptoError with gpg's
+        errors about it so far from the err file.
+        """
+        dest = filepath[:-len('.gpg')]
+        if decrypted:
+            logger.info("Downloaded and decrypted: {}".format(dest))
+            os.unlink(filepath)  # original file
+            return None
+
+        if os.path.exists(dest):
+            os.unlink(dest)
+        # gpg is still writing to err, so read it without moving its offset.
+        stderr = os.pread(err.fileno(), os.fstat(err.fileno()).st_size, 0)
+        # gpg's errors about the file are prefixed with its path
+        details = [line for line in stderr.decode('utf-8', 'replace').splitlines()
+                   if filepath in line]
+        msg = "GPG Error: {}".format('\n'.join(details) or filepath)
+        logger.error(msg)
+        return CryptoError(msg)
 
     def _gpg_cmd_base(self) -> list:
         if self.is_qubes:  # pragma: no cover
@@ -116,11 +224,57 @@ class GpgHelper:
             raise RuntimeError('Expected exactly one fingerprint.')
 
         local_source.fingerprint = fingerprints.pop()
+        local_source.public_key_hash = key_hash(key_data)
         self.session.add(local_source)
         self.session.commit()
 
+    def import_keys(self, keys: dict) -> None:
+        '''
+        Import the public keys of the sources, given by source uuid, storing
+        the fingerprint of each. Keys already in the keyring, unchanged since
+        they were imported, are skipped; the others are imported with a
+        single gpg process.
+        '''
+        if not keys:
+            return
+
+        in_keyring = self._keyring_fingerprints()
+        sources = [source for source in self.session.query(Source)
+                   if source.uuid in keys and (
+                       source.public_key_hash != key_hash(keys[source.uuid]) or
+                       source.fingerprint not in in_keyring)]
+        if not sources:
+            return
+
+        try:
+            fingerprints = self._import_keys('\n'.join(keys[source.uuid] for source in sources))
+        except CryptoError:
+            fingerprints = []
+        if len(fingerprints) != len(sources):
+            # gpg failed or skipped a key it could not read, so which
+            # fingerprint belongs to which source is not known: import the
+            # keys one by one.
+            for source in sources:
+                try:
+                    self.import_key(source.uuid, keys[source.uuid])
+                except (CryptoError, RuntimeError):
+                    logger.warning('Failed to import key for source {}'.format(source.uuid))
+            return
+
+        for source, fingerprint in zip(sources, fingerprints):
+            source.fingerprint = fingerprint
+            source.public_key_hash = key_hash(keys[source.uuid])
+        self.session.commit()
+
     def _import(self, key_data: str, is_private: bool = False) -> set:
         '''Wrapper for `gpg --import-keys`'''
+        return set(self._import_keys(key_data, is_private))
+
+    def _import_keys(self, key_data: str, is_private: bool = False) -> list:
+        '''
+        Import the keys in key_data, returning the fingerprint of each public
+        key in the order the keys were given.
+        '''
         cmd = self._gpg_cmd_base()
         if is_private:
             cmd.append('--allow-secret-key-import')
@@ -142,22 +296,19 @@ class GpgHelper:
                 raise CryptoError('Could not import key.')
 
             stdout.seek(0)
-            # this is to ensure we only read the fingerprint attached to the public key
-            # and not a subkey
-            reading_pub = False
-            key_fingerprints = set()
-            for line in stdout:
-                if line.startswith('pub'):
-                    reading_pub = True
-                    continue
-                if not line.startswith('fpr'):
-                    continue
-                if not reading_pub:
-                    continue
-                key_fingerprints.add(line.split(':')[9])
-                reading_pub = False
-
-            return key_fingerprints
+            return _public_key_fingerprints(stdout)
+
+    def _keyring_fingerprints(self) -> set:
+        '''
+        Return the fingerprints of the public keys in the keyring.
+        '''
+        cmd = self._gpg_cmd_base()
+        cmd.extend(['--with-colons', '--list-keys'])
+        res = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if res.returncode != 0:
+            logger.error('Could not list keys: {}'.format(res.stderr.decode('utf-8', 'replace')))
+            return set()
+        return set(_public_key_fingerprints(res.stdout.decode('utf-8', 'replace').splitlines()))
 
     def encrypt_to_source(self, source_uuid: str, data: str) -> str:
         '''
@@ -189,3 +340,33 @@ class GpgHelper:
 
             stdout.seek(0)
             return stdout.read()
+
+
+def key_hash(key_data: str) -> str:
+    '''
+    Return the SHA-256 of the armored key, as stored in Source.public_key_hash.
+    '''
+    return hashlib.sha256(key_data.encode('utf-8')).hexdigest()
+
+
+def _public_key_fingerprints(lines) -> list:
+    '''
+    Return the fingerprints of the public keys in gpg's --with-colons output,
+    in order.
+    '''
+    # this is to ensure we only read the fingerprint attached to the public key
+    # and not a subkey
+    reading_pub = False
+    key_fingerprints = []
+    for line in lines:
+        if line.startswith('pub'):
+            reading_pub = True
+            continue
+        if not line.startswith('fpr'):
+            continue
+        if not reading_pub:
+            continue
+        key_fingerprints.append(line.split(':')[9])
+        reading_pub = False
+
+    return key_fingerprints
@@ -1,9 +1,11 @@
 import os
+import threading
 
-from sqlalchemy import Boolean, Column, create_engine, DateTime, ForeignKey, Integer, String, \
-    Text, MetaData
+from sqlalchemy import Boolean, Column, create_engine, DateTime, event, ForeignKey, Index, \
+    Integer, String, Text, MetaData, text
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy.orm import relationship, backref, scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
 
 
 convention = {
@@ -19,9 +21,80 @@ metadata = MetaData(naming_convention=convention)
 Base = declarative_base(metadata=metadata)
 
 
-def make_engine(home: str):
+# The PRAGMAs set on every connection to the local database by default. The
+# database is shared by several threads: write-ahead logging lets readers
+# carry on while another connection writes, a busy timeout makes writers wait
+# for each other rather than fail with "database is locked", and in WAL mode
+# synchronous=NORMAL is still safe against corruption, it only gives up the
+# durability of the last transactions on power loss.
+SQLITE_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('busy_timeout', 5000),  # milliseconds
+    ('mmap_size', 64 * 1024 * 1024),  # bytes
+    ('cache_size', -8000),  # negative values are in KiB
+)
+
+
+def make_engine(home: str, pragmas=SQLITE_PRAGMAS):
+    """
+    Return an engine for the local database in the home directory, setting
+    the given PRAGMAs on each connection. Pass pragmas=None to use SQLite's
+    defaults instead.
+
+    Connections are pooled (rather than opened for each session) and may be
+    handed from one thread to another, so that they keep their page cache.
+    """
     db_path = os.path.join(home, 'svs.sqlite')
-    return create_engine('sqlite:///{}'.format(db_path))
+    engine = create_engine('sqlite:///{}'.format(db_path), poolclass=QueuePool,
+                           connect_args={'check_same_thread': False})
+
+    if pragmas:
+        @event.listens_for(engine, 'connect')
+        def set_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in pragmas:
+                cursor.execute('PRAGMA {} = {}'.format(name, value))
+            cursor.close()
+
+    return engine
+
+
+# Session registries for each home directory, see make_session_maker.
+_session_makers = {}
+_session_makers_lock = threading.Lock()
+
+
+def make_session_maker(home: str) -> scoped_session:
+    """
+    Return the process-wide session registry for the local database in the
+    home directory. There is one engine (and so one connection pool) per
+    database, and calling the registry returns the session of the calling
+    thread. The registry can also be used in place of a session, in which
+    case it uses the session of whichever thread it is used from.
+    """
+    with _session_makers_lock:
+        if home not in _session_makers:
+            engine = make_engine(home)
+            _session_makers[home] = scoped_session(sessionmaker(bind=engine))
+        return _session_makers[home]
+
+
+# The states of downloading a submission or reply. Once its ciphertext has
+# been downloaded, it is kept until it has been decrypted, so that decryption
+# can be retried without downloading it again.
+DOWNLOADED = 'downloaded'
+DECRYPTING = 'decrypting'
+DECRYPTED = 'decrypted'
+DECRYPTION_FAILED = 'failed'
+
+
+def submission_kind(filename: str) -> str:
+    """
+    Return the kind of a submission given its filename: 'message' for messages
+    (e.g. 1-impractical_thing-msg.gpg) or 'file' for documents.
+    """
+    return 'message' if filename.endswith('-msg.gpg') else 'file'
 
 
 class Source(Base):
@@ -37,6 +110,9 @@ class Source(Base):
                         server_default="false")
     public_key = Column(Text, nullable=True)
     fingerprint = Column(String(64))
+    # SHA-256 of the armored public key last imported into the keyring, so
+    # that unchanged keys are not imported again.
+    public_key_hash = Column(String(64))
     interaction_count = Column(Integer, server_default="0", nullable=False)
     is_starred = Column(Boolean(name='ck_sources_is_starred'),
                         server_default="false")
@@ -77,6 +153,9 @@ class Submission(Base):
     size = Column(Integer, nullable=False)
     download_url = Column(String(255), nullable=False)
 
+    # Either 'message' or 'file', derived from the filename (see submission_kind).
+    kind = Column(String(7))
+
     # This is whether the submission has been downloaded in the local database.
     is_downloaded = Column(Boolean(name='ck_submissions_is_downloaded'),
                            default=False)
@@ -85,11 +164,27 @@ class Submission(Base):
     is_read = Column(Boolean(name='ck_submissions_is_read'),
                      default=False)
 
-    source_id = Column(Integer, ForeignKey('sources.id'))
+    # Failed attempts to download (and decrypt) the submission, see
+    # storage.mark_file_download_failed.
+    download_attempts = Column(Integer, nullable=False, default=0, server_default='0')
+    download_error = Column(Text)
+    download_next_attempt = Column(DateTime)
+
+    # Where the submission is in being downloaded and decrypted: None, or one
+    # of DOWNLOADED, DECRYPTING, DECRYPTED or DECRYPTION_FAILED.
+    download_state = Column(String(10))
+
+    source_id = Column(Integer, ForeignKey('sources.id'), index=True)
     source = relationship("Source",
                           backref=backref("submissions", order_by=id,
                                           cascade="delete"))
 
+    __table_args__ = (
+        # Used to find the messages still to download.
+        Index('ix_submissions_kind_not_downloaded', 'kind',
+              sqlite_where=text('is_downloaded = 0')),
+    )
+
     def __init__(self, source, uuid, size, filename, download_url):
         # ORM event catching _should_ have already initialized `self.data`
 
@@ -97,6 +192,7 @@ class Submission(Base):
         self.uuid = uuid
         self.size = size
         self.filename = filename
+        self.kind = submission_kind(filename)
         self.download_url = download_url
         self.is_download = False
 
@@ -110,12 +206,12 @@ class Reply(Base):
 
     id = Column(Integer, primary_key=True)
     uuid = Column(String(36), unique=True, nullable=False)
-    source_id = Column(Integer, ForeignKey('sources.id'))
+    source_id = Column(Integer, ForeignKey('sources.id'), index=True)
     source = relationship("Source",
                           backref=backref("replies", order_by=id,
                                           cascade="delete"))
 
-    journalist_id = Column(Integer, ForeignKey('users.id'))
+    journalist_id = Column(Integer, ForeignKey('users.id'), index=True)
     journalist = relationship(
         "User", backref=backref('replies', order_by=id))
 
@@ -126,6 +222,22 @@ class Reply(Base):
     is_downloaded = Column(Boolean(name='ck_replies_is_downloaded'),
                            default=False)
 
+    # Failed attempts to download (and decrypt) the reply, see
+    # storage.mark_reply_download_failed.
+    download_attempts = Column(Integer, nullable=False, default=0, server_default='0')
+    download_error = Column(Text)
+    download_next_attempt = Column(DateTime)
+
+    # Where the reply is in being downloaded and decrypted, as for
+    # Submission.download_state.
+    download_state = Column(String(10))
+
+    __table_args__ = (
+        # Used to find the replies still to download.
+        Index('ix_replies_not_downloaded', 'is_downloaded',
+              sqlite_where=text('is_downloaded = 0')),
+    )
+
     def __init__(self, uuid, journalist, source, filename, size):
         self.uuid = uuid
         self.journalist_id = journalist.id
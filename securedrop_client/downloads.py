@@ -0,0 +1,892 @@
+"""
+Contains the DownloadQueue class, which runs in the background and downloads
+and decrypts messages, replies and files from the SecureDrop server.
+
+Copyright (C) 2018  The Freedom of the Press Foundation.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import datetime
+import heapq
+import logging
+import os
+import requests
+import shutil
+import threading
+import time
+import sdclientapi.sdlocalobjects as sdkobjects
+
+from collections import deque, OrderedDict
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
+from PyQt5.QtCore import QObject, QTimer, pyqtSignal
+from securedrop_client import storage
+from securedrop_client.crypto import CryptoError, GpgHelper
+from securedrop_client.db import make_session_maker, Reply, Submission, DOWNLOADED, DECRYPTING, \
+    DECRYPTION_FAILED
+from securedrop_client.storage import get_data
+
+
+logger = logging.getLogger(__name__)
+
+
+# The kinds of item to download. Submissions are messages or files, see
+# db.submission_kind.
+MESSAGE = 'message'
+FILE = 'file'
+REPLY = 'reply'
+
+# The number of items downloaded at once.
+MAX_CONCURRENT_DOWNLOADS = 4
+
+# The number of items of each kind downloaded at once. Files can be large, so
+# fewer of them are downloaded at once so as not to hold up messages.
+CONCURRENT_DOWNLOADS_PER_KIND = {
+    MESSAGE: MAX_CONCURRENT_DOWNLOADS,
+    REPLY: MAX_CONCURRENT_DOWNLOADS,
+    FILE: 2,
+}
+
+# Bytes read from the server at a time by download_resumable.
+CHUNK_SIZE = 64 * 1024
+
+# Seconds to wait for the server to accept the connection, and then for each
+# chunk to arrive. A download which keeps making progress is never timed out.
+DOWNLOAD_TIMEOUT = (20, 60)
+
+# Times an interrupted download is resumed without any progress being made
+# before giving up.
+MAX_STALLED_RESUMES = 3
+
+# The most messages and replies decrypted by one gpg process. Batches are kept
+# small so that a busy decryption thread is soon free for items the user is
+# waiting for.
+DECRYPT_BATCH_SIZE = 10
+
+# The most gpg processes decrypting messages and replies at once. Decryption
+# is bound by the CPU, so one per core.
+MAX_CONCURRENT_DECRYPTIONS = os.cpu_count() or 1
+
+# Seconds over which DownloadStats measures the download rate.
+RATE_WINDOW = 10
+
+# Seconds between download_progress signals for each item.
+PROGRESS_INTERVAL = 0.25
+
+
+def download_resumable(api, path_query, dest, chunk_size=CHUNK_SIZE,
+                       timeout=DOWNLOAD_TIMEOUT, max_stalled_resumes=MAX_STALLED_RESUMES,
+                       on_progress=None):
+    """
+    Stream the file at the API path to dest in chunks. The partial download is
+    kept at dest + '.part', so if the download is interrupted (now or in an
+    earlier attempt) it resumes where it left off with an HTTP Range request.
+
+    If given, on_progress is called after each chunk with the number of bytes
+    in the chunk, the number received so far and the size of the file (or
+    None if the server does not say).
+    """
+    partial = dest + '.part'
+    url = urljoin(api.server, path_query)
+    stalls = 0
+
+    while True:
+        offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+        headers = dict(api.auth_header)
+        if offset:
+            headers['Range'] = 'bytes={}-'.format(offset)
+
+        try:
+            with requests.get(url, headers=headers, stream=True, timeout=timeout) as response:
+                if response.status_code == 416:
+                    # The partial download does not match the file on the
+                    # server, so start again.
+                    os.unlink(partial)
+                    raise requests.ConnectionError('Range not satisfiable')
+                response.raise_for_status()
+
+                # A server which ignores the Range header sends the whole file.
+                resuming = response.status_code == 206
+                expected_size = _expected_size(response, offset if resuming else 0)
+                received = offset if resuming else 0
+                with open(partial, 'ab' if resuming else 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=chunk_size):
+                        f.write(chunk)
+                        received += len(chunk)
+                        if on_progress:
+                            on_progress(len(chunk), received, expected_size)
+
+            size = os.path.getsize(partial)
+            if expected_size is not None and size < expected_size:
+                raise requests.ConnectionError(
+                    'Received {} of {} bytes'.format(size, expected_size))
+        except (requests.ConnectionError, requests.Timeout,
+                requests.exceptions.ChunkedEncodingError) as e:
+            progress = os.path.getsize(partial) > offset if os.path.exists(partial) else False
+            stalls = 0 if progress else stalls + 1
+            if stalls > max_stalled_resumes:
+                raise
+            logger.info('Download of {} interrupted, resuming: {}'.format(path_query, e))
+            continue
+
+        os.replace(partial, dest)
+        return dest
+
+
+def _expected_size(response, offset):
+    """
+    Return the size of the whole file being downloaded, if the server says.
+    """
+    content_length = response.headers.get('Content-Length')
+    if content_length is None:
+        return None
+    return offset + int(content_length)
+
+
+class DownloadStats:
+    """
+    Figures about the activity of a download queue: bytes downloaded, the
+    current rate, the estimated time to finish the items being downloaded and
+    the length of the queue. It is updated from the worker threads and may be
+    read from any thread.
+    """
+
+    def __init__(self, window=RATE_WINDOW, clock=time.monotonic):
+        self.window = window
+        self.clock = clock
+        self.lock = threading.Lock()
+
+        self.bytes_downloaded = 0
+        self.downloaded = 0  # Items downloaded.
+        self.failed = 0  # Attempts to download an item which failed.
+        self.queued = 0  # Items waiting to be downloaded or decrypted.
+        self.active = 0  # Items being downloaded or decrypted.
+
+        # Bytes received and expected for each item being downloaded, by uuid.
+        self.progress = {}
+        # Times at which bytes were received, and how many, for the rate.
+        self.samples = deque()
+
+    def add_bytes(self, uuid, count, received, total):
+        """
+        Record that count more bytes of the item have been received, making
+        received bytes out of total (or None, if unknown).
+        """
+        with self.lock:
+            now = self.clock()
+            self.bytes_downloaded += count
+            self.progress[uuid] = (received, total)
+            self.samples.append((now, count))
+            self._forget_samples(now)
+
+    def item_done(self, uuid, succeeded):
+        with self.lock:
+            self.progress.pop(uuid, None)
+            if succeeded:
+                self.downloaded += 1
+            else:
+                self.failed += 1
+
+    def set_queue_length(self, queued, active):
+        with self.lock:
+            self.queued = queued
+            self.active = active
+
+    @property
+    def rate(self):
+        """
+        Bytes per second received over the last window seconds.
+        """
+        with self.lock:
+            self._forget_samples(self.clock())
+            return sum(count for _, count in self.samples) / self.window
+
+    @property
+    def eta(self):
+        """
+        Seconds until the items being downloaded whose size is known are
+        finished at the current rate, or None if nothing is being received.
+        """
+        rate = self.rate
+        with self.lock:
+            remaining = sum(total - received for received, total in self.progress.values()
+                            if total is not None)
+        if not rate:
+            return None
+        return remaining / rate
+
+    def as_dict(self):
+        """
+        Return all the figures, e.g. for logging.
+        """
+        rate, eta = self.rate, self.eta
+        with self.lock:
+            return {
+                'bytes_downloaded': self.bytes_downloaded,
+                'downloaded': self.downloaded,
+                'failed': self.failed,
+                'queued': self.queued,
+                'active': self.active,
+                'rate': rate,
+                'eta': eta,
+            }
+
+    def _forget_samples(self, now):
+        while self.samples and self.samples[0][0] < now - self.window:
+            self.samples.popleft()
+
+
+class Download:
+    """
+    A message, reply or file to download. Only plain values are kept, so that
+    it can be passed between threads (unlike database objects, which belong to
+    the session of a single thread).
+    """
+
+    def __init__(self, kind, uuid, source_uuid, filename, source_last_updated=0,
+                 size=None):
+        self.kind = kind
+        self.uuid = uuid
+        self.source_uuid = source_uuid
+        self.filename = filename
+        # Timestamp of the source's last activity, for ordering downloads.
+        self.source_last_updated = source_last_updated
+        # Size of the ciphertext on the server, if known.
+        self.size = size
+        # Whether the ciphertext downloaded by an earlier attempt was reused.
+        self.reused_ciphertext = False
+
+    @classmethod
+    def from_db_object(cls, db_object, source=None):
+        """
+        Return the download of the given Submission or Reply, from the given
+        source (by default, the source it is related to).
+        """
+        if isinstance(db_object, Reply):
+            kind = REPLY
+        else:
+            kind = db_object.kind
+        source = source or db_object.source
+        if source.last_updated:
+            source_last_updated = source.last_updated.timestamp()
+        else:
+            source_last_updated = 0
+        return cls(kind, db_object.uuid, source.uuid, db_object.filename,
+                   source_last_updated, db_object.size)
+
+    def __repr__(self):
+        return '<Download {} {}>'.format(self.kind, self.uuid)
+
+
+class PrioritizedDownloads(MutableMapping):
+    """
+    Items waiting in a download queue, by uuid. Besides the order in which
+    they were added, they are kept in a heap for each kind in the order given
+    by the priority function, so that the most urgent item is found without
+    sorting them all. Call reorder when the priority of the items changes.
+    """
+
+    def __init__(self, priority):
+        self.priority = priority
+        # The items and the order in which they were added (which breaks ties
+        # between items of the same priority), by uuid.
+        self.downloads = OrderedDict()
+        self.count = 0
+        # (priority, order, uuid) tuples by kind. Those of removed items are
+        # dropped as they come first, see first.
+        self.heaps = {}
+
+    def __getitem__(self, uuid):
+        return self.downloads[uuid][1]
+
+    def __setitem__(self, uuid, download):
+        self.count += 1
+        self.downloads[uuid] = (self.count, download)
+        heapq.heappush(self.heaps.setdefault(download.kind, []),
+                       (self.priority(download), self.count, uuid))
+
+    def __delitem__(self, uuid):
+        del self.downloads[uuid]
+
+    def __iter__(self):
+        return iter(self.downloads)
+
+    def __len__(self):
+        return len(self.downloads)
+
+    def first(self, skip_kinds=()):
+        """
+        Return the most urgent item, other than those of the given kinds, or
+        None if there is none.
+        """
+        first_entry = None
+        for kind, heap in self.heaps.items():
+            if kind in skip_kinds:
+                continue
+            while heap:
+                _, order, uuid = heap[0]
+                if uuid in self.downloads and self.downloads[uuid][0] == order:
+                    break
+                heapq.heappop(heap)
+            if heap and (first_entry is None or heap[0] < first_entry):
+                first_entry = heap[0]
+
+        if first_entry is None:
+            return None
+        return self.downloads[first_entry[2]][1]
+
+    def reorder(self):
+        """
+        Rebuild the heaps, once the priority of the items changed.
+        """
+        self.heaps = {}
+        for uuid, (order, download) in self.downloads.items():
+            self.heaps.setdefault(download.kind, []).append(
+                (self.priority(download), order, uuid))
+        for heap in self.heaps.values():
+            heapq.heapify(heap)
+
+
+class DownloadQueue(QObject):
+    """
+    Runs in the background, downloading messages, replies and files with a
+    bounded pool of workers.
+
+    Each item is downloaded at most once at a time (items are identified by
+    their uuid), and no more than CONCURRENT_DOWNLOADS_PER_KIND of each kind
+    are downloaded at once. Items from the selected source are downloaded
+    first, then those from the sources visible in the source list, then the
+    rest starting with the most recently updated source (see set_priorities).
+
+    Call wake (or connect a signal to it) once new
+    messages or replies may be waiting to be downloaded. Failures are recorded
+    in the database, and messages and replies are tried again with a growing
+    backoff (see storage.mark_file_download_failed) until they are given up
+    on. Files are only downloaded when enqueued.
+    """
+
+    """
+    Signal emitted notifying that a message has been downloaded. The signal is a tuple of
+    (str, str) containing the message's UUID and the content of the message.
+    """
+    message_downloaded = pyqtSignal([str, str])
+
+    """
+    Signal emitted notifying that a reply has been downloaded. The signal is a tuple of
+    (str, str) containing the message's UUID and the content of the reply.
+    """
+    reply_downloaded = pyqtSignal([str, str])
+
+    """
+    Signal emitted notifying that a file has been downloaded. The signal is a tuple of
+    (str, str) containing the file's UUID and its filename on the server.
+    """
+    file_downloaded = pyqtSignal([str, str])
+
+    """
+    Signal emitted notifying that a file could not be downloaded. The signal is a tuple of
+    (str, str, object) containing the file's UUID, its filename on the server
+    and the exception raised.
+    """
+    file_download_failed = pyqtSignal([str, str, object])
+
+    """
+    Signal emitted as an item downloads, at most every PROGRESS_INTERVAL
+    seconds. The signal is a tuple of (str, int, int) containing the item's
+    UUID, the bytes received so far and the size of the item (or -1 if
+    unknown). The sizes are 64-bit, as files may be larger than 2 GiB. See
+    stats for the figures of the whole queue.
+    """
+    download_progress = pyqtSignal(str, 'qint64', 'qint64')
+
+    """
+    Signal emitted when the number of items waiting to be downloaded or
+    decrypted, or being downloaded or decrypted, changes. The signal is a
+    tuple of (int, int) containing those numbers.
+    """
+    queue_length_changed = pyqtSignal(int, int)
+
+    """
+    Signal emitted from the worker threads as each download completes. The
+    signal is a tuple of (Download, object) containing the item and the
+    exception raised, or None if it succeeded.
+    """
+    download_done = pyqtSignal(object, object)
+
+    """
+    Signal emitted from the worker threads when the ciphertext of a message or
+    reply has been downloaded, so that it can be decrypted with others. The
+    signal is the Download.
+    """
+    ciphertext_downloaded = pyqtSignal(object)
+
+    def __init__(self, api, home, is_qubes, max_workers=MAX_CONCURRENT_DOWNLOADS,
+                 limits=CONCURRENT_DOWNLOADS_PER_KIND,
+                 max_decrypt_workers=MAX_CONCURRENT_DECRYPTIONS):
+        super().__init__()
+
+        # Reference to the SqlAlchemy session registry, which provides the
+        # session of whichever thread it is used in.
+        self.session = make_session_maker(home)
+        self.api = api
+        self.home = home
+        self.data_dir = os.path.join(home, 'data')
+        self.is_qubes = is_qubes
+        self.gpg = GpgHelper(home, is_qubes)
+        self.max_workers = max_workers
+        self.limits = limits
+
+        # Items waiting to be downloaded, in order of priority, and being
+        # downloaded, by uuid.
+        self.pending = PrioritizedDownloads(self.priority)
+        self.active = {}
+
+        # The uuids of the source selected in the GUI and of those visible in
+        # the source list.
+        self.selected_source = None
+        self.visible_sources = set()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.download_done.connect(self.on_download_done)
+
+        # Messages and replies whose ciphertext is waiting to be decrypted, in
+        # order of priority, and the number of the batch each of those being
+        # decrypted is in, by uuid. Each batch is decrypted by one gpg
+        # process, several at once.
+        self.to_decrypt = PrioritizedDownloads(self.priority)
+        self.decrypting = {}
+        self.batch_count = 0
+        self.max_decrypt_workers = max_decrypt_workers
+        self.decrypt_executor = ThreadPoolExecutor(max_workers=max_decrypt_workers)
+        self.ciphertext_downloaded.connect(self.on_ciphertext_downloaded)
+
+        self.stats = DownloadStats()
+
+        # Looks for messages and replies to download. Being a child of this
+        # object, the timer moves to the same thread as it, and restarting it
+        # collapses several wakes into one.
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.run)
+
+    def wake(self):
+        """
+        Look for messages and replies to download as soon as the thread is
+        idle.
+        """
+        self.timer.start(0)
+
+    def schedule_retry(self):
+        """
+        Look for messages and replies to download once the next one which
+        failed may be downloaded again, unless this is already due sooner.
+        """
+        next_attempt = storage.next_download_attempt(self.session)
+        if next_attempt is None:
+            return
+
+        delay = (next_attempt - datetime.datetime.utcnow()).total_seconds()
+        delay = max(0, int(delay * 1000))
+        if not self.timer.isActive() or self.timer.remainingTime() > delay:
+            self.timer.start(delay)
+
+    def run(self):
+        """
+        Enqueue the messages and replies which have not been downloaded yet.
+        """
+        logger.debug('Syncing messages and replies.')
+        if not self.api:
+            return
+
+        for db_object in storage.find_new_submissions(self.session) + \
+                storage.find_new_replies(self.session):
+            self.add_pending(Download.from_db_object(db_object))
+        self.dispatch()
+
+        # Items which failed before may not be downloaded again yet.
+        self.schedule_retry()
+
+    def set_priorities(self, selected_source_uuid, visible_source_uuids):
+        """
+        Download items from the selected source first, then from the visible
+        sources.
+        """
+        self.selected_source = selected_source_uuid
+        self.visible_sources = set(visible_source_uuids)
+        self.pending.reorder()
+        self.to_decrypt.reorder()
+
+    def priority(self, download):
+        """
+        Return the sort key of the item: items which sort first are downloaded
+        first.
+        """
+        if download.source_uuid == self.selected_source:
+            rank = 0
+        elif download.source_uuid in self.visible_sources:
+            rank = 1
+        else:
+            rank = 2
+        return rank, -download.source_last_updated
+
+    def enqueue(self, download):
+        """
+        Download the given item, unless it is already waiting to be (or being)
+        downloaded.
+        """
+        if self.add_pending(download):
+            self.dispatch()
+
+    def add_pending(self, download):
+        """
+        Add the given item to those waiting to be downloaded, unless it is
+        already waiting to be (or being) downloaded. Return True if it was
+        added. The items are handed to the workers by dispatch.
+        """
+        if download.uuid in self.pending or download.uuid in self.active or \
+                download.uuid in self.to_decrypt or download.uuid in self.decrypting:
+            return False
+
+        self.pending[download.uuid] = download
+        return True
+
+    def dispatch(self):
+        """
+        Hand waiting items to the workers in order of priority, as far as the
+        limits allow.
+        """
+        while len(self.active) < self.max_workers:
+            active_by_kind = {}
+            for active in self.active.values():
+                active_by_kind[active.kind] = active_by_kind.get(active.kind, 0) + 1
+            busy_kinds = [kind for kind, count in active_by_kind.items()
+                          if count >= self.limits.get(kind, self.max_workers)]
+            download = self.pending.first(busy_kinds)
+            if download is None:
+                break
+
+            del self.pending[download.uuid]
+            self.active[download.uuid] = download
+            self.executor.submit(self.download_in_worker, download)
+
+        self.report_queue_length()
+
+    def report_queue_length(self):
+        """
+        Record and signal the length of the queue, if it changed. Messages and
+        replies are counted until they are decrypted.
+        """
+        queued = len(self.pending) + len(self.to_decrypt)
+        active = len(self.active) + len(self.decrypting)
+        if (self.stats.queued, self.stats.active) != (queued, active):
+            self.stats.set_queue_length(queued, active)
+            self.queue_length_changed.emit(queued, active)
+
+    def download_in_worker(self, download):
+        """
+        Called in a worker thread. Download the item, reporting the outcome to
+        the queue's thread. Failures are recorded in the database.
+        """
+        try:
+            decrypted = self.download(download)
+        except Exception as e:
+            self.record_failure(download, e)
+            self.download_done.emit(download, e)
+        else:
+            if decrypted:
+                self.stats.item_done(download.uuid, True)
+                self.download_done.emit(download, None)
+            else:
+                self.ciphertext_downloaded.emit(download)
+
+    def decrypt_in_worker(self, downloads):
+        """
+        Called in the decryption thread. Decrypt the items, reporting the
+        outcome of each to the queue's thread as soon as it is known, rather
+        than once the whole batch is decrypted. Failures are recorded in the
+        database.
+        """
+        reported = set()
+
+        def report(download, error):
+            reported.add(download.uuid)
+            if error:
+                self.record_failure(download, error)
+            else:
+                self.stats.item_done(download.uuid, True)
+            self.download_done.emit(download, error)
+
+        try:
+            self.decrypt(downloads, on_decrypted=report)
+        except Exception as e:
+            for download in downloads:
+                if download.uuid not in reported:
+                    report(download, e)
+
+    def record_failure(self, download, error):
+        """
+        Record in the database that the item could not be downloaded, so that
+        it is not downloaded again for a while.
+        """
+        logger.error('Exception while downloading {}! {}'.format(download, error))
+        try:
+            if download.kind == REPLY:
+                storage.mark_reply_download_failed(download.uuid, error, self.session)
+            else:
+                storage.mark_file_download_failed(download.uuid, error, self.session)
+        except Exception as db_error:
+            logger.error('Could not record the failure: {}'.format(db_error))
+            self.session.rollback()
+        self.stats.item_done(download.uuid, False)
+
+    def progress_reporter(self, download):
+        """
+        Return the on_progress callback of download_resumable for the item,
+        which updates the stats and emits download_progress.
+        """
+        last_emitted = [None]
+
+        def on_progress(count, received, total):
+            self.stats.add_bytes(download.uuid, count, received, total)
+            now = time.monotonic()
+            if last_emitted[0] is None or now - last_emitted[0] >= PROGRESS_INTERVAL or \
+                    received == total:
+                last_emitted[0] = now
+                self.download_progress.emit(download.uuid, received,
+                                            -1 if total is None else total)
+
+        return on_progress
+
+    def download(self, download):
+        """
+        Download the item, unless its ciphertext was downloaded before. Files
+        are then decrypted and marked as downloaded, returning True; messages
+        and replies are left to be decrypted in batches, returning False.
+
+        The item's download_state moves from DOWNLOADED to DECRYPTING, then
+        to DECRYPTED or DECRYPTION_FAILED. Until it is decrypted, the
+        ciphertext is kept in the data directory and reused rather than
+        downloaded again, unless its size differs from the one on the server
+        (see also decrypt).
+        """
+        model = Reply if download.kind == REPLY else Submission
+        filepath_in_datadir = os.path.join(self.data_dir, download.filename)
+        state = storage.get_download_state(model, download.uuid, self.session)
+        if state in (DOWNLOADED, DECRYPTING, DECRYPTION_FAILED) and \
+                self.ciphertext_complete(download, filepath_in_datadir):
+            logger.info("Reusing the downloaded {}".format(download.filename))
+            download.reused_ciphertext = True
+        else:
+            self.download_ciphertext(download, filepath_in_datadir)
+            storage.set_download_state(model, download.uuid, DOWNLOADED, self.session)
+
+        if download.kind != FILE:
+            return False
+
+        error = self.decrypt([download]).get(download.uuid)
+        if error:
+            raise error
+        return True
+
+    def ciphertext_complete(self, download, filepath_in_datadir):
+        """
+        Return True if the ciphertext of the item is in the data directory, as
+        large as on the server (if its size there is known). A truncated
+        ciphertext is removed.
+        """
+        if not os.path.exists(filepath_in_datadir):
+            return False
+
+        if download.size is not None and os.path.getsize(filepath_in_datadir) != download.size:
+            logger.info("The downloaded {} is {} bytes instead of {}, discarding it".format(
+                download.filename, os.path.getsize(filepath_in_datadir), download.size))
+            os.unlink(filepath_in_datadir)
+            return False
+
+        return True
+
+    def decrypt(self, downloads, on_decrypted=None):
+        """
+        Decrypt the items, whose ciphertext is in the data directory, and mark
+        those decrypted as downloaded. Files are gunzipped as they are
+        decrypted, so have a gpg process each; messages and replies share one.
+        Return the CryptoError for each item which could not be decrypted, by
+        uuid.
+
+        If given, on_decrypted is called with each item and its CryptoError
+        (or None) as soon as it has been decrypted and marked, see
+        GpgHelper.decrypt_files.
+
+        If a ciphertext reused from an earlier attempt cannot be decrypted
+        either, it is removed, so that the next attempt downloads it again.
+        """
+        for download in downloads:
+            model = Reply if download.kind == REPLY else Submission
+            storage.set_download_state(model, download.uuid, DECRYPTING, self.session)
+
+        errors = {}
+
+        def finished(download, error):
+            if download.kind == REPLY:
+                model = Reply
+                mark_as_downloaded = storage.mark_reply_as_downloaded
+            else:
+                model = Submission
+                mark_as_downloaded = storage.mark_file_as_downloaded
+
+            if error:
+                errors[download.uuid] = error
+                storage.set_download_state(model, download.uuid, DECRYPTION_FAILED,
+                                           self.session)
+                filepath_in_datadir = os.path.join(self.data_dir, download.filename)
+                if download.reused_ciphertext and os.path.exists(filepath_in_datadir):
+                    logger.info("Discarding the reused {}".format(download.filename))
+                    os.unlink(filepath_in_datadir)
+            else:
+                mark_as_downloaded(download.uuid, self.session)
+                logger.info("Stored {} at {}".format(download.kind, download.filename))
+            if on_decrypted:
+                on_decrypted(download, error)
+
+        batch = {}
+        for download in downloads:
+            filepath_in_datadir = os.path.join(self.data_dir, download.filename)
+            if download.kind != FILE:
+                batch[filepath_in_datadir] = download
+                continue
+            try:
+                self.gpg.decrypt_submission_or_reply(filepath_in_datadir, download.filename,
+                                                     is_doc=True)
+            except CryptoError as e:
+                finished(download, e)
+            else:
+                finished(download, None)
+
+        if batch:
+            self.gpg.decrypt_files(list(batch), on_decrypted=lambda filepath, error:
+                                   finished(batch[filepath], error))
+
+        return errors
+
+    def download_ciphertext(self, download, filepath_in_datadir):
+        """
+        Download the encrypted item to the given path in the data directory.
+
+        Outside Qubes OS, the download is streamed and resumable (see
+        download_resumable). The Qubes OS proxy does not support Range
+        requests, so there the download is left to the API.
+        """
+        if not self.is_qubes:
+            if download.kind == REPLY:
+                path_query = 'api/v1/sources/{}/replies/{}/download'
+            else:
+                path_query = 'api/v1/sources/{}/submissions/{}/download'
+            path_query = path_query.format(download.source_uuid, download.uuid)
+            download_resumable(self.api, path_query, filepath_in_datadir,
+                               on_progress=self.progress_reporter(download))
+            return
+
+        # the API wants API objects. here in the client,
+        # we have client objects. let's take care of that
+        # here
+        if download.kind == REPLY:
+            sdk_object = sdkobjects.Reply(uuid=download.uuid)
+            download_fn = self.api.download_reply
+        else:
+            sdk_object = sdkobjects.Submission(uuid=download.uuid)
+            download_fn = self.api.download_submission
+        # Need to set filename on non-Qubes platforms
+        sdk_object.filename = download.filename
+        sdk_object.source_uuid = download.source_uuid
+
+        _, filepath = download_fn(sdk_object, self.data_dir)
+
+        # On Qubes OS, the file is stored in a ~/QubesIncoming directory, so
+        # is moved to the data directory and named the same as on the server.
+        if filepath != filepath_in_datadir:
+            shutil.move(filepath, filepath_in_datadir)
+
+        # The API gives no progress, so all the bytes arrive at once.
+        size = os.path.getsize(filepath_in_datadir)
+        self.progress_reporter(download)(size, size, size)
+
+    def on_download_done(self, download, error):
+        """
+        Called in the queue's thread when a worker has finished with an item.
+        Report the outcome, then hand the workers more items.
+        """
+        self.active.pop(download.uuid, None)
+        self.decrypting.pop(download.uuid, None)
+
+        if error is None:
+            if download.kind == MESSAGE:
+                self.message_downloaded.emit(download.uuid,
+                                             get_data(self.home, download.filename))
+            elif download.kind == REPLY:
+                self.reply_downloaded.emit(download.uuid,
+                                           get_data(self.home, download.filename))
+            else:
+                self.file_downloaded.emit(download.uuid, download.filename)
+        elif download.kind == FILE:
+            self.file_download_failed.emit(download.uuid, download.filename, error)
+        else:
+            self.schedule_retry()
+
+        self.decrypt_next()
+        self.dispatch()
+        if not (self.pending or self.active or self.to_decrypt or self.decrypting):
+            logger.info('Downloads finished: {}'.format(self.stats.as_dict()))
+
+    def on_ciphertext_downloaded(self, download):
+        """
+        Called in the queue's thread when the ciphertext of a message or reply
+        has been downloaded. Decrypt it as soon as a decryption thread is
+        free, then hand the workers more items.
+        """
+        self.active.pop(download.uuid, None)
+        self.to_decrypt[download.uuid] = download
+        self.decrypt_next()
+        self.dispatch()
+
+    def decrypt_next(self):
+        """
+        Hand the messages and replies waiting to be decrypted to the free
+        decryption threads in batches, in order of priority. Items from the
+        selected source and from the visible sources are never batched with
+        less urgent items, so they do not wait on them. While every thread is
+        busy, items queue up.
+        """
+        free_workers = self.max_decrypt_workers - len(set(self.decrypting.values()))
+        if free_workers <= 0 or not self.to_decrypt:
+            return
+
+        batches = []
+        download = self.to_decrypt.first()
+        while download:
+            rank = self.priority(download)[0]
+            if batches and len(batches[-1]) < DECRYPT_BATCH_SIZE and \
+                    self.priority(batches[-1][0])[0] == rank:
+                batches[-1].append(download)
+            elif len(batches) < free_workers:
+                batches.append([download])
+            else:
+                break
+            del self.to_decrypt[download.uuid]
+            download = self.to_decrypt.first()
+
+        for batch in batches:
+            self.batch_count += 1
+            for download in batch:
+                self.decrypting[download.uuid] = self.batch_count
+            self.decrypt_executor.submit(self.decrypt_in_worker, batch)
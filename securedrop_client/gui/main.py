@@ -134,6 +134,13 @@ class Window(QMainWindow):
         """
         self.main_view.source_list.update(sources)
 
+    def show_changed_sources(self, sources, changed_source_uuids):
+        """
+        Update the left hand sources list in the UI with the passed in list of
+        changed sources, leaving the other sources as they are.
+        """
+        self.main_view.source_list.update_changed(sources, changed_source_uuids)
+
     def show_sync(self, updated_on):
         """
         Display a message indicating the data-sync state.
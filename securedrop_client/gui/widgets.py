@@ -79,6 +79,8 @@ class ToolBar(QWidget):
         self.controller = controller
 
         self.controller.sync_events.connect(self._on_sync_event)
+        self.controller.sync_progress.connect(self._on_sync_progress)
+        self.controller.file_purge.purge_progress.connect(self._on_purge_progress)
 
     def set_logged_in_as(self, username):
         """
@@ -122,6 +124,18 @@ class ToolBar(QWidget):
         """
         self.refresh.setEnabled(data != 'syncing')
 
+    def _on_sync_progress(self, fetched, total):
+        """
+        Called as each source is stored while a sync is in progress.
+        """
+        self.window.set_status(_('Refreshed {} of {} sources.').format(fetched, total))
+
+    def _on_purge_progress(self, deleted, total):
+        """
+        Called as each batch of files of deleted records is removed from disk.
+        """
+        self.window.set_status(_('Deleted {} of {} files.').format(deleted, total))
+
 
 class MainView(QWidget):
     """
@@ -191,6 +205,26 @@ class SourceList(QListWidget):
         Pass through the controller object to this widget.
         """
         self.controller = controller
+        self.itemSelectionChanged.connect(self.update_download_priorities)
+        self.verticalScrollBar().valueChanged.connect(self.update_download_priorities)
+
+    def update_download_priorities(self):
+        """
+        Tell the controller which source is selected and which sources can be
+        seen, so that their messages are downloaded first.
+        """
+        current_maybe = self.currentItem() and self.itemWidget(self.currentItem())
+        selected = current_maybe.source.uuid if current_maybe else None
+
+        viewport = self.viewport().rect()
+        visible = []
+        for row in range(self.count()):
+            list_item = self.item(row)
+            source_widget = self.itemWidget(list_item)
+            if source_widget and self.visualItemRect(list_item).intersects(viewport):
+                visible.append(source_widget.source.uuid)
+
+        self.controller.set_download_priorities(selected, visible)
 
     def update(self, sources):
         """
@@ -216,6 +250,55 @@ class SourceList(QListWidget):
         if new_current_maybe:
             self.setCurrentItem(new_current_maybe)
 
+        self.update_download_priorities()
+
+    def update_changed(self, sources, changed_source_uuids):
+        """
+        Update the list with the passed in list of changed sources, leaving the
+        other sources as they are. Sources whose uuid is in
+        changed_source_uuids but that are not in the list of sources were
+        deleted.
+        """
+        current_maybe = self.currentItem() and self.itemWidget(self.currentItem())
+        current_uuid = current_maybe.source.uuid if current_maybe else None
+
+        # The selection only changes for good once the list is updated.
+        self.blockSignals(True)
+        kept_sources = []
+        for row in reversed(range(self.count())):
+            list_item = self.item(row)
+            source_widget = self.itemWidget(list_item)
+            if source_widget.source.uuid in changed_source_uuids:
+                self.removeItemWidget(list_item)
+                self.takeItem(row)
+            else:
+                kept_sources.insert(0, source_widget.source)
+
+        new_uuids = set(source.uuid for source in sources)
+        all_sources = sorted(kept_sources + list(sources),
+                             key=lambda x: x.last_updated, reverse=True)
+        new_current_maybe = None
+        for row, source in enumerate(all_sources):
+            if source.uuid not in new_uuids:
+                continue
+            new_source = SourceWidget(self, source)
+            new_source.setup(self.controller)
+
+            list_item = QListWidgetItem()
+            list_item.setSizeHint(new_source.sizeHint())
+
+            self.insertItem(row, list_item)
+            self.setItemWidget(list_item, new_source)
+
+            if source.uuid == current_uuid:
+                new_current_maybe = list_item
+        self.blockSignals(False)
+
+        if new_current_maybe:
+            self.setCurrentItem(new_current_maybe)
+
+        self.update_download_priorities()
+
 
 class DeleteSourceMessageBox:
     """Use this to display operation details and confirm user choice."""
@@ -718,14 +801,14 @@ class ConversationView(QWidget):
         Add a message from the source.
         """
         self.conversation_layout.addWidget(
-            MessageWidget(message_id, message, self.controller.message_sync.message_downloaded))
+            MessageWidget(message_id, message, self.controller.download_queue.message_downloaded))
 
     def add_reply(self, message_id: str, reply: str, files=None) -> None:
         """
         Add a reply from a journalist.
         """
         self.conversation_layout.addWidget(
-            ReplyWidget(message_id, reply, self.controller.reply_sync.reply_downloaded))
+            ReplyWidget(message_id, reply, self.controller.download_queue.reply_downloaded))
 
 
 class SourceConversationWrapper(QWidget):
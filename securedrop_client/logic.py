@@ -18,26 +18,36 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 import os
 import logging
+import threading
 import sdclientapi
-import shutil
 import arrow
 import uuid
 from securedrop_client import storage
 from securedrop_client import db
 from securedrop_client.utils import check_dir_permissions
-from securedrop_client.crypto import GpgHelper, CryptoError
-from securedrop_client.message_sync import MessageSync, ReplySync
-from PyQt5.QtCore import QObject, QThread, pyqtSignal, QTimer, QProcess
+from securedrop_client.crypto import CryptoError
+from securedrop_client.downloads import Download, DownloadQueue
+from securedrop_client.post_sync import PostSync
+from securedrop_client.purge import FilePurge
+from PyQt5.QtCore import QObject, QRunnable, QThread, QThreadPool, pyqtSignal, QTimer, \
+    QProcess
 
 logger = logging.getLogger(__name__)
 
+# The most API calls made at once. Further calls wait for a free thread.
+MAX_CONCURRENT_API_CALLS = 4
+
+# Milliseconds to wait after a change is made on the server (e.g. a source is
+# starred or deleted) before syncing, so that changes in quick succession are
+# followed by a single sync.
+SYNC_DEBOUNCE = 1000
+
 
 class APICallRunner(QObject):
     """
     Used to call the SecureDrop API in a non-blocking manner. Will emit a
-    call_finished signal when a result becomes known. The caller should manage
-    the state of i_timed_out (a flag used to indicate the call to the API has
-    timed out).
+    call_finished signal when a result becomes known. The caller should call
+    time_out when the call to the API has timed out.
 
     See the call_api method of the Client class for how this is
     done (hint: you should be using the call_api method and not directly
@@ -59,12 +69,23 @@ class APICallRunner(QObject):
         self.kwargs = kwargs
         self.result = None
         self.i_timed_out = False
+        # Whether the API is being called, guarded by lock as the call is made
+        # in another thread than the one timing it out.
+        self.running = False
+        self.lock = threading.Lock()
 
     def call_api(self):
         """
         Call the API. Emit a boolean signal to indicate the outcome of the
         call. Any return value or exception raised is stored in self.result.
         """
+        with self.lock:
+            # the call may have waited for a thread for longer than its timeout
+            if self.i_timed_out:
+                logger.info("API call timed out before it was made.")
+                return
+            self.running = True
+
         # this blocks
         try:
             self.result = self.api_call(*self.args, **self.kwargs)
@@ -72,13 +93,38 @@ class APICallRunner(QObject):
             logger.error(ex)
             self.result = ex
 
-        # by the time we end up here, who knows how long it's taken
-        # we may not want to emit this, if there's nothing to catch it
-        if self.i_timed_out is False:
-            self.call_finished.emit()
-        else:
+        with self.lock:
+            self.running = False
+
+        # by the time we end up here, who knows how long it's taken: if the
+        # call timed out, the signal tells the caller that the thread is free
+        if self.i_timed_out:
             logger.info("Thread returned from API call, "
                         "but it had timed out.")  # pragma: no cover
+        self.call_finished.emit()
+
+    def time_out(self):
+        """
+        Flag the call as timed out. Return True if the API is still being
+        called, in which case call_finished is emitted once it returns.
+        """
+        with self.lock:
+            self.i_timed_out = True
+            return self.running
+
+
+class APICallRunnable(QRunnable):
+    """
+    Runs an APICallRunner in a thread of a QThreadPool. (A QRunnable is not a
+    QObject, so cannot emit the runner's signal itself.)
+    """
+
+    def __init__(self, runner):
+        super().__init__()
+        self.runner = runner
+
+    def run(self):
+        self.runner.call_api()
 
 
 class Client(QObject):
@@ -89,6 +135,52 @@ class Client(QObject):
 
     sync_events = pyqtSignal(str)
 
+    """
+    Signal emitted from the sync thread as the submissions of each source are
+    fetched. The signal is a tuple of (remote_source, remote_submissions,
+    fetched_count, stale_count), see storage.get_remote_data.
+    """
+    source_fetched = pyqtSignal(object, object, int, int)
+
+    """
+    Signal emitted as each source fetched during a sync is stored locally.
+    The signal is a tuple of (int, int) containing the number of sources
+    stored so far and the number of sources being synced.
+    """
+    sync_progress = pyqtSignal(int, int)
+
+    """
+    Signal emitted with a list of paths of files to delete in the background,
+    see FilePurge.
+    """
+    purge_requested = pyqtSignal(object)
+
+    """
+    Signal emitted when a sync may have stored items which have not been
+    downloaded yet, waking the download queue.
+    """
+    downloads_requested = pyqtSignal()
+
+    """
+    Signal emitted with a Download to add to the download queue, see
+    on_file_download.
+    """
+    file_download_requested = pyqtSignal(object)
+
+    """
+    Signal emitted when the sources the user is looking at change. The signal
+    is a tuple of (str, list) containing the uuid of the selected source (or
+    None) and the uuids of the sources visible in the source list.
+    """
+    download_priorities_changed = pyqtSignal(object, object)
+
+    """
+    Signal emitted with the result of a sync, a tuple of (remote_sources,
+    remote_submissions, remote_replies), to store it in the background, see
+    PostSync.
+    """
+    post_sync_requested = pyqtSignal(object, object, object)
+
     def __init__(self, hostname, gui, session,
                  home: str, proxy: bool = True) -> None:
         """
@@ -113,26 +205,54 @@ class Client(QObject):
 
         # Reference to the API for secure drop proxy.
         self.api = None
-        # Contains active threads calling the API.
+        # Contains the API calls in progress, by id, and the ids of those
+        # which others may attach to, by coalesce_key (see call_api).
         self.api_threads = {}
+        self.coalesced_api_calls = {}
+        # The threads which call the API, reused from one call to the next.
+        self.api_pool = QThreadPool()
+        self.api_pool.setMaxThreadCount(MAX_CONCURRENT_API_CALLS)
 
         # Reference to the SqlAlchemy session.
         self.session = session
 
-        # thread responsible for fetching messages
-        self.message_thread = None
-        self.message_sync = MessageSync(self.api, self.home, self.proxy)
+        # thread responsible for fetching messages, replies and files
+        self.download_thread = None
+        self.download_queue = DownloadQueue(self.api, self.home, self.proxy)
 
-        # thread responsible for fetching replies
-        self.reply_thread = None
-        self.reply_sync = ReplySync(self.api, self.home, self.proxy)
+        # thread responsible for deleting the files of deleted records
+        self.purge_thread = None
+        self.file_purge = FilePurge()
+        self.purge_requested.connect(self.file_purge.purge)
+
+        self.downloads_requested.connect(self.download_queue.wake)
+        self.file_download_requested.connect(self.download_queue.enqueue)
+        self.download_priorities_changed.connect(self.download_queue.set_priorities)
+        self.download_queue.file_downloaded.connect(self.on_file_downloaded)
+        self.download_queue.file_download_failed.connect(self.on_file_download_failed)
+
+        # thread responsible for storing the result of each sync
+        self.post_sync_thread = None
+        self.post_sync = PostSync(home, proxy)
+        self.post_sync_requested.connect(self.post_sync.run)
+        self.post_sync.source_stored.connect(self.on_source_stored)
+        self.post_sync.post_sync_done.connect(self.on_post_sync_done)
 
         self.sync_flag = os.path.join(home, 'sync_flag')
 
         # File data.
         self.data_dir = os.path.join(self.home, 'data')
 
-        self.gpg = GpgHelper(home, proxy)
+        # Syncs requested after changes on the server are collapsed into one,
+        # which runs after any sync in progress, see request_sync.
+        self.sync_debounce = QTimer()
+        self.sync_debounce.setSingleShot(True)
+        self.sync_debounce.timeout.connect(self.sync_after_changes)
+        self.resync_requested = False
+
+        # Sources are fetched in the sync thread and stored in the post sync
+        # thread.
+        self.source_fetched.connect(self.post_sync.store_source)
 
     def setup(self):
         """
@@ -164,46 +284,66 @@ class Client(QObject):
         self.sync_update.start(1000 * 60 * 5)  # every 5 minutes.
 
     def call_api(self, function, callback, timeout, *args, current_object=None,
-                 **kwargs):
+                 coalesce_key=None, **kwargs):
         """
         Calls the function in a non-blocking manner. Upon completion calls the
         callback with the result. Calls timeout if the timer associated with
         the call emits a timeout signal. Any further arguments are passed to
         the function to be called.
-        """
-        new_thread_id = str(uuid.uuid4())  # Uniquely id the new thread.
+
+        The function is called in a thread of the API thread pool, so at most
+        MAX_CONCURRENT_API_CALLS calls are made at once.
+
+        If a coalesce_key is given and a call with the same key is in
+        progress, no new call is made: the callback and timeout are attached
+        to the call in progress instead, and so get its result. A call which
+        timed out is in progress until the function returns.
+        """
+        if coalesce_key is not None and coalesce_key in self.coalesced_api_calls:
+            thread_info = self.api_threads[self.coalesced_api_calls[coalesce_key]]
+            if thread_info.get('timed_out') and not thread_info['timer'].isActive():
+                # The call timed out before, so is timed again for this
+                # callback.
+                thread_info['timer'].start(20000)
+            if callback not in thread_info['callbacks']:
+                thread_info['callbacks'].append(callback)
+            if timeout not in thread_info['timeouts']:
+                thread_info['timeouts'].append(timeout)
+            logger.debug("Attached to API call in progress: {}".format(coalesce_key))
+            return
+
+        new_thread_id = str(uuid.uuid4())  # Uniquely id the new call.
         new_timer = QTimer()
         new_timer.setSingleShot(True)
         new_timer.start(20000)
 
-        new_api_thread = QThread(self.gui)
         new_api_runner = APICallRunner(function, current_object, *args,
                                        **kwargs)
-        new_api_runner.moveToThread(new_api_thread)
 
         # handle completed call: copy response data, reset the
-        # client, give the user-provided callback the response
+        # client, give the user-provided callbacks the response
         # data
         new_api_runner.call_finished.connect(
-            lambda: self.completed_api_call(new_thread_id, callback))
+            lambda: self.completed_api_call(new_thread_id))
 
         # we've started a timer. when that hits zero, call our
-        # timeout function
+        # timeout functions
         new_timer.timeout.connect(
-            lambda: self.timeout_cleanup(new_thread_id, timeout))
-
-        # when the thread starts, we want to run `call_api` on `api_runner`
-        new_api_thread.started.connect(new_api_runner.call_api)
+            lambda: self.timeout_cleanup(new_thread_id))
 
-        # Add the thread related objects to the api_threads dictionary.
+        # Add the call related objects to the api_threads dictionary.
         self.api_threads[new_thread_id] = {
-            'thread': new_api_thread,
             'runner': new_api_runner,
             'timer': new_timer,
+            'callbacks': [callback],
+            'timeouts': [timeout],
+            'coalesce_key': coalesce_key,
         }
+        if coalesce_key is not None:
+            self.coalesced_api_calls[coalesce_key] = new_thread_id
 
-        # Start the thread and related activity.
-        new_api_thread.start()
+        # Run `call_api` on `api_runner` once a thread is free.
+        self.api_pool.start(APICallRunnable(new_api_runner))
 
     def clean_thread(self, thread_id):
         """
@@ -212,17 +352,24 @@ class Client(QObject):
         if thread_id in self.api_threads:
             timer = self.api_threads[thread_id]['timer']
             timer.disconnect()
+            coalesce_key = self.api_threads[thread_id].get('coalesce_key')
+            if self.coalesced_api_calls.get(coalesce_key) == thread_id:
+                del self.coalesced_api_calls[coalesce_key]
             del(self.api_threads[thread_id])
 
-    def completed_api_call(self, thread_id, user_callback):
+    def completed_api_call(self, thread_id):
         """
         Manage a completed API call. The actual result *may* be an exception or
-        error result from the API. It's up to the handler (user_callback) to
+        error result from the API. It's up to the handlers (the callbacks) to
         handle these potential states.
         """
         logger.info("Completed API call. Cleaning up and running callback.")
         if thread_id in self.api_threads:
             thread_info = self.api_threads[thread_id]
+            if thread_info.get('timed_out'):
+                # The thread held by the timed out call is free again. Only
+                # the callbacks attached since it timed out are left.
+                self.api_pool.setMaxThreadCount(self.api_pool.maxThreadCount() - 1)
             runner = thread_info['runner']
             timer = thread_info['timer']
             timer.stop()
@@ -235,58 +382,78 @@ class Client(QObject):
                 current_object = None
 
             self.clean_thread(thread_id)
-            if current_object:
-                user_callback(result_data, current_object=current_object)
-            else:
-                user_callback(result_data)
+            for user_callback in thread_info['callbacks']:
+                if current_object:
+                    user_callback(result_data, current_object=current_object)
+                else:
+                    user_callback(result_data)
+
+    def start_download_thread(self):
+        """
+        Starts the download thread in the background.
+        """
+        if not self.download_thread:
+            self.download_queue.api = self.api
+            self.download_thread = QThread()
+            self.download_queue.moveToThread(self.download_thread)
+            self.download_thread.started.connect(self.download_queue.run)
+            self.download_thread.start()
+        else:  # Already running from last login
+            self.download_queue.api = self.api
 
-    def start_message_thread(self):
+    def start_purge_thread(self):
         """
-        Starts the message-fetching thread in the background.
+        Starts the file-purging thread in the background.
         """
-        if not self.message_thread:
-            self.message_sync.api = self.api
-            self.message_thread = QThread()
-            self.message_sync.moveToThread(self.message_thread)
-            self.message_thread.started.connect(self.message_sync.run)
-            self.message_thread.start()
-        else:  # Already running from last login
-            self.message_sync.api = self.api
+        if not self.purge_thread:
+            self.purge_thread = QThread()
+            self.file_purge.moveToThread(self.purge_thread)
+            self.purge_thread.start()
 
-    def start_reply_thread(self):
+    def start_post_sync_thread(self):
         """
-        Starts the reply-fetching thread in the background.
+        Starts the thread which stores the result of each sync in the
+        background.
         """
-        if not self.reply_thread:
-            self.reply_sync.api = self.api
-            self.reply_thread = QThread()
-            self.reply_sync.moveToThread(self.reply_thread)
-            self.reply_thread.started.connect(self.reply_sync.run)
-            self.reply_thread.start()
-        else:  # Already running from last login
-            self.reply_sync.api = self.api
+        if not self.post_sync_thread:
+            self.post_sync_thread = QThread()
+            self.post_sync.moveToThread(self.post_sync_thread)
+            self.post_sync_thread.start()
 
-    def timeout_cleanup(self, thread_id, user_callback):
+    def timeout_cleanup(self, thread_id):
         """
         Clean up after the referenced thread has timed-out by setting some
-        flags and calling the passed user_callback.
+        flags and calling the timeout callbacks.
         """
         logger.info("API call timed out. Cleaning up and running "
                     "timeout callback.")
         if thread_id in self.api_threads:
-            runner = self.api_threads[thread_id]['runner']
-            runner.i_timed_out = True
+            thread_info = self.api_threads[thread_id]
+            runner = thread_info['runner']
 
             if runner.current_object:
                 current_object = runner.current_object
             else:
                 current_object = None
 
-            self.clean_thread(thread_id)
-            if current_object:
-                user_callback(current_object=current_object)
+            timeouts = thread_info['timeouts']
+            if thread_info.get('timed_out') or runner.time_out():
+                # The call still holds a thread of the pool, which may never
+                # be freed: let another call have a thread meanwhile, until
+                # it returns (see completed_api_call). It stays in progress
+                # till then, so that the same call is not made twice at once.
+                if not thread_info.get('timed_out'):
+                    self.api_pool.setMaxThreadCount(self.api_pool.maxThreadCount() + 1)
+                    thread_info['timed_out'] = True
+                thread_info['callbacks'] = []
+                thread_info['timeouts'] = []
             else:
-                user_callback()
+                self.clean_thread(thread_id)
+            for user_callback in timeouts:
+                if current_object:
+                    user_callback(current_object=current_object)
+                else:
+                    user_callback()
 
     def login(self, username, password, totp):
         """
@@ -305,10 +472,11 @@ class Client(QObject):
         if isinstance(result, bool) and result:
             # It worked! Sync with the API and update the UI.
             self.gui.hide_login()
-            self.sync_api()
+            self.sync_api(full=True)
             self.gui.set_logged_in_as(self.api.username)
-            self.start_message_thread()
-            self.start_reply_thread()
+            self.start_download_thread()
+            self.start_purge_thread()
+            self.start_post_sync_thread()
 
             # Clear the sidebar error status bar if a message was shown
             # to the user indicating they should log in.
@@ -366,9 +534,14 @@ class Client(QObject):
         """
         return bool(self.api and self.api.token['token'])
 
-    def sync_api(self):
+    def sync_api(self, full=False):
         """
         Grab data from the remote SecureDrop API in a non-blocking manner.
+
+        Unless a full sync is requested (or there has never been a sync),
+        submissions are only fetched for sources whose last_updated timestamp
+        has changed on the server. They are stored as they arrive, see
+        PostSync.store_source.
         """
         logger.debug("In sync_api on thread {}".format(
             self.thread().currentThreadId()))
@@ -376,11 +549,41 @@ class Client(QObject):
 
         if self.authenticated():
             logger.debug("You are authenticated, going to make your call")
+            if full or self.last_sync() is None:
+                last_updated = None
+            else:
+                last_updated = {source.uuid: source.last_updated for source
+                                in storage.get_local_sources(self.session)}
+            # A sync requested while one is in progress gets its result.
             self.call_api(storage.get_remote_data, self.on_synced,
-                          self.on_sync_timeout, self.api)
+                          self.on_sync_timeout, self.api, last_updated,
+                          on_source_fetched=self.source_fetched.emit,
+                          coalesce_key='full sync' if full else 'sync')
             logger.debug("In sync_api, after call to call_api, on "
                          "thread {}".format(self.thread().currentThreadId()))
 
+    def request_sync(self):
+        """
+        Sync once SYNC_DEBOUNCE milliseconds have passed without another
+        request, so that several changes made on the server in quick
+        succession are followed by a single sync.
+        """
+        self.sync_debounce.start(SYNC_DEBOUNCE)
+
+    def sync_after_changes(self):
+        """
+        Sync to fetch the changes made on the server. A sync in progress may
+        have started before the changes were made, so sync again once it is
+        done (see on_synced). It may have timed out already, so is attached to
+        for on_synced to be called.
+        """
+        for coalesce_key in ('sync', 'full sync'):
+            if coalesce_key in self.coalesced_api_calls:
+                self.resync_requested = True
+                self.sync_api(full=coalesce_key == 'full sync')
+                return
+        self.sync_api()
+
     def last_sync(self):
         """
         Returns the time of last synchronisation with the remote SD server.
@@ -391,48 +594,52 @@ class Client(QObject):
         except Exception:
             return None
 
+    def on_source_stored(self, deleted_files, has_submissions, fetched, total):
+        """
+        Called while a sync is in progress, once a source and its submissions
+        have been stored (see PostSync.store_source).
+        """
+        self.purge_requested.emit(deleted_files)
+        if has_submissions:
+            self.downloads_requested.emit()
+        self.sync_progress.emit(fetched, total)
+
     def on_synced(self, result):
         """
         Called when syncronisation of data via the API is complete.
         """
         self.sync_events.emit('synced')
+        if self.resync_requested:
+            self.resync_requested = False
+            self.sync_api()
+
         if isinstance(result, tuple):
-            remote_sources, remote_submissions, remote_replies = \
-                result
-
-            storage.update_local_storage(self.session, remote_sources,
-                                         remote_submissions,
-                                         remote_replies, self.data_dir)
-
-            # clean up locally cached conversation views
-            remote_source_uuids = [s.uuid for s in remote_sources]
-            cached_sources = list(self.gui.conversations.keys())
-            for cached_source in cached_sources:
-                if cached_source not in remote_source_uuids:
-                    self.gui.conversations.pop(cached_source, None)
-
-            # Set last sync flag.
-            with open(self.sync_flag, 'w') as f:
-                f.write(arrow.now().format())
-
-            # import keys into keyring
-            for source in remote_sources:
-                if source.key and source.key.get('type', None) == 'PGP':
-                    pub_key = source.key.get('public', None)
-                    if not pub_key:
-                        continue
-                    try:
-                        self.gpg.import_key(source.uuid, pub_key)
-                    except CryptoError:
-                        logger.warning('Failed to import key for source {}'.format(source.uuid))
-
-            self.update_conversation_views()
+            # Storing the result takes a while, so is done in the background
+            # and the UI updated once it is done, see on_post_sync_done.
+            self.post_sync_requested.emit(*result)
         else:
             # How to handle a failure? Exceptions are already logged. Perhaps
             # a message in the UI?
-            pass
+            self.update_sources()
 
-        self.update_sources()
+    def on_post_sync_done(self, remote_source_uuids, deleted_files,
+                          changed_source_uuids):
+        """
+        Called when the result of a sync has been stored. Update the UI with
+        what changed: only the changed sources are read again and redrawn.
+        """
+        self.purge_requested.emit(deleted_files)
+        self.downloads_requested.emit()
+
+        # clean up locally cached conversation views
+        remote_source_uuids = set(remote_source_uuids)
+        cached_sources = list(self.gui.conversations.keys())
+        for cached_source in cached_sources:
+            if cached_source not in remote_source_uuids:
+                self.gui.conversations.pop(cached_source, None)
+
+        self.update_conversation_views(changed_source_uuids)
+        self.update_sources(changed_source_uuids)
 
     def update_sync(self):
         """
@@ -440,24 +647,42 @@ class Client(QObject):
         """
         self.gui.show_sync(self.last_sync())
 
-    def update_sources(self):
+    def update_sources(self, changed_source_uuids=None):
         """
         Display the updated list of sources with those found in local storage.
-        """
-        sources = list(storage.get_local_sources(self.session))
-        if sources:
-            sources.sort(key=lambda x: x.last_updated, reverse=True)
-        self.gui.show_sources(sources)
+
+        If changed_source_uuids is given, only those sources are read again
+        (they were stored by another session) and redrawn in the list.
+        """
+        if changed_source_uuids is None:
+            sources = list(storage.get_local_sources(self.session))
+            if sources:
+                sources.sort(key=lambda x: x.last_updated, reverse=True)
+            self.gui.show_sources(sources)
+        elif changed_source_uuids:
+            sources = list(storage.get_local_sources(self.session,
+                                                     changed_source_uuids))
+            for source in sources:
+                self.session.refresh(source)
+            self.gui.show_changed_sources(sources, changed_source_uuids)
         self.update_sync()
 
-    def update_conversation_views(self):
+    def update_conversation_views(self, source_uuids=None):
         """
-        Updates the conversation view to reflect progress
-        of the download and decryption of messages and replies.
+        Updates the conversation views (of the given sources, or of all of
+        them) to reflect progress of the download and decryption of messages
+        and replies.
         """
-        for conversation_wrapper in self.gui.conversations.values():
+        for source_uuid, conversation_wrapper in self.gui.conversations.items():
+            if source_uuids is not None and source_uuid not in source_uuids:
+                continue
             conv = conversation_wrapper.conversation
             self.session.refresh(conv.source)
+            # The messages and replies were downloaded by another session, so
+            # are read again, with a query for each kind.
+            for model in (db.Submission, db.Reply):
+                self.session.query(model).filter_by(source_id=conv.source.id) \
+                                         .populate_existing().all()
             conv.update_conversation(conv.source.collection)
 
     def on_update_star_complete(self, result):
@@ -468,7 +693,7 @@ class Client(QObject):
         TODO: Improve the push to server sync logic.
         """
         if isinstance(result, bool) and result:  # result may be an exception.
-            self.sync_api()  # Syncing the API also updates the source list UI
+            self.request_sync()  # Syncing the API also updates the source list UI
             self.gui.update_error_status("")
         else:
             # Here we need some kind of retry logic.
@@ -502,8 +727,7 @@ class Client(QObject):
         state.
         """
         self.api = None
-        self.message_sync.api = None
-        self.reply_sync.api = None
+        self.download_queue.api = None
         self.gui.logout()
 
     def set_status(self, message, duration=5000):
@@ -542,81 +766,54 @@ class Client(QObject):
     def on_file_download(self, source_db_object, message):
         """
         Download the file associated with the associated message (which may
-        be a Submission or Reply).
+        be a Submission or Reply) in the download queue.
         """
         if not self.api:  # Then we should tell the user they need to login.
             self.on_action_requiring_login()
             return
 
-        if isinstance(message, db.Submission):
-            # Handle submissions.
-            func = self.api.download_submission
-            sdk_object = sdclientapi.Submission(uuid=message.uuid)
-            sdk_object.filename = message.filename
-            sdk_object.source_uuid = source_db_object.uuid
-        elif isinstance(message, db.Reply):
-            # Handle journalist's replies.
-            func = self.api.download_reply
-            sdk_object = sdclientapi.Reply(uuid=message.uuid)
-            sdk_object.filename = message.filename
-            sdk_object.source_uuid = source_db_object.uuid
-
-        self.set_status(_('Downloading {}'.format(sdk_object.filename)))
-        self.call_api(func, self.on_file_downloaded,
-                      self.on_download_timeout, sdk_object, self.data_dir,
-                      current_object=message)
-
-    def on_file_downloaded(self, result, current_object):
-        """
-        Called when a file has downloaded. Cause a refresh to the conversation
-        view to display the contents of the new file.
-        """
-        file_uuid = current_object.uuid
-        server_filename = current_object.filename
-        if isinstance(result, tuple):  # The file properly downloaded.
-            sha256sum, filename = result
-            # The filename contains the location where the file has been
-            # stored. On non-Qubes OSes, this will be the data directory.
-            # On Qubes OS, this will a ~/QubesIncoming directory. In case
-            # we are on Qubes, we should move the file to the data directory
-            # and name it the same as the server (e.g. spotless-tater-msg.gpg).
-            filepath_in_datadir = os.path.join(self.data_dir, server_filename)
-            shutil.move(filename, filepath_in_datadir)
-
-            try:
-                # Attempt to decrypt the file.
-                self.gpg.decrypt_submission_or_reply(
-                    filepath_in_datadir, server_filename, is_doc=True)
-            except CryptoError as e:
-                logger.debug('Failed to decrypt file {}: {}'.format(server_filename, e))
-
-                self.set_status("Failed to download and decrypt file, "
-                                "please try again.")
-                # TODO: We should save the downloaded content, and just
-                # try to decrypt again if there was a failure.
-                return  # If we failed we should stop here.
-
-            # Now that download and decrypt are done, mark the file as such.
-            storage.mark_file_as_downloaded(file_uuid, self.session)
-
-            self.set_status('Finished downloading {}'.format(current_object.filename))
-        else:  # The file did not download properly.
-            logger.debug('Failed to download file {}'.format(server_filename))
-            # Update the UI in some way to indicate a failure state.
-            self.set_status("The file download failed. Please try again.")
+        self.set_status(_('Downloading {}'.format(message.filename)))
+        self.file_download_requested.emit(Download.from_db_object(message, source_db_object))
 
-    def on_download_timeout(self, current_object):
+    def set_download_priorities(self, selected_source_uuid, visible_source_uuids):
         """
-        Called when downloading a file has timed out.
+        Download the messages, replies and files of the selected source first,
+        then those of the visible sources.
         """
-        # Update the status bar to indicate a failure state.
-        self.set_status("The connection to the SecureDrop server timed out. "
-                        "Please try again.")
+        self.download_priorities_changed.emit(selected_source_uuid, visible_source_uuids)
+
+    def on_file_downloaded(self, file_uuid, server_filename):
+        """
+        Called when a file has been downloaded, decrypted and marked as
+        downloaded by the download queue.
+        """
+        # The file was marked as downloaded in the session of another
+        # thread, so reload it in this one.
+        submission = self.session.query(db.Submission) \
+                                 .filter_by(uuid=file_uuid) \
+                                 .one_or_none()
+        if submission:
+            self.session.refresh(submission)
+
+        self.set_status('Finished downloading {}'.format(server_filename))
+
+    def on_file_download_failed(self, file_uuid, server_filename, error):
+        """
+        Called when the download queue failed to download or decrypt a file.
+        """
+        if isinstance(error, CryptoError):
+            logger.debug('Failed to decrypt file {}: {}'.format(server_filename, error))
+            self.set_status("Failed to download and decrypt file, "
+                            "please try again.")
+        else:
+            logger.debug('Failed to download file {}'.format(server_filename))
+            # Update the UI in some way to indicate a failure state.
+            self.set_status("The file download failed. Please try again.")
 
     def _on_delete_source_complete(self, result):
         """Trigger this when delete operation on source is completed."""
         if result:
-            self.sync_api()
+            self.request_sync()
             self.gui.update_error_status("")
         else:
             logging.info("failed to delete source at server")
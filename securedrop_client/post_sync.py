@@ -0,0 +1,147 @@
+"""
+Contains the PostSync class, which runs in the background and stores the
+data of each sync with the API: the sources as they arrive, then reconciling
+local storage with the server's data, recording the time of the sync and
+importing source keys.
+
+Copyright (C) 2018  The Freedom of the Press Foundation.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import arrow
+import logging
+import os
+
+from PyQt5.QtCore import QObject, pyqtSignal
+
+from securedrop_client import storage
+from securedrop_client.crypto import CryptoError, GpgHelper
+from securedrop_client.db import make_session_maker
+
+
+logger = logging.getLogger(__name__)
+
+
+class PostSync(QObject):
+    """
+    Runs in the background during and after each sync, so that the GUI thread
+    is only left to redraw what changed.
+    """
+
+    """
+    Signal emitted as each source fetched during a sync is stored. The signal
+    is a tuple of (list, bool, int, int) containing the paths of the files of
+    deleted submissions, to purge, whether the source has any submissions, to
+    download, and the number of sources stored so far and being synced.
+    """
+    source_stored = pyqtSignal(object, bool, int, int)
+
+    """
+    Signal emitted when the work after a sync is done. The signal is a tuple
+    of (list, list, set) containing the uuids of the sources on the server,
+    the paths of the files of deleted records, to purge, and the uuids of the
+    sources which changed (or were deleted) during the sync, to redraw.
+    """
+    post_sync_done = pyqtSignal(object, object, object)
+
+    def __init__(self, home, is_qubes):
+        super().__init__()
+
+        # Reference to the SqlAlchemy session registry, which provides the
+        # session of whichever thread this runs in.
+        self.session = make_session_maker(home)
+        self.data_dir = os.path.join(home, 'data')
+        self.sync_flag = os.path.join(home, 'sync_flag')
+        self.gpg = GpgHelper(home, is_qubes)
+
+        # The uuids of the sources stored by store_source since the last run,
+        # and of those it failed to store.
+        self.stored_sources = set()
+        self.unstored_sources = set()
+
+    def store_source(self, remote_source, remote_submissions, fetched, total):
+        """
+        Store a source and its submissions as soon as they are fetched during
+        a sync, rather than waiting for the whole sync to complete.
+        """
+        try:
+            deleted_files = storage.update_local_source(
+                remote_source, remote_submissions, self.session, self.data_dir)
+        except Exception as e:
+            # The source is left stale by run, so it is fetched again by the
+            # next sync.
+            logger.error('Could not store source {}: {}'.format(remote_source.uuid, e))
+            self.session.rollback()
+            self.unstored_sources.add(remote_source.uuid)
+            deleted_files = []
+        else:
+            self.stored_sources.add(remote_source.uuid)
+
+        self.source_stored.emit(deleted_files, bool(remote_submissions), fetched, total)
+
+    def run(self, remote_sources, remote_submissions, remote_replies):
+        """
+        Reconcile local storage with the data from the server, record the time
+        of the sync and import new and changed source keys into the keyring.
+        """
+        remote_source_uuids = [source.uuid for source in remote_sources]
+        summaries = storage.get_source_summaries(self.session)
+        unstored_sources = self.unstored_sources
+        self.unstored_sources = set()
+
+        # The submissions have already been stored source by source (see
+        # store_source), so are not reconciled again here.
+        try:
+            deleted_files = storage.update_local_storage(
+                self.session, remote_sources, remote_submissions,
+                remote_replies, self.data_dir, refreshed_sources=[],
+                unstored_sources=unstored_sources)
+        except Exception as e:
+            logger.error('Could not update local storage: {}'.format(e))
+            self.session.rollback()
+            self.post_sync_done.emit(remote_source_uuids, [],
+                                     self.changed_sources(summaries))
+            return
+
+        # Set last sync flag.
+        with open(self.sync_flag, 'w') as f:
+            f.write(arrow.now().format())
+
+        # import new and changed keys into keyring
+        keys = {}
+        for source in remote_sources:
+            if source.key and source.key.get('type', None) == 'PGP':
+                pub_key = source.key.get('public', None)
+                if pub_key:
+                    keys[source.uuid] = pub_key
+        try:
+            self.gpg.import_keys(keys)
+        except CryptoError:
+            logger.warning('Failed to import source keys')
+
+        self.post_sync_done.emit(remote_source_uuids, deleted_files,
+                                 self.changed_sources(summaries))
+
+    def changed_sources(self, summaries):
+        """
+        Return the uuids of the sources stored since the last run, and of
+        those whose summary differs from the given one (see
+        storage.get_source_summaries).
+        """
+        new_summaries = storage.get_source_summaries(self.session)
+        changed = self.stored_sources | {
+            uuid for uuid in summaries.keys() | new_summaries.keys()
+            if summaries.get(uuid) != new_summaries.get(uuid)}
+        self.stored_sources = set()
+        return changed
@@ -0,0 +1,56 @@
+"""
+Contains the FilePurge class, which runs in the background and deletes the
+files of submissions and replies which no longer exist on the server.
+
+Copyright (C) 2018  The Freedom of the Press Foundation.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import logging
+
+from PyQt5.QtCore import QObject, pyqtSignal
+from securedrop_client.storage import delete_files
+
+
+logger = logging.getLogger(__name__)
+
+
+class FilePurge(QObject):
+    """
+    Runs in the background, deleting the files it is given in batches so that
+    a sync does not wait on the file system.
+    """
+
+    """
+    Signal emitted after each batch of files is deleted. The signal is a tuple
+    of (int, int) containing the number of files deleted so far and the
+    number of files to delete.
+    """
+    purge_progress = pyqtSignal(int, int)
+
+    def __init__(self, batch_size=100):
+        super().__init__()
+        self.batch_size = batch_size
+
+    def purge(self, paths):
+        """
+        Delete the files at the given paths, in batches of batch_size.
+        """
+        total = len(paths)
+        for start in range(0, total, self.batch_size):
+            batch = paths[start:start + self.batch_size]
+            delete_files(batch)
+            self.purge_progress.emit(start + len(batch), total)
+
+        logger.info('Purged {} files.'.format(total))
@@ -19,21 +19,58 @@ GNU Affero General Public License for more details.
 You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
+import datetime
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dateutil.parser import parse
-import glob
 import os
-from securedrop_client.db import Source, Submission, Reply, User
+from sqlalchemy import func, or_
+from securedrop_client.db import Source, Submission, Reply, User, submission_kind, DECRYPTED
 
 
 logger = logging.getLogger(__name__)
 
 
-def get_local_sources(session):
+# The maximum number of concurrent requests made to the API to fetch the
+# submissions of each source during a sync.
+MAX_CONCURRENT_FETCHES = 4
+
+# Messages and replies which have failed to download this many times are given
+# up on, see mark_file_download_failed.
+MAX_DOWNLOAD_ATTEMPTS = 10
+
+# Seconds to wait before downloading an item again after its first failure.
+# The wait doubles with each further failure, up to MAX_DOWNLOAD_BACKOFF.
+DOWNLOAD_BACKOFF = 5
+MAX_DOWNLOAD_BACKOFF = 60 * 60
+
+
+def get_local_sources(session, uuids=None):
+    """
+    Return all source objects from the local database, or only those with the
+    given UUIDs.
+    """
+    query = session.query(Source)
+    if uuids is not None:
+        query = query.filter(Source.uuid.in_(uuids))
+    return query
+
+
+def get_source_summaries(session):
     """
-    Return all source objects from the local database.
+    Return what is shown of each source in the local database, by UUID: its
+    attributes and the UUIDs of its replies. Comparing the summaries from
+    before and after a sync tells which sources it changed.
     """
-    return session.query(Source)
+    summaries = {}
+    for uuid, *attributes in session.query(Source.uuid, Source.journalist_designation,
+                                           Source.is_flagged, Source.is_starred,
+                                           Source.last_updated, Source.document_count):
+        summaries[uuid] = (tuple(attributes), set())
+    for source_uuid, reply_uuid in session.query(Source.uuid, Reply.uuid) \
+                                          .join(Reply.source):
+        summaries[source_uuid][1].add(reply_uuid)
+    return summaries
 
 
 def get_local_submissions(session):
@@ -50,19 +87,47 @@ def get_local_replies(session):
     return session.query(Reply)
 
 
-def get_remote_data(api):
+def get_remote_data(api, last_updated=None, max_workers=MAX_CONCURRENT_FETCHES,
+                    on_source_fetched=None):
     """
     Given an authenticated connection to the SecureDrop API, get sources,
     submissions and replies from the remote server and return a tuple
     containing lists of objects representing this data:
 
     (remote_sources, remote_submissions, remote_replies)
+
+    If last_updated is given, it should map the UUID of each local source to
+    its locally stored last_updated timestamp. Submissions are then only
+    fetched for sources which have changed since (see get_stale_sources).
+
+    The submissions of up to max_workers sources are fetched concurrently.
+    Their order is preserved, and the first error encountered is raised.
+
+    If on_source_fetched is given, the submissions are streamed to it instead
+    of being collected in the returned tuple: as soon as the submissions of a
+    source are fetched, it is called with the arguments:
+
+    (remote_source, remote_submissions, fetched_count, stale_count)
     """
     remote_submissions = []
+    # Streamed submissions are counted, as they are not collected.
+    streamed_count = 0
     try:
         remote_sources = api.get_sources()
-        for source in remote_sources:
-            remote_submissions.extend(api.get_submissions(source))
+        stale_sources = get_stale_sources(remote_sources, last_updated)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            if on_source_fetched:
+                futures = {executor.submit(api.get_submissions, source): source
+                           for source in stale_sources}
+                for count, future in enumerate(as_completed(futures), 1):
+                    submissions = future.result()
+                    streamed_count += len(submissions)
+                    on_source_fetched(futures[future], submissions, count,
+                                      len(stale_sources))
+            else:
+                for submissions in executor.map(api.get_submissions,
+                                                stale_sources):
+                    remote_submissions.extend(submissions)
         remote_replies = api.get_all_replies()
     except Exception as ex:
         # Log any errors but allow the caller to handle the exception.
@@ -71,29 +136,136 @@ def get_remote_data(api):
 
     logger.info('Fetched {} remote sources.'.format(len(remote_sources)))
     logger.info('Fetched {} remote submissions.'.format(
-        len(remote_submissions)))
+        len(remote_submissions) + streamed_count))
     logger.info('Fetched {} remote replies.'.format(len(remote_replies)))
 
     return (remote_sources, remote_submissions, remote_replies)
 
 
+def get_stale_sources(remote_sources, last_updated=None):
+    """
+    Return the remote sources whose submissions need to be fetched, given a
+    dict mapping the UUID of each local source to its locally stored
+    last_updated timestamp. These are the sources which are new, or whose
+    last_updated timestamp on the server differs from the local one.
+
+    If last_updated is None, all the remote sources are returned.
+    """
+    if last_updated is None:
+        return list(remote_sources)
+
+    stale_sources = []
+    for source in remote_sources:
+        # Timestamps are stored without timezone information, so compare them
+        # as naive datetimes.
+        local_timestamp = last_updated.get(source.uuid)
+        if local_timestamp is not None:
+            local_timestamp = local_timestamp.replace(tzinfo=None)
+        if parse(source.last_updated).replace(tzinfo=None) != local_timestamp:
+            stale_sources.append(source)
+    return stale_sources
+
+
+def reconcile(remote_items, local_items):
+    """
+    Given collections of remote items (from the API) and local items (from the
+    local database), classify the remote items in a single pass by indexing
+    the local items by their UUID. Return a tuple containing:
+
+    (to_update, to_create, to_delete)
+
+    * to_update is a list of (remote_item, local_item) pairs that exist in both.
+    * to_create is a list of remote items with no local counterpart.
+    * to_delete is a list of local items not returned by the remote server.
+    """
+    local_items_by_uuid = {item.uuid: item for item in local_items}
+    to_update = []
+    to_create = []
+    for remote_item in remote_items:
+        local_item = local_items_by_uuid.pop(remote_item.uuid, None)
+        if local_item is None:
+            to_create.append(remote_item)
+        else:
+            to_update.append((remote_item, local_item))
+
+    # Anything left over does not exist on the remote server.
+    to_delete = list(local_items_by_uuid.values())
+    return to_update, to_create, to_delete
+
+
 def update_local_storage(session, remote_sources, remote_submissions,
-                         remote_replies, data_dir):
+                         remote_replies, data_dir, refreshed_sources=None,
+                         unstored_sources=None):
     """
     Given a database session and collections of remote sources, submissions and
     replies from the SecureDrop API, ensures the local database is updated
     with this data.
+
+    If refreshed_sources is given, it is the collection of UUIDs of the
+    sources whose submissions were fetched (see get_stale_sources). Local
+    submissions belonging to any other source are left untouched.
+
+    If unstored_sources is given, it is the collection of UUIDs of the
+    sources whose submissions could not be stored. Their last_updated
+    timestamps are not advanced, and new ones are not created, so that the
+    next sync finds them stale and fetches their submissions again.
+
+    All three tables are reconciled within a single transaction, so the local
+    database is committed (and the SQLite file synced to disk) once per sync.
+
+    Return the paths of the files belonging to deleted records, which are left
+    on disk for the caller to delete once committed (see delete_files).
     """
     local_sources = get_local_sources(session)
-    local_submissions = get_local_submissions(session)
+    if refreshed_sources is None:
+        local_submissions = get_local_submissions(session)
+    elif refreshed_sources:
+        refreshed_ids = session.query(Source.id) \
+                               .filter(Source.uuid.in_(refreshed_sources))
+        local_submissions = get_local_submissions(session) \
+            .filter(Submission.source_id.in_(refreshed_ids.subquery()))
+    else:
+        # No submissions were fetched, so there are none to reconcile.
+        local_submissions = []
     local_replies = get_local_replies(session)
 
-    update_sources(remote_sources, local_sources, session, data_dir)
-    update_submissions(remote_submissions, local_submissions, session, data_dir)
-    update_replies(remote_replies, local_replies, session, data_dir)
+    deleted_files = update_sources(remote_sources, local_sources, session,
+                                   data_dir, unstored_sources=unstored_sources)
+    deleted_files += update_submissions(remote_submissions, local_submissions,
+                                        session, data_dir)
+    deleted_files += update_replies(remote_replies, local_replies, session,
+                                    data_dir)
+
+    session.commit()
+    return deleted_files
+
+
+def update_local_source(remote_source, remote_submissions, session, data_dir):
+    """
+    Given a single remote source and all of its remote submissions, ensure the
+    local database is updated with this data and commit it. This is used to
+    apply a sync source by source, as the data arrives.
 
+    The source is created locally if it is new. Deleting local sources which
+    no longer exist on the server is left to update_local_storage.
 
-def update_sources(remote_sources, local_sources, session, data_dir):
+    Return the paths of the files belonging to deleted submissions, which are
+    left on disk for the caller to delete once committed (see delete_files).
+    """
+    local_sources = session.query(Source).filter_by(uuid=remote_source.uuid)
+    update_sources([remote_source], local_sources, session, data_dir)
+
+    local_submissions = session.query(Submission).join(Source) \
+                               .filter(Source.uuid == remote_source.uuid)
+    deleted_files = update_submissions(remote_submissions, local_submissions,
+                                       session, data_dir)
+
+    session.commit()
+    return deleted_files
+
+
+def update_sources(remote_sources, local_sources, session, data_dir,
+                   unstored_sources=None):
     """
     Given collections of remote sources, the current local sources and a
     session to the local database, ensure the state of the local database
@@ -103,48 +275,56 @@ def update_sources(remote_sources, local_sources, session, data_dir):
     * New items are created in the local database.
     * Local items not returned in the remote sources are deleted from the
       local database.
+
+    The sources whose UUIDs are in unstored_sources keep their last_updated
+    timestamp if they exist, and are not created otherwise (see
+    update_local_storage).
+
+    Changes are not committed, that is left to the caller. Return the paths of
+    the files in data_dir belonging to the deleted sources.
     """
-    local_uuids = {source.uuid for source in local_sources}
-    for source in remote_sources:
-        if source.uuid in local_uuids:
-            # Update an existing record.
-            local_source = [s for s in local_sources
-                            if s.uuid == source.uuid][0]
-            local_source.journalist_designation = source.journalist_designation
-            local_source.is_flagged = source.is_flagged
-            local_source.public_key = source.key['public']
-            local_source.interaction_count = source.interaction_count
-            local_source.document_count = source.number_of_documents
-            local_source.is_starred = source.is_starred
+    to_update, to_create, to_delete = reconcile(remote_sources, local_sources)
+    unstored_sources = set(unstored_sources or [])
+
+    for source, local_source in to_update:
+        # Update an existing record.
+        local_source.journalist_designation = source.journalist_designation
+        local_source.is_flagged = source.is_flagged
+        local_source.public_key = source.key['public']
+        local_source.interaction_count = source.interaction_count
+        local_source.document_count = source.number_of_documents
+        local_source.is_starred = source.is_starred
+        if source.uuid not in unstored_sources:
             local_source.last_updated = parse(source.last_updated)
-
-            # Removing the UUID from local_uuids ensures this record won't be
-            # deleted at the end of this function.
-            local_uuids.remove(source.uuid)
-            logger.info('Updated source {}'.format(source.uuid))
-        else:
-            # A new source to be added to the database.
-            ns = Source(uuid=source.uuid,
-                        journalist_designation=source.journalist_designation,
-                        is_flagged=source.is_flagged,
-                        public_key=source.key['public'],
-                        interaction_count=source.interaction_count,
-                        is_starred=source.is_starred,
-                        last_updated=parse(source.last_updated),
-                        document_count=source.number_of_documents)
-            session.add(ns)
-            logger.info('Added new source {}'.format(source.uuid))
-
-    # The uuids remaining in local_uuids do not exist on the remote server, so
-    # delete the related records.
-    for deleted_source in [s for s in local_sources if s.uuid in local_uuids]:
-        for document in deleted_source.collection:
-            delete_single_submission_or_reply_on_disk(document, data_dir)
+        logger.info('Updated source {}'.format(source.uuid))
+
+    for source in to_create:
+        if source.uuid in unstored_sources:
+            logger.info('Not adding unstored source {}'.format(source.uuid))
+            continue
+        # A new source to be added to the database.
+        ns = Source(uuid=source.uuid,
+                    journalist_designation=source.journalist_designation,
+                    is_flagged=source.is_flagged,
+                    public_key=source.key['public'],
+                    interaction_count=source.interaction_count,
+                    is_starred=source.is_starred,
+                    last_updated=parse(source.last_updated),
+                    document_count=source.number_of_documents)
+        session.add(ns)
+        logger.info('Added new source {}'.format(source.uuid))
+
+    # These sources do not exist on the remote server, so delete the related
+    # records.
+    deleted_files = []
+    for deleted_source in to_delete:
+        for document in deleted_source.submissions + deleted_source.replies:
+            deleted_files.extend(get_artifact_paths(document, data_dir))
 
         session.delete(deleted_source)
         logger.info('Deleted source {}'.format(deleted_source.uuid))
 
-    session.commit()
+    return deleted_files
 
 
 def update_submissions(remote_submissions, local_submissions, session, data_dir):
@@ -153,42 +333,48 @@ def update_submissions(remote_submissions, local_submissions, session, data_dir)
     * New submissions have an entry created in the local database.
     * Local submissions not returned in the remote submissions are deleted
       from the local database.
+
+    New submissions are written with a single bulk insert. Changes are not
+    committed, that is left to the caller. Return the paths of the files in
+    data_dir belonging to the deleted submissions.
     """
-    local_uuids = {submission.uuid for submission in local_submissions}
-    for submission in remote_submissions:
-        if submission.uuid in local_uuids:
-            # Update an existing record.
-            local_submission = [s for s in local_submissions
-                                if s.uuid == submission.uuid][0]
-            local_submission.filename = submission.filename
-            local_submission.size = submission.size
-            local_submission.is_read = submission.is_read
-            local_submission.download_url = submission.download_url
-
-            # Removing the UUID from local_uuids ensures this record won't be
-            # deleted at the end of this function.
-            local_uuids.remove(submission.uuid)
-            logger.info('Updated submission {}'.format(submission.uuid))
-        else:
-            # A new submission to be added to the database.
-            _, source_uuid = submission.source_url.rsplit('/', 1)
-            source = session.query(Source).filter_by(uuid=source_uuid)[0]
-            ns = Submission(source=source, uuid=submission.uuid,
-                            size=submission.size,
-                            filename=submission.filename,
-                            download_url=submission.download_url)
-            session.add(ns)
-            logger.info('Added new submission {}'.format(submission.uuid))
-
-    # The uuids remaining in local_uuids do not exist on the remote server, so
-    # delete the related records.
-    for deleted_submission in [s for s in local_submissions
-                               if s.uuid in local_uuids]:
-        delete_single_submission_or_reply_on_disk(deleted_submission, data_dir)
+    to_update, to_create, to_delete = reconcile(remote_submissions,
+                                                local_submissions)
+
+    for submission, local_submission in to_update:
+        # Update an existing record.
+        local_submission.filename = submission.filename
+        local_submission.kind = submission_kind(submission.filename)
+        local_submission.size = submission.size
+        local_submission.is_read = submission.is_read
+        local_submission.download_url = submission.download_url
+        logger.info('Updated submission {}'.format(submission.uuid))
+
+    if to_create:
+        sources = {source.uuid: source for source in get_local_sources(session)}
+
+    new_submissions = []
+    for submission in to_create:
+        # A new submission to be added to the database.
+        _, source_uuid = submission.source_url.rsplit('/', 1)
+        source = sources[source_uuid]
+        ns = Submission(source=source, uuid=submission.uuid,
+                        size=submission.size,
+                        filename=submission.filename,
+                        download_url=submission.download_url)
+        new_submissions.append(ns)
+        logger.info('Added new submission {}'.format(submission.uuid))
+    session.bulk_save_objects(new_submissions)
+
+    # These submissions do not exist on the remote server, so delete the
+    # related records.
+    deleted_files = []
+    for deleted_submission in to_delete:
+        deleted_files.extend(get_artifact_paths(deleted_submission, data_dir))
         session.delete(deleted_submission)
         logger.info('Deleted submission {}'.format(deleted_submission.uuid))
 
-    session.commit()
+    return deleted_files
 
 
 def update_replies(remote_replies, local_replies, session, data_dir):
@@ -200,47 +386,76 @@ def update_replies(remote_replies, local_replies, session, data_dir):
 
     If a reply references a new journalist username, add them to the database
     as a new user.
+
+    New replies are written with a single bulk insert. Changes are not
+    committed, that is left to the caller. Return the paths of the files in
+    data_dir belonging to the deleted replies.
     """
-    local_uuids = {reply.uuid for reply in local_replies}
+    to_update, to_create, to_delete = reconcile(remote_replies, local_replies)
+
+    # Resolve the journalist of every remote reply against the users loaded
+    # with a single query, then flush once so that new users are given an id.
+    users = {user.uuid: user for user in session.query(User)}
+    journalists = {}
     for reply in remote_replies:
-        if reply.uuid in local_uuids:
-            # Update an existing record.
-            local_reply = [r for r in local_replies if r.uuid == reply.uuid][0]
-            user = find_or_create_user(reply.journalist_uuid,
-                                       reply.journalist_username, session)
-            local_reply.journalist_id = user.id
-            local_reply.filename = reply.filename
-            local_reply.size = reply.size
-
-            local_uuids.remove(reply.uuid)
-            logger.info('Updated reply {}'.format(reply.uuid))
-        else:
-            # A new reply to be added to the database.
-            source_uuid = reply.source_uuid
-            source = session.query(Source).filter_by(uuid=source_uuid)[0]
-            user = find_or_create_user(reply.journalist_uuid,
-                                       reply.journalist_username, session)
-            nr = Reply(reply.uuid, user, source, reply.filename, reply.size)
-            session.add(nr)
-            logger.info('Added new reply {}'.format(reply.uuid))
-
-    # The uuids remaining in local_uuids do not exist on the remote server, so
-    # delete the related records.
-    for deleted_reply in [r for r in local_replies if r.uuid in local_uuids]:
-        delete_single_submission_or_reply_on_disk(deleted_reply, data_dir)
+        journalists[reply.journalist_uuid] = find_or_create_user(
+            reply.journalist_uuid, reply.journalist_username, session, users)
+    session.flush()
+
+    for reply, local_reply in to_update:
+        # Update an existing record.
+        user = journalists[reply.journalist_uuid]
+        local_reply.journalist_id = user.id
+        local_reply.filename = reply.filename
+        local_reply.size = reply.size
+        logger.info('Updated reply {}'.format(reply.uuid))
+
+    if to_create:
+        sources = {source.uuid: source for source in get_local_sources(session)}
+
+    new_replies = []
+    for reply in to_create:
+        # A new reply to be added to the database, once its source is (see
+        # update_sources).
+        source = sources.get(reply.source_uuid)
+        if source is None:
+            logger.info('Not adding reply {} of unstored source'.format(reply.uuid))
+            continue
+        user = journalists[reply.journalist_uuid]
+        nr = Reply(reply.uuid, user, source, reply.filename, reply.size)
+        new_replies.append(nr)
+        logger.info('Added new reply {}'.format(reply.uuid))
+    session.bulk_save_objects(new_replies)
+
+    # These replies do not exist on the remote server, so delete the related
+    # records.
+    deleted_files = []
+    for deleted_reply in to_delete:
+        deleted_files.extend(get_artifact_paths(deleted_reply, data_dir))
         session.delete(deleted_reply)
         logger.info('Deleted reply {}'.format(deleted_reply.uuid))
 
-    session.commit()
+    return deleted_files
 
 
-def find_or_create_user(uuid, username, session):
+def find_or_create_user(uuid, username, session, users=None):
     """
     Returns a user object representing the referenced journalist UUID.
     If the user does not already exist in the data, a new instance is created.
     If the user exists but the username has changed, the username is updated.
+
+    New users are flushed (so they have an id to reference) but not committed,
+    that is left to the caller.
+
+    If given, users is a dict mapping UUIDs to the users already loaded from
+    the local database. It is used instead of querying the database, and new
+    users are added to it rather than flushed.
     """
-    user = session.query(User).filter_by(uuid=uuid).one_or_none()
+    if users is None:
+        user = session.query(User).filter_by(uuid=uuid).one_or_none()
+    else:
+        user = users.get(uuid)
+
     if user and user.username == username:
         # User exists in the local database and the username is unchanged.
         return user
@@ -248,32 +463,119 @@ def find_or_create_user(uuid, username, session):
         # User exists in the local database but the username is changed.
         user.username = username
         session.add(user)
-        session.commit()
         return user
     else:
         # User does not exist in the local database.
         new_user = User(username)
         new_user.uuid = uuid
         session.add(new_user)
-        session.commit()
+        if users is None:
+            session.flush()
+        else:
+            users[uuid] = new_user
         return new_user
 
 
-def find_new_submissions(session):
+def _can_download_now(model, now):
+    """
+    Return the filter for items of the model (Submission or Reply) which have
+    not been given up on and are not waiting to be downloaded again.
+    """
+    return (model.download_attempts < MAX_DOWNLOAD_ATTEMPTS) & \
+        or_(model.download_next_attempt.is_(None), model.download_next_attempt <= now)
+
+
+def find_new_submissions(session, now=None):
+    """
+    Return the messages to download now, skipping those which failed recently
+    or too often.
+    """
+    now = now or datetime.datetime.utcnow()
     submissions = session.query(Submission) \
-                         .filter_by(is_downloaded=False) \
-                         .filter(Submission.filename.like('%-msg.gpg')) \
+                         .filter_by(is_downloaded=False, kind='message') \
+                         .filter(_can_download_now(Submission, now)) \
                          .all()
     return submissions
 
 
-def find_new_replies(session):
+def find_new_replies(session, now=None):
+    """
+    Return the replies to download now, skipping those which failed recently
+    or too often.
+    """
+    now = now or datetime.datetime.utcnow()
     replies = session.query(Reply) \
                      .filter_by(is_downloaded=False) \
+                     .filter(_can_download_now(Reply, now)) \
                      .all()
     return replies
 
 
+def next_download_attempt(session, now=None):
+    """
+    Return when the next message or reply which failed to download may be
+    downloaded again, or None if none are waiting to be.
+    """
+    now = now or datetime.datetime.utcnow()
+    times = []
+    for model, criteria in [(Submission, {'kind': 'message'}), (Reply, {})]:
+        next_attempt = session.query(func.min(model.download_next_attempt)) \
+                              .filter(model.is_downloaded == False,  # noqa: E712
+                                      model.download_attempts < MAX_DOWNLOAD_ATTEMPTS,
+                                      model.download_next_attempt > now) \
+                              .filter_by(**criteria) \
+                              .scalar()
+        if next_attempt:
+            times.append(next_attempt)
+    return min(times, default=None)
+
+
+def download_backoff(attempts):
+    """
+    Return the seconds to wait before downloading an item again after it has
+    failed the given number of times.
+    """
+    return min(DOWNLOAD_BACKOFF * 2 ** (attempts - 1), MAX_DOWNLOAD_BACKOFF)
+
+
+def _mark_download_failed(model, uuid, error, session, now=None):
+    """
+    Record a failed attempt to download an item of the model (Submission or
+    Reply), and when it may be downloaded again.
+    """
+    now = now or datetime.datetime.utcnow()
+    db_object = session.query(model).filter_by(uuid=uuid).one_or_none()
+    if db_object is None:  # Deleted while it was being downloaded.
+        return
+
+    db_object.download_attempts = (db_object.download_attempts or 0) + 1
+    db_object.download_error = str(error)
+    if db_object.download_attempts >= MAX_DOWNLOAD_ATTEMPTS:
+        db_object.download_next_attempt = None
+        logger.warning('Giving up on downloading {} after {} attempts.'.format(
+            db_object.filename, db_object.download_attempts))
+    else:
+        db_object.download_next_attempt = now + datetime.timedelta(
+            seconds=download_backoff(db_object.download_attempts))
+    session.commit()
+
+
+def mark_file_download_failed(uuid, error, session):
+    """
+    Record a failed attempt to download the submission. After
+    MAX_DOWNLOAD_ATTEMPTS it is no longer found by find_new_submissions.
+    """
+    _mark_download_failed(Submission, uuid, error, session)
+
+
+def mark_reply_download_failed(uuid, error, session):
+    """
+    Record a failed attempt to download the reply. After MAX_DOWNLOAD_ATTEMPTS
+    it is no longer found by find_new_replies.
+    """
+    _mark_download_failed(Reply, uuid, error, session)
+
+
 def mark_file_as_downloaded(uuid, session):
     """Mark file as downloaded in the database. The file itself will be
     stored in the data directory.
@@ -282,6 +584,7 @@ def mark_file_as_downloaded(uuid, session):
                                   .filter_by(uuid=uuid) \
                                   .one_or_none()
     submission_db_object.is_downloaded = True
+    submission_db_object.download_state = DECRYPTED
     session.add(submission_db_object)
     session.commit()
 
@@ -294,26 +597,74 @@ def mark_reply_as_downloaded(uuid, session):
                              .filter_by(uuid=uuid) \
                              .one_or_none()
     reply_db_object.is_downloaded = True
+    reply_db_object.download_state = DECRYPTED
     session.add(reply_db_object)
     session.commit()
 
 
-def delete_single_submission_or_reply_on_disk(obj_db, data_dir):
+def get_download_state(model, uuid, session):
     """
-    Delete on disk a single submission or reply.
+    Return where the item of the model (Submission or Reply) is in being
+    downloaded and decrypted, see db.DOWNLOADED.
     """
-    filename_without_extensions = obj_db.filename.split('.')[0]
-    files_to_delete = os.path.join(
-        data_dir,
-        '{}*'.format(filename_without_extensions))
-    logging.info('Deleting all {} files'.format(filename_without_extensions))
+    return session.query(model.download_state).filter_by(uuid=uuid).scalar()
 
-    try:
-        for file_to_delete in glob.glob(files_to_delete):
+
+def set_download_state(model, uuid, state, session):
+    """
+    Record where the item of the model (Submission or Reply) is in being
+    downloaded and decrypted, see db.DOWNLOADED.
+    """
+    session.query(model).filter_by(uuid=uuid).update({'download_state': state},
+                                                     synchronize_session=False)
+    session.commit()
+
+
+def get_artifact_filenames(filename):
+    """
+    Given the server filename of a submission or reply, return the names of
+    all the files it may have produced in the data directory: the partial
+    download, the encrypted file as downloaded, the decrypted file and, for
+    documents, the gzipped and gunzipped decrypted files. For example,
+    1-foo-doc.gz.gpg produces:
+
+    ['1-foo-doc.gz.gpg.part', '1-foo-doc.gz.gpg', '1-foo-doc.gz', '1-foo-doc']
+    """
+    artifacts = [filename + '.part', filename]
+    name, extension = os.path.splitext(filename)
+    while extension:
+        artifacts.append(name)
+        name, extension = os.path.splitext(name)
+    return artifacts
+
+
+def get_artifact_paths(obj_db, data_dir):
+    """
+    Return the paths of all the files a submission or reply may have produced
+    in the data directory (see get_artifact_filenames).
+    """
+    return [os.path.join(data_dir, filename)
+            for filename in get_artifact_filenames(obj_db.filename)]
+
+
+def delete_files(paths):
+    """
+    Delete the files at the given paths, skipping any which do not exist.
+    """
+    for file_to_delete in paths:
+        try:
             os.remove(file_to_delete)
-    except FileNotFoundError:
-        logging.info(
-            'File {} already deleted, skipping'.format(file_to_delete))
+        except FileNotFoundError:
+            logging.debug(
+                'File {} already deleted, skipping'.format(file_to_delete))
+
+
+def delete_single_submission_or_reply_on_disk(obj_db, data_dir):
+    """
+    Delete on disk a single submission or reply.
+    """
+    logging.info('Deleting all {} files'.format(obj_db.filename))
+    delete_files(get_artifact_paths(obj_db, data_dir))
 
 
 def get_data(sdc_home: str, filename: str) -> str:
@@ -112,6 +112,17 @@ def test_show_sources(mocker):
     w.main_view.source_list.update.assert_called_once_with([1, 2, 3])
 
 
+def test_show_changed_sources(mocker):
+    """
+    Ensure the changed sources are passed to the source list widget to be
+    updated.
+    """
+    w = Window('mock')
+    w.main_view = mocker.MagicMock()
+    w.show_changed_sources([1], {1, 2})
+    w.main_view.source_list.update_changed.assert_called_once_with([1], {1, 2})
+
+
 def test_update_error_status(mocker):
     """
     Ensure that the error to be shown in the error status sidebar will
@@ -1,6 +1,7 @@
 """
 Make sure the UI widgets are configured correctly and work as expected.
 """
+from datetime import datetime
 from PyQt5.QtWidgets import QWidget, QApplication, QWidgetItem, QSpacerItem, QVBoxLayout, \
     QMessageBox
 from tests import factory
@@ -36,6 +37,8 @@ def test_ToolBar_setup(mocker):
 
     assert tb.window == mock_window
     assert tb.controller == mock_controller
+    mock_controller.file_purge.purge_progress.connect.assert_called_once_with(
+        tb._on_purge_progress)
 
 
 def test_ToolBar_set_logged_in_as(mocker):
@@ -117,6 +120,25 @@ def test_ToolBar_sync_event():
     assert tb.refresh.isEnabled()
 
 
+def test_ToolBar_sync_progress(mocker):
+    """Shows the progress of a sync in the status bar
+    """
+    tb = ToolBar(None)
+    tb.window = mocker.MagicMock()
+    tb._on_sync_progress(1, 3)
+    tb.window.set_status.assert_called_once_with('Refreshed 1 of 3 sources.')
+
+
+def test_ToolBar_purge_progress(mocker):
+    """Shows the progress of deleting the files of deleted records in the
+    status bar
+    """
+    tb = ToolBar(None)
+    tb.window = mocker.MagicMock()
+    tb._on_purge_progress(100, 250)
+    tb.window.set_status.assert_called_once_with('Deleted 100 of 250 files.')
+
+
 def test_MainView_init():
     """
     Ensure the MainView instance is correctly set up.
@@ -199,6 +221,92 @@ def test_SourceList_maintains_selection(mocker):
     assert sl.itemWidget(sl.currentItem()).source.id == sources[0].id
 
 
+def test_SourceList_update_changed(mocker):
+    """
+    Only the widgets of the changed sources are replaced, in the order of the
+    list, and those of deleted sources removed.
+    """
+    sl = SourceList(None)
+    controller = mocker.MagicMock()
+    sl.setup(controller)
+    sources = [factory.Source(last_updated=datetime(2019, 1, 4)),
+               factory.Source(last_updated=datetime(2019, 1, 3)),
+               factory.Source(last_updated=datetime(2019, 1, 2))]
+    sl.update(sources)
+    unchanged_widget = sl.itemWidget(sl.item(0))
+
+    updated = factory.Source(uuid=sources[2].uuid, last_updated=datetime(2019, 1, 5))
+    added = factory.Source(last_updated=datetime(2019, 1, 1))
+    sl.update_changed([updated, added], {sources[1].uuid, updated.uuid, added.uuid})
+
+    assert [sl.itemWidget(sl.item(row)).source for row in range(sl.count())] == \
+        [updated, sources[0], added]
+    assert sl.itemWidget(sl.item(1)) is unchanged_widget
+    controller.set_download_priorities.assert_called_with(
+        None, [updated.uuid, sources[0].uuid, added.uuid])
+
+
+def test_SourceList_update_changed_maintains_selection(mocker):
+    """
+    If the selected source changed, it is selected again once redrawn, without
+    the conversation being shown for another source meanwhile.
+    """
+    sl = SourceList(None)
+    sl.setup(mocker.MagicMock())
+    sources = [factory.Source(last_updated=datetime(2019, 1, 2)),
+               factory.Source(last_updated=datetime(2019, 1, 1))]
+    sl.update(sources)
+    sl.setCurrentItem(sl.item(1))
+    selection_changed = mocker.MagicMock()
+    sl.itemSelectionChanged.connect(selection_changed)
+
+    updated = factory.Source(uuid=sources[1].uuid, last_updated=datetime(2019, 1, 3))
+    sl.update_changed([updated], {updated.uuid})
+
+    assert sl.itemWidget(sl.currentItem()).source == updated
+    assert sl.currentRow() == 0
+    assert selection_changed.call_count == 1
+
+
+def test_SourceList_update_download_priorities(mocker):
+    """
+    The controller is told which source is selected and which are visible, so
+    that their messages are downloaded first.
+    """
+    sl = SourceList(None)
+    sl.resize(300, 1000)
+    sources = [factory.Source(), factory.Source()]
+    controller = mocker.MagicMock()
+    sl.setup(controller)
+    sl.update(sources)
+
+    controller.set_download_priorities.assert_called_with(
+        None, [sources[0].uuid, sources[1].uuid])
+
+    # Selecting a source updates the priorities.
+    sl.setCurrentItem(sl.item(1))
+    controller.set_download_priorities.assert_called_with(
+        sources[1].uuid, [sources[0].uuid, sources[1].uuid])
+
+
+def test_SourceList_update_download_priorities_hidden(mocker):
+    """
+    Sources scrolled out of view are not visible.
+    """
+    sl = SourceList(None)
+    sl.resize(300, 1000)
+    sources = [factory.Source(), factory.Source()]
+    controller = mocker.MagicMock()
+    sl.setup(controller)
+    sl.update(sources)
+    sl.visualItemRect = mocker.MagicMock()
+    sl.visualItemRect().intersects.side_effect = [True, False]
+
+    sl.update_download_priorities()
+
+    controller.set_download_priorities.assert_called_with(None, [sources[0].uuid])
+
+
 def test_SourceWidget_init(mocker):
     """
     The source widget is initialised with the passed-in source.
@@ -117,7 +117,7 @@ def test_start_app(homedir, mocker):
     mock_client = mocker.patch('securedrop_client.app.Client')
     mocker.patch('securedrop_client.app.prevent_second_instance')
     mocker.patch('securedrop_client.app.sys')
-    mocker.patch('securedrop_client.app.sessionmaker', return_value=mock_session_class)
+    mocker.patch('securedrop_client.app.make_session_maker', return_value=mock_session_class)
 
     start_app(mock_args, mock_qt_args)
     mock_app.assert_called_once_with(mock_qt_args)
@@ -186,7 +186,8 @@ def test_create_app_dir_permissions(tmpdir, mocker):
         mocker.patch('securedrop_client.app.Client')
         mocker.patch('securedrop_client.app.sys')
         mocker.patch('securedrop_client.app.prevent_second_instance')
-        mocker.patch('securedrop_client.app.sessionmaker', return_value=mock_session_class)
+        mocker.patch('securedrop_client.app.make_session_maker',
+                     return_value=mock_session_class)
 
         def func():
             start_app(mock_args, mock_qt_args)
@@ -242,7 +243,7 @@ def test_signal_interception(mocker, homedir):
     mocker.patch('securedrop_client.db.make_engine')
     mocker.patch('securedrop_client.app.init')
     mocker.patch('securedrop_client.logic.Client.setup')
-    mocker.patch('securedrop_client.logic.GpgHelper')
+    mocker.patch('securedrop_client.post_sync.GpgHelper')
     mocker.patch('securedrop_client.app.configure_logging')
     mock_signal_handlers = mocker.patch('securedrop_client.app.configure_signal_handlers')
     mock_args = mocker.Mock()
@@ -1,10 +1,13 @@
+import gzip
+import io
 import os
 import subprocess
 import pytest
 
 from subprocess import CalledProcessError
 
-from securedrop_client.crypto import GpgHelper, CryptoError
+from securedrop_client.crypto import GpgHelper, CryptoError, key_hash
+from tests import factory
 
 with open(os.path.join(os.path.dirname(__file__), 'files', 'test-key.gpg.pub.asc')) as f:
     PUB_KEY = f.read()
@@ -13,6 +16,30 @@ with open(os.path.join(os.path.dirname(__file__), 'files', 'securedrop.gpg.asc')
     JOURNO_KEY = f.read()
 
 
+class FakeProcess:
+    """
+    A gpg process which writes the given plaintext and errors to its pipes.
+    """
+
+    def __init__(self, stdout=b'', stderr=b'', returncode=0):
+        self.stdout = io.BytesIO(stdout)
+        self.stderr = stderr
+        self.returncode = returncode
+
+    def wait(self):
+        return self.returncode
+
+
+def fake_popen(mocker, **kwargs):
+    def popen(cmd, stdout, stderr):
+        process = FakeProcess(**kwargs)
+        stderr.write(process.stderr)
+        stderr.flush()
+        return process
+
+    return mocker.patch('securedrop_client.crypto.subprocess.Popen', side_effect=popen)
+
+
 def test_message_logic(homedir, config, mocker):
     """
     Ensure that messages are handled.
@@ -23,13 +50,17 @@ def test_message_logic(homedir, config, mocker):
     test_msg = 'tests/files/test-msg.gpg'
     expected_output_filename = 'test-msg'
 
-    mock_gpg = mocker.patch('subprocess.call', return_value=0)
-    mocker.patch('os.unlink')
+    mock_gpg = fake_popen(mocker, stdout=b'hello')
+    mock_unlink = mocker.patch('os.unlink')
 
     dest = gpg.decrypt_submission_or_reply(test_msg, expected_output_filename, is_doc=False)
 
     assert mock_gpg.call_count == 1
     assert dest == os.path.join(homedir, 'data', expected_output_filename)
+    with open(dest, 'rb') as f:
+        assert f.read() == b'hello'
+    # Once decrypted, the encrypted file is deleted.
+    mock_unlink.assert_any_call(test_msg)
 
 
 def test_gunzip_logic(homedir, config, mocker):
@@ -42,12 +73,32 @@ def test_gunzip_logic(homedir, config, mocker):
     test_gzip = 'tests/files/test-doc.gz.gpg'
     expected_output_filename = 'test-doc'
 
-    mock_gpg = mocker.patch('subprocess.call', return_value=0)
+    mock_gpg = fake_popen(mocker, stdout=gzip.compress(b'hello') + gzip.compress(b' world'))
     mocker.patch('os.unlink')
     dest = gpg.decrypt_submission_or_reply(test_gzip, expected_output_filename, is_doc=True)
 
     assert mock_gpg.call_count == 1
     assert dest == os.path.join(homedir, 'data', expected_output_filename)
+    with open(dest, 'rb') as f:
+        assert f.read() == b'hello world'
+
+
+def test_gunzip_corrupt(homedir, config, mocker):
+    """
+    If the decrypted document cannot be gunzipped, the partial plaintext is
+    removed and the encrypted file is kept.
+    """
+    gpg = GpgHelper(homedir, is_qubes=False)
+    test_gzip = os.path.join(homedir, 'data', 'test-doc.gz.gpg')
+    with open(test_gzip, 'wb') as f:
+        f.write(b'ciphertext')
+    fake_popen(mocker, stdout=gzip.compress(b'hello')[:-10])
+
+    with pytest.raises(CryptoError, match='Could not write the plaintext'):
+        gpg.decrypt_submission_or_reply(test_gzip, 'test-doc', is_doc=True)
+
+    assert not os.path.exists(os.path.join(homedir, 'data', 'test-doc'))
+    assert os.path.exists(test_gzip)
 
 
 def test_subprocess_raises_exception(homedir, config, mocker):
@@ -60,13 +111,15 @@ def test_subprocess_raises_exception(homedir, config, mocker):
     test_gzip = 'tests/files/test-doc.gz.gpg'
     output_filename = 'test-doc'
 
-    mock_gpg = mocker.patch('subprocess.call', return_value=1)
-    mocker.patch('os.unlink')
+    mock_gpg = fake_popen(mocker, stderr=b'decryption failed', returncode=2)
+    mock_unlink = mocker.patch('os.unlink')
 
-    with pytest.raises(CryptoError):
+    with pytest.raises(CryptoError, match='GPG Error: decryption failed'):
         gpg.decrypt_submission_or_reply(test_gzip, output_filename, is_doc=True)
 
     assert mock_gpg.call_count == 1
+    # The encrypted file is kept, so that it can be decrypted again.
+    assert mocker.call(test_gzip) not in mock_unlink.call_args_list
 
 
 def test_import_key(homedir, config, source):
@@ -110,6 +163,130 @@ def test_import_key_multiple_fingerprints(homedir, source, config, mocker):
     assert mock_import.called
 
 
+def test_import_keys(homedir, config, session, mocker):
+    '''
+    Only new and changed keys, or keys missing from the keyring, are imported,
+    together, and the fingerprint and hash of each are stored.
+    Using the `config` fixture to ensure the config is written to disk.
+    '''
+    helper = GpgHelper(homedir, is_qubes=False)
+    sources = [factory.Source() for _ in range(4)]
+    unchanged, changed, missing, new = sources
+    for source in (unchanged, changed, missing):
+        source.fingerprint = 'FPR-' + source.uuid
+        source.public_key_hash = key_hash('key-' + source.uuid)
+    session.add_all(sources)
+    session.commit()
+    mocker.patch.object(helper, '_keyring_fingerprints',
+                        return_value={unchanged.fingerprint, changed.fingerprint})
+    mock_import = mocker.patch.object(helper, '_import_keys',
+                                      return_value=['FPR-1', 'FPR-2', 'FPR-3'])
+    keys = {source.uuid: 'key-' + source.uuid for source in sources}
+    keys[changed.uuid] = 'new-key'
+
+    helper.import_keys(keys)
+
+    mock_import.assert_called_once_with('\n'.join(
+        [keys[changed.uuid], keys[missing.uuid], keys[new.uuid]]))
+    session.expire_all()
+    assert [s.fingerprint for s in sources] == \
+        ['FPR-' + unchanged.uuid, 'FPR-1', 'FPR-2', 'FPR-3']
+    assert changed.public_key_hash == key_hash('new-key')
+    assert new.public_key_hash == key_hash(keys[new.uuid])
+
+
+def test_import_keys_unchanged(homedir, config, session, mocker):
+    '''
+    If no key has changed, gpg is not asked to import anything.
+    Using the `config` fixture to ensure the config is written to disk.
+    '''
+    helper = GpgHelper(homedir, is_qubes=False)
+    source = factory.Source()
+    source.fingerprint = 'FPR'
+    source.public_key_hash = key_hash('key')
+    session.add(source)
+    session.commit()
+    mocker.patch.object(helper, '_keyring_fingerprints', return_value={'FPR'})
+    mock_import = mocker.patch.object(helper, '_import_keys')
+
+    helper.import_keys({source.uuid: 'key'})
+
+    mock_import.assert_not_called()
+
+
+def test_import_keys_one_by_one(homedir, config, session, mocker):
+    '''
+    If gpg does not give a fingerprint for every key, the keys are imported one
+    by one so that each fingerprint is stored against the right source.
+    Using the `config` fixture to ensure the config is written to disk.
+    '''
+    helper = GpgHelper(homedir, is_qubes=False)
+    good, bad = factory.Source(), factory.Source()
+    session.add_all([good, bad])
+    session.commit()
+    mocker.patch.object(helper, '_keyring_fingerprints', return_value=set())
+    mocker.patch.object(helper, '_import_keys', return_value=['FPR'])
+    mocker.patch.object(helper, '_import', side_effect=[{'FPR'}, CryptoError()])
+
+    helper.import_keys({good.uuid: 'good-key', bad.uuid: 'bad-key'})
+
+    session.expire_all()
+    assert good.fingerprint == 'FPR'
+    assert good.public_key_hash == key_hash('good-key')
+    assert bad.fingerprint is None
+
+
+def test_import_keys_batch_failed(homedir, config, session, mocker):
+    '''
+    If gpg fails to import the keys together, they are imported one by one.
+    Using the `config` fixture to ensure the config is written to disk.
+    '''
+    helper = GpgHelper(homedir, is_qubes=False)
+    source = factory.Source()
+    session.add(source)
+    session.commit()
+    mocker.patch.object(helper, '_keyring_fingerprints', return_value=set())
+    mocker.patch.object(helper, '_import_keys', side_effect=CryptoError())
+    mocker.patch.object(helper, '_import', return_value={'FPR'})
+
+    helper.import_keys({source.uuid: 'key'})
+
+    session.expire_all()
+    assert source.fingerprint == 'FPR'
+    assert source.public_key_hash == key_hash('key')
+
+
+def test_import_keys_no_keys(homedir, config, mocker):
+    '''
+    Without keys, gpg is not run at all.
+    Using the `config` fixture to ensure the config is written to disk.
+    '''
+    helper = GpgHelper(homedir, is_qubes=False)
+    mock_keyring = mocker.patch.object(helper, '_keyring_fingerprints')
+    mock_import = mocker.patch.object(helper, '_import_keys')
+
+    helper.import_keys({})
+
+    mock_keyring.assert_not_called()
+    mock_import.assert_not_called()
+
+
+def test_keyring_fingerprints(homedir, config, mocker):
+    '''
+    Using the `config` fixture to ensure the config is written to disk.
+    '''
+    helper = GpgHelper(homedir, is_qubes=False)
+    output = 'pub:-:4096:1:CC40EF1228271441:::\nfpr:::::::::PUB-FPR:\n' \
+             'sub:-:4096:1:C3E7C4C0A2201B2A:::\nfpr:::::::::SUB-FPR:\n'
+    mocker.patch('securedrop_client.crypto.subprocess.run',
+                 return_value=subprocess.CompletedProcess([], 0, output.encode(), b''))
+    assert helper._keyring_fingerprints() == {'PUB-FPR'}
+
+    mocker.patch('securedrop_client.crypto.subprocess.run',
+                 return_value=subprocess.CompletedProcess([], 2, b'', b'error'))
+    assert helper._keyring_fingerprints() == set()
+
+
 def test_encrypt(homedir, source, config, mocker):
     '''
     Check that calling `encrypt` encrypts the message.
@@ -167,3 +344,96 @@ def test_encrypt_fail(homedir, source, config, mocker):
 
     # check mock called to prevent "dead code"
     assert mock_gpg.called
+
+
+def test_decrypt_files(homedir, config, mocker):
+    """
+    The files are decrypted by one gpg process, whose status lines tell which
+    of them were decrypted.
+    Using the `config` fixture to ensure the config is written to disk.
+    """
+    gpg = GpgHelper(homedir, is_qubes=False)
+    data_dir = os.path.join(homedir, 'data')
+    ok, bad = os.path.join(data_dir, '1-ok-msg.gpg'), os.path.join(data_dir, '2-bad-msg.gpg')
+    for path in (ok, bad, os.path.join(data_dir, '2-bad-msg')):
+        with open(path, 'w') as f:
+            f.write('x')
+    status = '\n'.join([
+        '[GNUPG:] FILE_START 3 {}'.format(ok),
+        '[GNUPG:] DECRYPTION_OKAY',
+        '[GNUPG:] FILE_DONE',
+        '[GNUPG:] FILE_START 3 {}'.format(bad),
+        '[GNUPG:] DECRYPTION_OKAY',
+        '[GNUPG:] DECRYPTION_FAILED',
+        '[GNUPG:] FILE_DONE',
+    ])
+    mock_gpg = fake_popen(mocker, stdout=status.encode(), returncode=2,
+                          stderr='gpg: {}: decryption failed: Bad MDC\n'.format(bad).encode())
+
+    errors = gpg.decrypt_files([ok, bad])
+
+    assert list(errors) == [bad]
+    assert 'Bad MDC' in str(errors[bad])
+    assert mock_gpg.call_count == 1
+    assert mock_gpg.call_args[0][0][-3:] == ['--decrypt-files', ok, bad]
+    # Once decrypted, the encrypted file is deleted; otherwise it is kept,
+    # and any partial plaintext removed.
+    assert sorted(os.listdir(data_dir)) == ['2-bad-msg.gpg']
+
+
+def test_decrypt_files_streamed(homedir, config, mocker):
+    """
+    Each file is reported as soon as gpg is done with it, before gpg moves on
+    to the next. Files gpg never got to are reported as failed.
+    Using the `config` fixture to ensure the config is written to disk.
+    """
+    gpg = GpgHelper(homedir, is_qubes=False)
+    data_dir = os.path.join(homedir, 'data')
+    first, second = os.path.join(data_dir, '1-msg.gpg'), os.path.join(data_dir, '2-msg.gpg')
+    for path in (first, second):
+        with open(path, 'w') as f:
+            f.write('x')
+    on_decrypted = mocker.MagicMock()
+
+    def status_lines():
+        yield '[GNUPG:] FILE_START 3 {}\n'.format(first).encode()
+        yield b'[GNUPG:] DECRYPTION_OKAY\n'
+        yield b'[GNUPG:] FILE_DONE\n'
+        assert on_decrypted.call_args_list == [mocker.call(first, None)]
+        # gpg is killed before it gets to the second file.
+
+    process = FakeProcess(returncode=2)
+    process.stdout = mocker.MagicMock()
+    process.stdout.__iter__.return_value = status_lines()
+    mocker.patch('securedrop_client.crypto.subprocess.Popen', return_value=process)
+
+    errors = gpg.decrypt_files([first, second], on_decrypted=on_decrypted)
+
+    assert list(errors) == [second]
+    assert on_decrypted.call_args_list == [mocker.call(first, None),
+                                           mocker.call(second, errors[second])]
+    process.stdout.close.assert_called_once_with()
+    assert os.listdir(data_dir) == ['2-msg.gpg']
+
+
+def test_decrypt_files_one_by_one(homedir, config, mocker):
+    """
+    On Qubes OS, or if a file has no .gpg extension, each file is decrypted by
+    its own gpg process.
+    Using the `config` fixture to ensure the config is written to disk.
+    """
+    gpg = GpgHelper(homedir, is_qubes=True)
+    error = CryptoError()
+    mock_decrypt = mocker.patch.object(gpg, 'decrypt_submission_or_reply',
+                                       side_effect=[None, error])
+    mock_popen = mocker.patch('securedrop_client.crypto.subprocess.Popen')
+    on_decrypted = mocker.MagicMock()
+
+    assert gpg.decrypt_files(['/data/1-msg.gpg', '/data/2-msg.gpg'],
+                             on_decrypted=on_decrypted) == {'/data/2-msg.gpg': error}
+
+    assert mock_decrypt.call_args_list == [mocker.call('/data/1-msg.gpg', '1-msg.gpg'),
+                                           mocker.call('/data/2-msg.gpg', '2-msg.gpg')]
+    assert on_decrypted.call_args_list == [mocker.call('/data/1-msg.gpg', None),
+                                           mocker.call('/data/2-msg.gpg', error)]
+    mock_popen.assert_not_called()
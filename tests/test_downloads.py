@@ -0,0 +1,1153 @@
+"""
+Make sure the download queue behaves as expected.
+"""
+import datetime
+import os
+import pytest
+import requests
+
+from securedrop_client import db
+from securedrop_client.crypto import CryptoError
+from securedrop_client.downloads import Download, DownloadQueue, DownloadStats, \
+    PrioritizedDownloads, download_resumable, DOWNLOAD_TIMEOUT
+from tests import factory
+
+
+@pytest.fixture
+def queue(mocker):
+    """
+    A download queue which hands items to a mock executor rather than worker
+    threads. It runs as on Qubes OS, so downloads are left to the API.
+    """
+    # don't create a GpgHelper because it will error on missing directories
+    mocker.patch('securedrop_client.downloads.GpgHelper')
+    mocker.patch('securedrop_client.downloads.make_session_maker')
+    # the API downloads nothing, so there is no file to measure
+    mocker.patch('securedrop_client.downloads.os.path.getsize', return_value=0)
+    queue = DownloadQueue(mocker.MagicMock(), '/home/user/.sd', True, max_workers=3,
+                          limits={'message': 2, 'reply': 2, 'file': 1})
+    queue.executor = mocker.MagicMock()
+    queue.decrypt_executor = mocker.MagicMock()
+    return queue
+
+
+def test_Download_from_db_object_submission(mocker):
+    source = factory.Source()
+    submission = db.Submission(source, 'submission-uuid', 1234, '1-my-doc.gz.gpg', 'url')
+    download = Download.from_db_object(submission, source)
+    assert download.kind == 'file'
+    assert download.uuid == 'submission-uuid'
+    assert download.source_uuid == source.uuid
+    assert download.filename == '1-my-doc.gz.gpg'
+    assert download.size == 1234
+
+
+def test_Download_from_db_object_reply(mocker):
+    reply = mocker.MagicMock(spec=db.Reply)
+    reply.uuid = 'reply-uuid'
+    reply.source.uuid = 'source-uuid'
+    reply.filename = '2-my-reply.gpg'
+    download = Download.from_db_object(reply)
+    assert download.kind == 'reply'
+    assert download.source_uuid == 'source-uuid'
+    assert repr(download) == '<Download reply reply-uuid>'
+
+
+def test_DownloadQueue_run(queue, mocker):
+    """
+    The messages and replies which have not been downloaded yet are enqueued,
+    then handed to the workers at once.
+    """
+    message = mocker.MagicMock(uuid='message-uuid', kind='message')
+    reply = mocker.MagicMock(spec=db.Reply)
+    reply.uuid = 'reply-uuid'
+    mocker.patch('securedrop_client.storage.find_new_submissions', return_value=[message])
+    mocker.patch('securedrop_client.storage.find_new_replies', return_value=[reply])
+    queue.add_pending = mocker.MagicMock()
+    queue.dispatch = mocker.MagicMock()
+    queue.schedule_retry = mocker.MagicMock()
+
+    queue.run()
+
+    enqueued = [c[0][0] for c in queue.add_pending.call_args_list]
+    assert [(d.kind, d.uuid) for d in enqueued] == [('message', 'message-uuid'),
+                                                    ('reply', 'reply-uuid')]
+    queue.dispatch.assert_called_once_with()
+    # Items which failed are looked for again once they may be retried.
+    queue.schedule_retry.assert_called_once_with()
+
+
+def test_DownloadQueue_run_no_api(queue, mocker):
+    """
+    Without an API (e.g. after logging out) there is nothing to download.
+    """
+    mock_find = mocker.patch('securedrop_client.storage.find_new_submissions')
+    queue.api = None
+    queue.run()
+    mock_find.assert_not_called()
+
+
+def test_DownloadQueue_enqueue_deduplicates(queue):
+    """
+    An item is only downloaded once, however often it is enqueued.
+    """
+    download = Download('message', 'uuid', 'source-uuid', '1-msg.gpg')
+    queue.enqueue(download)
+    queue.enqueue(Download('message', 'uuid', 'source-uuid', '1-msg.gpg'))
+
+    queue.executor.submit.assert_called_once_with(queue.download_in_worker, download)
+    assert queue.active == {'uuid': download}
+
+    # Nor is it queued again while it is being downloaded.
+    queue.enqueue(download)
+    assert queue.pending == {}
+
+
+def test_DownloadQueue_dispatch_limits(queue):
+    """
+    No more than max_workers items are downloaded at once, nor more than the
+    limit of each kind.
+    """
+    for i in range(3):
+        queue.enqueue(Download('file', 'file-{}'.format(i), 'source-uuid', 'doc.gz.gpg'))
+    for i in range(3):
+        queue.enqueue(Download('message', 'msg-{}'.format(i), 'source-uuid', 'msg.gpg'))
+
+    assert sorted(queue.active) == ['file-0', 'msg-0', 'msg-1']
+    assert list(queue.pending) == ['file-1', 'file-2', 'msg-2']
+    assert queue.executor.submit.call_count == 3
+
+
+def test_DownloadQueue_on_download_done_dispatches(queue, mocker):
+    """
+    Once an item has been downloaded, the next one is handed to the workers.
+    """
+    mocker.patch('securedrop_client.downloads.get_data', return_value='hello')
+    for i in range(4):
+        queue.enqueue(Download('message', 'msg-{}'.format(i), 'source-uuid', 'msg.gpg'))
+
+    queue.on_download_done(queue.active['msg-0'], None)
+
+    assert sorted(queue.active) == ['msg-1', 'msg-2']
+    assert list(queue.pending) == ['msg-3']
+
+
+def test_DownloadQueue_on_download_done_message(queue, mocker):
+    mocker.patch('securedrop_client.downloads.get_data', return_value='hello')
+    queue.message_downloaded = mocker.MagicMock()
+    queue.on_download_done(Download('message', 'uuid', 'source-uuid', '1-msg.gpg'), None)
+    queue.message_downloaded.emit.assert_called_once_with('uuid', 'hello')
+
+
+def test_DownloadQueue_on_download_done_reply(queue, mocker):
+    mocker.patch('securedrop_client.downloads.get_data', return_value='hello')
+    queue.reply_downloaded = mocker.MagicMock()
+    queue.on_download_done(Download('reply', 'uuid', 'source-uuid', '1-reply.gpg'), None)
+    queue.reply_downloaded.emit.assert_called_once_with('uuid', 'hello')
+
+
+def test_DownloadQueue_on_download_done_file(queue, mocker):
+    queue.file_downloaded = mocker.MagicMock()
+    queue.on_download_done(Download('file', 'uuid', 'source-uuid', '1-doc.gz.gpg'), None)
+    queue.file_downloaded.emit.assert_called_once_with('uuid', '1-doc.gz.gpg')
+
+
+def test_DownloadQueue_on_download_done_failure_schedules_retry(queue, mocker):
+    """
+    If a message fails to download, another attempt is scheduled.
+    """
+    queue.schedule_retry = mocker.MagicMock()
+    queue.message_downloaded = mocker.MagicMock()
+    queue.on_download_done(Download('message', 'uuid', 'source-uuid', '1-msg.gpg'),
+                           Exception('Boom'))
+    queue.schedule_retry.assert_called_once_with()
+    queue.message_downloaded.emit.assert_not_called()
+
+
+def test_DownloadQueue_on_download_done_file_failure(queue, mocker):
+    """
+    If a file fails to download, this is reported rather than retried.
+    """
+    error = CryptoError()
+    queue.schedule_retry = mocker.MagicMock()
+    queue.file_download_failed = mocker.MagicMock()
+    queue.on_download_done(Download('file', 'uuid', 'source-uuid', '1-doc.gz.gpg'), error)
+    queue.file_download_failed.emit.assert_called_once_with('uuid', '1-doc.gz.gpg', error)
+    queue.schedule_retry.assert_not_called()
+
+
+def test_DownloadQueue_download_in_worker(queue, mocker):
+    """
+    The outcome of a download is reported to the queue's thread.
+    """
+    download = Download('message', 'uuid', 'source-uuid', '1-msg.gpg')
+    queue.download = mocker.MagicMock()
+    queue.download_done = mocker.MagicMock()
+    queue.download_in_worker(download)
+    queue.download.assert_called_once_with(download)
+    queue.download_done.emit.assert_called_once_with(download, None)
+
+
+def test_DownloadQueue_download_in_worker_exception(queue, mocker):
+    """
+    Failures are recorded in the database.
+    """
+    download = Download('message', 'uuid', 'source-uuid', '1-msg.gpg')
+    error = Exception('Boom')
+    queue.download = mocker.MagicMock(side_effect=error)
+    queue.download_done = mocker.MagicMock()
+    mock_failed = mocker.patch('securedrop_client.storage.mark_file_download_failed')
+    queue.download_in_worker(download)
+    mock_failed.assert_called_once_with('uuid', error, queue.session)
+    queue.download_done.emit.assert_called_once_with(download, error)
+
+
+def test_DownloadQueue_download_in_worker_reply_exception(queue, mocker):
+    download = Download('reply', 'uuid', 'source-uuid', '1-reply.gpg')
+    error = Exception('Boom')
+    queue.download = mocker.MagicMock(side_effect=error)
+    queue.download_done = mocker.MagicMock()
+    mock_failed = mocker.patch('securedrop_client.storage.mark_reply_download_failed')
+    queue.download_in_worker(download)
+    mock_failed.assert_called_once_with('uuid', error, queue.session)
+    queue.download_done.emit.assert_called_once_with(download, error)
+
+
+def test_DownloadQueue_download_in_worker_record_failure_exception(queue, mocker):
+    """
+    If the failure cannot be recorded, the outcome is still reported.
+    """
+    download = Download('message', 'uuid', 'source-uuid', '1-msg.gpg')
+    error = Exception('Boom')
+    queue.download = mocker.MagicMock(side_effect=error)
+    queue.download_done = mocker.MagicMock()
+    mocker.patch('securedrop_client.storage.mark_file_download_failed',
+                 side_effect=Exception('Database locked'))
+    queue.download_in_worker(download)
+    queue.session.rollback.assert_called_once_with()
+    queue.download_done.emit.assert_called_once_with(download, error)
+
+
+def test_DownloadQueue_download_message(queue, mocker):
+    """
+    A message is downloaded to the data directory, leaving it to be decrypted
+    in a batch.
+    """
+    data_dir = os.path.join('/home/user/.sd', 'data')
+    queue.api.download_submission.return_value = ('', os.path.join(data_dir, '1-msg.gpg'))
+    mock_move = mocker.patch('securedrop_client.downloads.shutil.move')
+    mock_mark = mocker.patch('securedrop_client.storage.mark_file_as_downloaded')
+
+    assert queue.download(Download('message', 'uuid', 'source-uuid', '1-msg.gpg')) is False
+
+    sdk_submission = queue.api.download_submission.call_args[0][0]
+    assert sdk_submission.uuid == 'uuid'
+    assert sdk_submission.source_uuid == 'source-uuid'
+    assert sdk_submission.filename == '1-msg.gpg'
+    mock_move.assert_not_called()
+    queue.gpg.decrypt_submission_or_reply.assert_not_called()
+    queue.gpg.decrypt_files.assert_not_called()
+    mock_mark.assert_not_called()
+
+
+def test_DownloadQueue_download_file_on_qubes(queue, mocker):
+    """
+    On Qubes OS, files are moved from the incoming directory to the data
+    directory before being decrypted.
+    """
+    data_dir = os.path.join('/home/user/.sd', 'data')
+    queue.api.download_submission.return_value = ('', '/home/user/QubesIncoming/sd-proxy/x')
+    mock_move = mocker.patch('securedrop_client.downloads.shutil.move')
+    mocker.patch('securedrop_client.storage.mark_file_as_downloaded')
+
+    assert queue.download(Download('file', 'uuid', 'source-uuid', '1-doc.gz.gpg')) is True
+
+    mock_move.assert_called_once_with('/home/user/QubesIncoming/sd-proxy/x',
+                                      os.path.join(data_dir, '1-doc.gz.gpg'))
+    queue.gpg.decrypt_submission_or_reply.assert_called_once_with(
+        os.path.join(data_dir, '1-doc.gz.gpg'), '1-doc.gz.gpg', is_doc=True)
+
+
+def test_DownloadQueue_download_reply(queue, mocker):
+    data_dir = os.path.join('/home/user/.sd', 'data')
+    queue.api.download_reply.return_value = ('', os.path.join(data_dir, '1-reply.gpg'))
+    mock_mark = mocker.patch('securedrop_client.storage.mark_reply_as_downloaded')
+
+    assert queue.download(Download('reply', 'uuid', 'source-uuid', '1-reply.gpg')) is False
+
+    sdk_reply = queue.api.download_reply.call_args[0][0]
+    assert sdk_reply.uuid == 'uuid'
+    assert sdk_reply.source_uuid == 'source-uuid'
+    mock_mark.assert_not_called()
+
+
+def test_DownloadQueue_wake(queue, mocker):
+    """
+    Waking looks for items to download as soon as possible, replacing any
+    pending retry.
+    """
+    queue.timer = mocker.MagicMock()
+    queue.wake()
+    queue.timer.start.assert_called_once_with(0)
+
+
+def test_DownloadQueue_schedule_retry(queue, mocker):
+    """
+    The next pass is scheduled for when the next failed item may be
+    downloaded again.
+    """
+    now = datetime.datetime(2018, 12, 12, 11, 0, 0)
+    mock_datetime = mocker.patch('securedrop_client.downloads.datetime')
+    mock_datetime.datetime.utcnow.return_value = now
+    mocker.patch('securedrop_client.storage.next_download_attempt',
+                 return_value=now + datetime.timedelta(seconds=1.5))
+    queue.timer = mocker.MagicMock()
+    queue.timer.isActive.return_value = False
+    queue.schedule_retry()
+    queue.timer.start.assert_called_once_with(1500)
+
+
+def test_DownloadQueue_schedule_retry_overdue(queue, mocker):
+    mocker.patch('securedrop_client.storage.next_download_attempt',
+                 return_value=datetime.datetime(2000, 1, 1))
+    queue.timer = mocker.MagicMock()
+    queue.timer.isActive.return_value = False
+    queue.schedule_retry()
+    queue.timer.start.assert_called_once_with(0)
+
+
+def test_DownloadQueue_schedule_retry_nothing_waiting(queue, mocker):
+    mocker.patch('securedrop_client.storage.next_download_attempt', return_value=None)
+    queue.timer = mocker.MagicMock()
+    queue.schedule_retry()
+    queue.timer.start.assert_not_called()
+
+
+def test_DownloadQueue_schedule_retry_already_pending(queue, mocker):
+    """
+    A retry does not postpone a pass which is already due sooner.
+    """
+    mocker.patch('securedrop_client.storage.next_download_attempt',
+                 return_value=datetime.datetime.utcnow() + datetime.timedelta(hours=1))
+    queue.timer = mocker.MagicMock()
+    queue.timer.isActive.return_value = True
+    queue.timer.remainingTime.return_value = 0
+    queue.schedule_retry()
+    queue.timer.start.assert_not_called()
+
+
+def test_Download_from_db_object_last_updated(mocker):
+    source = factory.Source()
+    source.last_updated = datetime.datetime(2018, 10, 1, 12)
+    submission = db.Submission(source, 'submission-uuid', 1234, '1-msg.gpg', 'url')
+    download = Download.from_db_object(submission, source)
+    assert download.source_last_updated == source.last_updated.timestamp()
+
+
+def test_Download_from_db_object_no_last_updated(mocker):
+    """
+    Sources which have never been updated are downloaded last.
+    """
+    source = factory.Source(last_updated=None)
+    submission = db.Submission(source, 'submission-uuid', 1234, '1-msg.gpg', 'url')
+    download = Download.from_db_object(submission, source)
+    assert download.source_last_updated == 0
+
+
+def test_DownloadQueue_dispatch_priorities(queue):
+    """
+    Items from the selected source are downloaded first, then those from the
+    visible sources, then those from the most recently updated sources.
+    """
+    queue.max_workers = 1
+    queue.limits = {'message': 1}
+    queue.active = {'busy': Download('message', 'busy', 'other', 'msg.gpg')}
+    for uuid, source_uuid, last_updated in [('old', 'old-source', 1),
+                                            ('new', 'new-source', 2),
+                                            ('visible', 'visible-source', 0),
+                                            ('selected', 'selected-source', 0)]:
+        queue.enqueue(Download('message', uuid, source_uuid, 'msg.gpg', last_updated))
+    queue.set_priorities('selected-source', ['visible-source'])
+
+    order = []
+    while queue.pending:
+        queue.active = {}
+        queue.dispatch()
+        order.extend(queue.active)
+
+    assert order == ['selected', 'visible', 'new', 'old']
+
+
+def test_DownloadQueue_dispatch_backlog(queue, mocker):
+    """
+    The priority of each item of a backlog is worked out once, rather than
+    every time items are handed to the workers.
+    """
+    queue.max_workers = 2
+    queue.limits = {'message': 2}
+    priority = mocker.MagicMock(side_effect=queue.priority)
+    queue.pending = PrioritizedDownloads(priority)
+    for i in range(1000):
+        queue.add_pending(Download('message', 'msg-{}'.format(i), 'source-uuid', 'msg.gpg', i))
+
+    for i in range(10):
+        queue.active = {}
+        queue.dispatch()
+
+    assert priority.call_count == 1000
+    assert len(queue.pending) == 980
+    assert sorted(queue.active) == ['msg-980', 'msg-981']
+
+
+def test_PrioritizedDownloads():
+    """
+    The items are found in order of priority, then in the order they were
+    added, other than those of the given kinds.
+    """
+    downloads = PrioritizedDownloads(lambda download: download.source_last_updated)
+    for uuid, kind, last_updated in [('a', 'message', 2), ('b', 'file', 1),
+                                     ('c', 'message', 1), ('d', 'reply', 1)]:
+        downloads[uuid] = Download(kind, uuid, 'source-uuid', 'msg.gpg', last_updated)
+
+    assert list(downloads) == ['a', 'b', 'c', 'd']
+    assert downloads.first().uuid == 'b'
+    assert downloads.first(['file']).uuid == 'c'
+    assert downloads.first(['file', 'message']).uuid == 'd'
+    assert downloads.first(['file', 'message', 'reply']) is None
+
+    # An item removed then added again is found in its new place.
+    b = downloads['b']
+    del downloads['b']
+    assert downloads.first().uuid == 'c'
+    downloads['b'] = b
+    assert downloads.first().uuid == 'c'
+    assert len(downloads) == 4
+
+
+def test_PrioritizedDownloads_reorder():
+    """
+    Once the priority of the items changed, they are found in their new order.
+    """
+    urgent = set()
+    downloads = PrioritizedDownloads(lambda download: download.uuid not in urgent)
+    for uuid in ['a', 'b']:
+        downloads[uuid] = Download('message', uuid, 'source-uuid', 'msg.gpg')
+    assert downloads.first().uuid == 'a'
+
+    urgent.add('b')
+    downloads.reorder()
+
+    assert downloads.first().uuid == 'b'
+    assert list(downloads) == ['a', 'b']
+
+
+def test_DownloadQueue_priority(queue):
+    queue.set_priorities('selected-source', ['visible-source', 'selected-source'])
+    assert queue.priority(Download('message', 'uuid', 'selected-source', 'msg.gpg', 5)) == (0, -5)
+    assert queue.priority(Download('message', 'uuid', 'visible-source', 'msg.gpg', 5)) == (1, -5)
+    assert queue.priority(Download('message', 'uuid', 'other-source', 'msg.gpg', 5)) == (2, -5)
+
+
+def test_DownloadQueue_download_states(queue, mocker):
+    """
+    The state of the item is recorded as it is downloaded and decrypted.
+    """
+    data_dir = os.path.join('/home/user/.sd', 'data')
+    queue.api.download_submission.return_value = ('', os.path.join(data_dir, '1-doc.gz.gpg'))
+    mocker.patch('securedrop_client.storage.get_download_state', return_value=None)
+    mock_set_state = mocker.patch('securedrop_client.storage.set_download_state')
+    mock_mark = mocker.patch('securedrop_client.storage.mark_file_as_downloaded')
+
+    queue.download(Download('file', 'uuid', 'source-uuid', '1-doc.gz.gpg'))
+
+    assert mock_set_state.call_args_list == [
+        mocker.call(db.Submission, 'uuid', db.DOWNLOADED, queue.session),
+        mocker.call(db.Submission, 'uuid', db.DECRYPTING, queue.session),
+    ]
+    mock_mark.assert_called_once_with('uuid', queue.session)
+
+
+def test_DownloadQueue_download_decryption_failed(queue, mocker):
+    """
+    If decryption fails, this is recorded and the ciphertext is kept.
+    """
+    data_dir = os.path.join('/home/user/.sd', 'data')
+    queue.api.download_submission.return_value = ('', os.path.join(data_dir, '1-doc.gz.gpg'))
+    queue.gpg.decrypt_submission_or_reply.side_effect = CryptoError()
+    mocker.patch('securedrop_client.storage.get_download_state', return_value=None)
+    mock_set_state = mocker.patch('securedrop_client.storage.set_download_state')
+    mock_mark = mocker.patch('securedrop_client.storage.mark_file_as_downloaded')
+
+    with pytest.raises(CryptoError):
+        queue.download(Download('file', 'uuid', 'source-uuid', '1-doc.gz.gpg'))
+
+    mock_set_state.assert_called_with(db.Submission, 'uuid', db.DECRYPTION_FAILED,
+                                      queue.session)
+    mock_mark.assert_not_called()
+
+
+@pytest.mark.parametrize('state', [db.DOWNLOADED, db.DECRYPTING, db.DECRYPTION_FAILED])
+def test_DownloadQueue_download_reuses_ciphertext(queue, mocker, state):
+    """
+    If the ciphertext was downloaded before but not decrypted, it is
+    decrypted again without downloading it again.
+    """
+    mocker.patch('securedrop_client.storage.get_download_state', return_value=state)
+    mocker.patch('securedrop_client.downloads.os.path.exists', return_value=True)
+    mocker.patch('securedrop_client.storage.set_download_state')
+    mock_mark = mocker.patch('securedrop_client.storage.mark_file_as_downloaded')
+
+    queue.download(Download('file', 'uuid', 'source-uuid', '1-doc.gz.gpg'))
+
+    queue.api.download_submission.assert_not_called()
+    queue.gpg.decrypt_submission_or_reply.assert_called_once_with(
+        os.path.join('/home/user/.sd', 'data', '1-doc.gz.gpg'), '1-doc.gz.gpg', is_doc=True)
+    mock_mark.assert_called_once_with('uuid', queue.session)
+
+
+def test_DownloadQueue_download_ciphertext_truncated(queue, mocker, tmpdir):
+    """
+    If the ciphertext downloaded before is not as large as on the server, it
+    is downloaded again.
+    """
+    queue.data_dir = str(tmpdir)
+    filepath = tmpdir.join('1-doc.gz.gpg')
+    filepath.write('trunc')
+    queue.api.download_submission.return_value = ('', str(filepath))
+    mocker.patch('securedrop_client.downloads.os.path.getsize',
+                 side_effect=lambda path: os.stat(path).st_size)
+    mocker.patch('securedrop_client.storage.get_download_state',
+                 return_value=db.DECRYPTION_FAILED)
+    mocker.patch('securedrop_client.storage.set_download_state')
+    mocker.patch('securedrop_client.storage.mark_file_as_downloaded')
+    download = Download('file', 'uuid', 'source-uuid', '1-doc.gz.gpg', size=1234)
+
+    # the API fails to download it again
+    queue.api.download_submission.side_effect = Exception('Connection reset')
+    with pytest.raises(Exception):
+        queue.download(download)
+
+    assert not filepath.exists()
+    assert queue.api.download_submission.call_count == 1
+    assert download.reused_ciphertext is False
+
+
+def test_DownloadQueue_download_reused_ciphertext_fails(queue, mocker, tmpdir):
+    """
+    If a ciphertext downloaded before cannot be decrypted again, it is
+    discarded, so that the next attempt downloads it again.
+    """
+    queue.data_dir = str(tmpdir)
+    filepath = tmpdir.join('1-doc.gz.gpg')
+    filepath.write('corrupt')
+    queue.gpg.decrypt_submission_or_reply.side_effect = CryptoError()
+    mocker.patch('securedrop_client.storage.get_download_state',
+                 return_value=db.DECRYPTION_FAILED)
+    mocker.patch('securedrop_client.storage.set_download_state')
+
+    with pytest.raises(CryptoError):
+        queue.download(Download('file', 'uuid', 'source-uuid', '1-doc.gz.gpg'))
+
+    queue.api.download_submission.assert_not_called()
+    assert not filepath.exists()
+
+
+def test_DownloadQueue_decrypt_reused_ciphertext_fails(queue, mocker, tmpdir):
+    """
+    A message whose ciphertext was reused and cannot be decrypted again has it
+    discarded, unlike one which was just downloaded.
+    """
+    queue.data_dir = str(tmpdir)
+    reused = Download('message', 'reused-uuid', 'source-uuid', '1-msg.gpg')
+    reused.reused_ciphertext = True
+    fresh = Download('message', 'fresh-uuid', 'source-uuid', '2-msg.gpg')
+    for download in (reused, fresh):
+        tmpdir.join(download.filename).write('corrupt')
+
+    def decrypt_files(filepaths, on_decrypted):
+        for filepath in filepaths:
+            on_decrypted(filepath, CryptoError())
+
+    queue.gpg.decrypt_files.side_effect = decrypt_files
+    mocker.patch('securedrop_client.storage.set_download_state')
+
+    errors = queue.decrypt([reused, fresh])
+
+    assert sorted(errors) == ['fresh-uuid', 'reused-uuid']
+    assert not tmpdir.join('1-msg.gpg').exists()
+    assert tmpdir.join('2-msg.gpg').exists()
+
+
+def test_DownloadQueue_download_ciphertext_missing(queue, mocker):
+    """
+    If the ciphertext has gone missing, it is downloaded again.
+    """
+    data_dir = os.path.join('/home/user/.sd', 'data')
+    queue.api.download_submission.return_value = ('', os.path.join(data_dir, '1-msg.gpg'))
+    mocker.patch('securedrop_client.storage.get_download_state', return_value=db.DOWNLOADED)
+    mocker.patch('securedrop_client.downloads.os.path.exists', return_value=False)
+    mocker.patch('securedrop_client.storage.set_download_state')
+    mocker.patch('securedrop_client.storage.mark_file_as_downloaded')
+
+    queue.download(Download('message', 'uuid', 'source-uuid', '1-msg.gpg'))
+
+    assert queue.api.download_submission.call_count == 1
+
+
+class FakeResponse:
+    """
+    A streamed response from the server, which may be cut off with an error
+    after sending some of its chunks.
+    """
+
+    def __init__(self, status_code, chunks, content_length=None, error=None):
+        self.status_code = status_code
+        self.chunks = chunks
+        self.headers = {}
+        if content_length is not None:
+            self.headers['Content-Length'] = str(content_length)
+        self.error = error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(self.status_code)
+
+    def iter_content(self, chunk_size):
+        for chunk in self.chunks:
+            yield chunk
+        if self.error:
+            raise self.error
+
+
+@pytest.fixture
+def api(mocker):
+    api = mocker.MagicMock()
+    api.server = 'http://localhost:8081/'
+    api.auth_header = {'Authorization': 'Token abc'}
+    return api
+
+
+def test_download_resumable(homedir, api, mocker):
+    """
+    The file is streamed to the destination, without a Range header.
+    """
+    dest = os.path.join(homedir, 'data', '1-doc.gz.gpg')
+    mock_get = mocker.patch('securedrop_client.downloads.requests.get',
+                            return_value=FakeResponse(200, [b'abc', b'def'], 6))
+
+    assert download_resumable(api, 'api/v1/path/download', dest) == dest
+
+    with open(dest, 'rb') as f:
+        assert f.read() == b'abcdef'
+    assert not os.path.exists(dest + '.part')
+    mock_get.assert_called_once_with('http://localhost:8081/api/v1/path/download',
+                                     headers={'Authorization': 'Token abc'}, stream=True,
+                                     timeout=DOWNLOAD_TIMEOUT)
+
+
+def test_download_resumable_resumes(homedir, api, mocker):
+    """
+    If the download is interrupted, it resumes where it left off.
+    """
+    dest = os.path.join(homedir, 'data', '1-doc.gz.gpg')
+    mock_get = mocker.patch('securedrop_client.downloads.requests.get', side_effect=[
+        FakeResponse(200, [b'abc'], 6, error=requests.ConnectionError()),
+        FakeResponse(206, [b'd'], 3, error=requests.Timeout()),
+        FakeResponse(206, [b'e'], 2, error=requests.exceptions.ChunkedEncodingError()),
+        FakeResponse(206, [b'f'], 1),
+    ])
+
+    download_resumable(api, 'api/v1/path/download', dest)
+
+    with open(dest, 'rb') as f:
+        assert f.read() == b'abcdef'
+    assert [c[1]['headers'].get('Range') for c in mock_get.call_args_list] == \
+        [None, 'bytes=3-', 'bytes=4-', 'bytes=5-']
+
+
+def test_download_resumable_resumes_earlier_download(homedir, api, mocker):
+    """
+    A partial download left by an earlier attempt is resumed.
+    """
+    dest = os.path.join(homedir, 'data', '1-doc.gz.gpg')
+    with open(dest + '.part', 'wb') as f:
+        f.write(b'abc')
+    mock_get = mocker.patch('securedrop_client.downloads.requests.get',
+                            return_value=FakeResponse(206, [b'def'], 3))
+
+    download_resumable(api, 'api/v1/path/download', dest)
+
+    with open(dest, 'rb') as f:
+        assert f.read() == b'abcdef'
+    assert mock_get.call_args[1]['headers']['Range'] == 'bytes=3-'
+
+
+def test_download_resumable_range_ignored(homedir, api, mocker):
+    """
+    If the server ignores the Range header and sends the whole file, the
+    partial download is replaced.
+    """
+    dest = os.path.join(homedir, 'data', '1-doc.gz.gpg')
+    with open(dest + '.part', 'wb') as f:
+        f.write(b'xyz')
+    mocker.patch('securedrop_client.downloads.requests.get',
+                 return_value=FakeResponse(200, [b'abcdef'], 6))
+
+    download_resumable(api, 'api/v1/path/download', dest)
+
+    with open(dest, 'rb') as f:
+        assert f.read() == b'abcdef'
+
+
+def test_download_resumable_range_not_satisfiable(homedir, api, mocker):
+    """
+    If the partial download does not match the file on the server, it starts
+    again.
+    """
+    dest = os.path.join(homedir, 'data', '1-doc.gz.gpg')
+    with open(dest + '.part', 'wb') as f:
+        f.write(b'abcdefghi')
+    mock_get = mocker.patch('securedrop_client.downloads.requests.get', side_effect=[
+        FakeResponse(416, []),
+        FakeResponse(200, [b'abcdef'], 6),
+    ])
+
+    download_resumable(api, 'api/v1/path/download', dest)
+
+    with open(dest, 'rb') as f:
+        assert f.read() == b'abcdef'
+    assert 'Range' not in mock_get.call_args[1]['headers']
+
+
+def test_download_resumable_cut_short(homedir, api, mocker):
+    """
+    A response which ends before all the bytes have arrived is resumed.
+    """
+    dest = os.path.join(homedir, 'data', '1-doc.gz.gpg')
+    mocker.patch('securedrop_client.downloads.requests.get', side_effect=[
+        FakeResponse(200, [b'abc'], 6),
+        FakeResponse(206, [b'def'], 3),
+    ])
+
+    download_resumable(api, 'api/v1/path/download', dest)
+
+    with open(dest, 'rb') as f:
+        assert f.read() == b'abcdef'
+
+
+def test_download_resumable_stalled(homedir, api, mocker):
+    """
+    If resuming makes no progress, the download is given up on, keeping the
+    partial download for the next attempt.
+    """
+    dest = os.path.join(homedir, 'data', '1-doc.gz.gpg')
+    mock_get = mocker.patch('securedrop_client.downloads.requests.get', side_effect=[
+        FakeResponse(200, [b'abc'], 6, error=requests.ConnectionError()),
+        FakeResponse(206, [], 3, error=requests.Timeout()),
+        FakeResponse(206, [], 3, error=requests.Timeout()),
+    ])
+
+    with pytest.raises(requests.Timeout):
+        download_resumable(api, 'api/v1/path/download', dest, max_stalled_resumes=1)
+
+    assert mock_get.call_count == 3
+    with open(dest + '.part', 'rb') as f:
+        assert f.read() == b'abc'
+    assert not os.path.exists(dest)
+
+
+def test_download_resumable_http_error(homedir, api, mocker):
+    dest = os.path.join(homedir, 'data', '1-doc.gz.gpg')
+    mocker.patch('securedrop_client.downloads.requests.get',
+                 return_value=FakeResponse(404, []))
+
+    with pytest.raises(requests.HTTPError):
+        download_resumable(api, 'api/v1/path/download', dest)
+
+
+@pytest.mark.parametrize('kind,path', [
+    ('file', 'api/v1/sources/source-uuid/submissions/uuid/download'),
+    ('reply', 'api/v1/sources/source-uuid/replies/uuid/download'),
+])
+def test_DownloadQueue_download_ciphertext_resumable(queue, mocker, kind, path):
+    """
+    Outside Qubes OS, items are downloaded with download_resumable.
+    """
+    queue.is_qubes = False
+    mock_download = mocker.patch('securedrop_client.downloads.download_resumable')
+
+    queue.download_ciphertext(Download(kind, 'uuid', 'source-uuid', '1-x.gpg'), '/dest')
+
+    mock_download.assert_called_once_with(queue.api, path, '/dest',
+                                          on_progress=mocker.ANY)
+    queue.api.download_submission.assert_not_called()
+    queue.api.download_reply.assert_not_called()
+
+
+def test_download_resumable_progress(homedir, api, mocker):
+    """
+    Progress is reported after each chunk, counting bytes from an earlier
+    attempt as received.
+    """
+    dest = os.path.join(homedir, 'data', '1-doc.gz.gpg')
+    with open(dest + '.part', 'wb') as f:
+        f.write(b'ab')
+    mocker.patch('securedrop_client.downloads.requests.get',
+                 return_value=FakeResponse(206, [b'cd', b'ef'], 4))
+    on_progress = mocker.MagicMock()
+
+    download_resumable(api, 'api/v1/path/download', dest, on_progress=on_progress)
+
+    assert on_progress.call_args_list == [mocker.call(2, 4, 6), mocker.call(2, 6, 6)]
+
+
+def test_download_resumable_progress_unknown_size(homedir, api, mocker):
+    dest = os.path.join(homedir, 'data', '1-doc.gz.gpg')
+    mocker.patch('securedrop_client.downloads.requests.get',
+                 return_value=FakeResponse(200, [b'abc']))
+    on_progress = mocker.MagicMock()
+
+    download_resumable(api, 'api/v1/path/download', dest, on_progress=on_progress)
+
+    on_progress.assert_called_once_with(3, 3, None)
+
+
+def test_DownloadStats():
+    now = [100.0]
+    stats = DownloadStats(window=10, clock=lambda: now[0])
+    assert stats.rate == 0
+    assert stats.eta is None
+
+    stats.add_bytes('a', 1000, 1000, 5000)
+    stats.add_bytes('b', 1000, 1000, None)
+    now[0] = 105.0
+    stats.add_bytes('a', 1000, 2000, 5000)
+    stats.set_queue_length(3, 2)
+
+    assert stats.rate == 300
+    assert stats.eta == 10  # 3000 bytes of 'a' to go; the size of 'b' is unknown
+    assert stats.as_dict() == {
+        'bytes_downloaded': 3000,
+        'downloaded': 0,
+        'failed': 0,
+        'queued': 3,
+        'active': 2,
+        'rate': 300,
+        'eta': 10,
+    }
+
+    # samples older than the window no longer count towards the rate
+    now[0] = 112.0
+    assert stats.rate == 100
+
+    stats.item_done('a', True)
+    stats.item_done('b', False)
+    assert stats.progress == {}
+    assert (stats.downloaded, stats.failed) == (1, 1)
+    assert stats.bytes_downloaded == 3000
+
+
+def test_DownloadQueue_queue_length_changed(queue, mocker):
+    """
+    The length of the queue is recorded and signalled as it changes.
+    """
+    queue_length_changed = mocker.MagicMock()
+    queue.queue_length_changed.connect(queue_length_changed)
+
+    for i in range(3):
+        queue.enqueue(Download('file', 'uuid-{}'.format(i), 'source-uuid', 'x.gpg'))
+
+    assert queue_length_changed.call_args_list == \
+        [mocker.call(0, 1), mocker.call(1, 1), mocker.call(2, 1)]
+    assert (queue.stats.queued, queue.stats.active) == (2, 1)
+
+    # nothing changes, so nothing is signalled
+    queue.dispatch()
+    assert queue_length_changed.call_count == 3
+
+
+def test_DownloadQueue_queue_length_counts_decryption(queue, mocker):
+    """
+    Messages and replies are counted as queued while they wait to be
+    decrypted, and as active while they are decrypted.
+    """
+    queue.max_decrypt_workers = 1
+    queue_length_changed = mocker.MagicMock()
+    queue.queue_length_changed.connect(queue_length_changed)
+    first = Download('message', 'uuid-1', 'source-uuid', '1-msg.gpg')
+    second = Download('message', 'uuid-2', 'source-uuid', '2-msg.gpg')
+    queue.enqueue(first)
+    queue.enqueue(second)
+
+    queue.on_ciphertext_downloaded(first)
+    queue.on_ciphertext_downloaded(second)
+    assert (queue.stats.queued, queue.stats.active) == (1, 1)
+
+    queue.on_download_done(first, None)
+    assert (queue.stats.queued, queue.stats.active) == (0, 1)
+
+    queue.on_download_done(second, None)
+    assert (queue.stats.queued, queue.stats.active) == (0, 0)
+    assert queue_length_changed.call_args_list[-1] == mocker.call(0, 0)
+
+
+def test_DownloadQueue_download_progress_large_file(queue, mocker):
+    """
+    The progress of files larger than 2 GiB is not truncated to 32 bits.
+    """
+    download_progress = mocker.MagicMock()
+    queue.download_progress.connect(download_progress)
+    size = 5 * 2 ** 30
+    on_progress = queue.progress_reporter(Download('file', 'uuid', 'source-uuid', 'x.gpg'))
+    on_progress(2 ** 20, size, size)
+    download_progress.assert_called_once_with('uuid', size, size)
+
+
+def test_DownloadQueue_progress_reporter(queue, mocker):
+    """
+    Progress updates the stats on every chunk, but download_progress is
+    throttled except for the last chunk.
+    """
+    mock_time = mocker.patch('securedrop_client.downloads.time.monotonic', return_value=0)
+    download_progress = mocker.MagicMock()
+    queue.download_progress.connect(download_progress)
+    on_progress = queue.progress_reporter(Download('file', 'uuid', 'source-uuid', 'x.gpg'))
+
+    on_progress(10, 10, 30)
+    mock_time.return_value = 0.1
+    on_progress(10, 20, 30)
+    on_progress(10, 30, 30)
+    mock_time.return_value = 1
+    on_progress(10, 40, None)
+
+    assert download_progress.call_args_list == [
+        mocker.call('uuid', 10, 30),
+        mocker.call('uuid', 30, 30),
+        mocker.call('uuid', 40, -1),
+    ]
+    assert queue.stats.bytes_downloaded == 40
+
+
+def test_DownloadQueue_download_in_worker_stats(queue, mocker):
+    queue.stats.add_bytes('uuid', 10, 10, 30)
+    mocker.patch.object(queue, 'download')
+
+    queue.download_in_worker(Download('file', 'uuid', 'source-uuid', 'x.gpg'))
+
+    assert queue.stats.downloaded == 1
+    assert queue.stats.progress == {}
+
+
+def test_DownloadQueue_download_on_qubes_progress(queue, mocker):
+    """
+    The API gives no progress, so the whole item is reported when done.
+    """
+    mocker.patch('securedrop_client.downloads.os.path.getsize', return_value=42)
+    mocker.patch('securedrop_client.downloads.shutil.move')
+    queue.api.download_reply.return_value = ('sha', '/home/user/QubesIncoming/x.gpg')
+    download_progress = mocker.MagicMock()
+    queue.download_progress.connect(download_progress)
+
+    queue.download_ciphertext(Download('reply', 'uuid', 'source-uuid', 'x.gpg'),
+                              '/home/user/.sd/data/x.gpg')
+
+    download_progress.assert_called_once_with('uuid', 42, 42)
+    assert queue.stats.bytes_downloaded == 42
+
+
+def test_DownloadQueue_download_in_worker_ciphertext(queue, mocker):
+    """
+    Messages and replies whose ciphertext has been downloaded are handed back
+    to the queue to be decrypted.
+    """
+    download = Download('message', 'uuid', 'source-uuid', '1-msg.gpg')
+    queue.download = mocker.MagicMock(return_value=False)
+    queue.download_done = mocker.MagicMock()
+    queue.ciphertext_downloaded = mocker.MagicMock()
+    queue.download_in_worker(download)
+    queue.ciphertext_downloaded.emit.assert_called_once_with(download)
+    queue.download_done.emit.assert_not_called()
+
+
+def test_DownloadQueue_decrypt(queue, mocker):
+    """
+    Messages and replies are decrypted together, files one by one, and each
+    is marked as downloaded or as failed, and reported, as soon as it is
+    decrypted.
+    """
+    data_dir = os.path.join('/home/user/.sd', 'data')
+    message = Download('message', 'message-uuid', 'source-uuid', '1-msg.gpg')
+    reply = Download('reply', 'reply-uuid', 'source-uuid', '2-reply.gpg')
+    file_ = Download('file', 'file-uuid', 'source-uuid', '3-doc.gz.gpg')
+    error = CryptoError()
+
+    def decrypt_files(filepaths, on_decrypted):
+        on_decrypted(filepaths[0], None)
+        on_decrypted(filepaths[1], error)
+        return {filepaths[1]: error}
+
+    queue.gpg.decrypt_files.side_effect = decrypt_files
+    mock_set_state = mocker.patch('securedrop_client.storage.set_download_state')
+    mock_mark_file = mocker.patch('securedrop_client.storage.mark_file_as_downloaded')
+    mock_mark_reply = mocker.patch('securedrop_client.storage.mark_reply_as_downloaded')
+    on_decrypted = mocker.MagicMock()
+
+    assert queue.decrypt([message, reply, file_], on_decrypted=on_decrypted) == \
+        {'reply-uuid': error}
+
+    queue.gpg.decrypt_files.assert_called_once_with([
+        os.path.join(data_dir, '1-msg.gpg'), os.path.join(data_dir, '2-reply.gpg')],
+        on_decrypted=mocker.ANY)
+    queue.gpg.decrypt_submission_or_reply.assert_called_once_with(
+        os.path.join(data_dir, '3-doc.gz.gpg'), '3-doc.gz.gpg', is_doc=True)
+    assert mock_mark_file.call_args_list == [
+        mocker.call('file-uuid', queue.session), mocker.call('message-uuid', queue.session)]
+    mock_mark_reply.assert_not_called()
+    assert on_decrypted.call_args_list == [
+        mocker.call(file_, None), mocker.call(message, None), mocker.call(reply, error)]
+    mock_set_state.assert_any_call(db.Reply, 'reply-uuid', db.DECRYPTING, queue.session)
+    mock_set_state.assert_called_with(db.Reply, 'reply-uuid', db.DECRYPTION_FAILED,
+                                      queue.session)
+
+
+def test_DownloadQueue_decrypt_in_worker(queue, mocker):
+    """
+    The outcome of decrypting each item is reported to the queue's thread as
+    soon as it is known.
+    """
+    message = Download('message', 'message-uuid', 'source-uuid', '1-msg.gpg')
+    reply = Download('reply', 'reply-uuid', 'source-uuid', '2-reply.gpg')
+    error = CryptoError()
+    queue.download_done = mocker.MagicMock()
+
+    def decrypt(downloads, on_decrypted):
+        on_decrypted(message, None)
+        queue.download_done.emit.assert_called_once_with(message, None)
+        on_decrypted(reply, error)
+        return {'reply-uuid': error}
+
+    queue.decrypt = mocker.MagicMock(side_effect=decrypt)
+    mock_failed = mocker.patch('securedrop_client.storage.mark_reply_download_failed')
+
+    queue.decrypt_in_worker([message, reply])
+
+    mock_failed.assert_called_once_with('reply-uuid', error, queue.session)
+    assert queue.download_done.emit.call_args_list == [
+        mocker.call(message, None), mocker.call(reply, error)]
+    assert (queue.stats.downloaded, queue.stats.failed) == (1, 1)
+
+
+def test_DownloadQueue_decrypt_in_worker_exception(queue, mocker):
+    """
+    If the batch could not be decrypted, every item in it not yet reported
+    failed.
+    """
+    message = Download('message', 'message-uuid', 'source-uuid', '1-msg.gpg')
+    reply = Download('reply', 'reply-uuid', 'source-uuid', '2-reply.gpg')
+    error = Exception('Database locked')
+
+    def decrypt(downloads, on_decrypted):
+        on_decrypted(message, None)
+        raise error
+
+    queue.decrypt = mocker.MagicMock(side_effect=decrypt)
+    queue.download_done = mocker.MagicMock()
+    mocker.patch('securedrop_client.storage.mark_reply_download_failed')
+
+    queue.decrypt_in_worker([message, reply])
+
+    assert queue.download_done.emit.call_args_list == [
+        mocker.call(message, None), mocker.call(reply, error)]
+
+
+def test_DownloadQueue_decrypt_batches(queue, mocker):
+    """
+    Ciphertexts downloaded while a batch is being decrypted wait for it, then
+    are decrypted together.
+    """
+    mocker.patch('securedrop_client.downloads.get_data', return_value='hello')
+    queue.max_decrypt_workers = 1
+    downloads = [Download('message', 'uuid-{}'.format(i), 'source-uuid', '{}-msg.gpg'.format(i))
+                 for i in range(3)]
+    for download in downloads:
+        queue.active[download.uuid] = download
+
+    queue.on_ciphertext_downloaded(downloads[0])
+    queue.decrypt_executor.submit.assert_called_once_with(queue.decrypt_in_worker,
+                                                          [downloads[0]])
+
+    queue.on_ciphertext_downloaded(downloads[1])
+    queue.on_ciphertext_downloaded(downloads[2])
+    assert queue.decrypt_executor.submit.call_count == 1
+    assert not queue.active
+    assert list(queue.to_decrypt) == ['uuid-1', 'uuid-2']
+
+    # the items waiting or being decrypted are not downloaded again
+    queue.enqueue(downloads[0])
+    queue.enqueue(downloads[1])
+    assert not queue.pending
+
+    queue.on_download_done(downloads[0], None)
+    queue.decrypt_executor.submit.assert_called_with(queue.decrypt_in_worker, downloads[1:])
+    assert not queue.to_decrypt
+    assert list(queue.decrypting) == ['uuid-1', 'uuid-2']
+
+
+def test_DownloadQueue_decrypt_next_shares_batches(queue, mocker):
+    """
+    The items waiting to be decrypted are handed to the free decryption
+    threads in batches of at most DECRYPT_BATCH_SIZE, in order of priority.
+    """
+    mocker.patch('securedrop_client.downloads.DECRYPT_BATCH_SIZE', 2)
+    queue.max_decrypt_workers = 3
+    queue.decrypting = {'busy-uuid': 0}
+    downloads = [Download('message', 'uuid-{}'.format(i), 'source-uuid', 'msg.gpg',
+                          source_last_updated=10 - i)
+                 for i in range(5)]
+    for download in downloads:
+        queue.to_decrypt[download.uuid] = download
+
+    queue.decrypt_next()
+
+    assert queue.decrypt_executor.submit.call_args_list == [
+        mocker.call(queue.decrypt_in_worker, downloads[:2]),
+        mocker.call(queue.decrypt_in_worker, downloads[2:4]),
+    ]
+    assert list(queue.to_decrypt) == ['uuid-4']
+    assert len(set(queue.decrypting.values())) == 3
+
+    # every thread is busy
+    queue.decrypt_next()
+    assert queue.decrypt_executor.submit.call_count == 2
+
+
+def test_DownloadQueue_decrypt_next_prioritized_batches(queue, mocker):
+    """
+    Items from the selected source and from the visible sources are batched
+    on their own, so they are not held up by less urgent items.
+    """
+    queue.max_decrypt_workers = 3
+    queue.set_priorities('selected-source', ['visible-source'])
+    downloads = [
+        Download('message', 'other-uuid', 'other-source', 'msg.gpg'),
+        Download('message', 'visible-uuid', 'visible-source', 'msg.gpg'),
+        Download('reply', 'selected-uuid', 'selected-source', 'reply.gpg'),
+        Download('message', 'other-uuid-2', 'other-source', 'msg.gpg'),
+    ]
+    for download in downloads:
+        queue.to_decrypt[download.uuid] = download
+
+    queue.decrypt_next()
+
+    assert queue.decrypt_executor.submit.call_args_list == [
+        mocker.call(queue.decrypt_in_worker, [downloads[2]]),
+        mocker.call(queue.decrypt_in_worker, [downloads[1]]),
+        mocker.call(queue.decrypt_in_worker, [downloads[0], downloads[3]]),
+    ]
+    assert not queue.to_decrypt
@@ -5,10 +5,13 @@ expected.
 import arrow
 import os
 import pytest
+import threading
+from PyQt5.QtCore import QCoreApplication
 from tests import factory
 from securedrop_client import storage, db
 from securedrop_client.crypto import CryptoError
-from securedrop_client.logic import APICallRunner, Client
+from securedrop_client.logic import APICallRunnable, APICallRunner, Client, \
+    MAX_CONCURRENT_API_CALLS, SYNC_DEBOUNCE
 
 with open(os.path.join(os.path.dirname(__file__), 'files', 'test-key.gpg.pub.asc')) as f:
     PUB_KEY = f.read()
@@ -57,6 +60,39 @@ def test_APICallRunner_with_exception(mocker):
     cr.call_finished.emit.assert_called_once_with()
 
 
+def test_APICallRunner_timed_out(mocker):
+    """
+    If the call timed out while it waited for a thread, the API is not called.
+    """
+    mock_api_call = mocker.MagicMock()
+    cr = APICallRunner(mock_api_call, None)
+    cr.call_finished = mocker.MagicMock()
+    assert cr.time_out() is False
+    cr.call_api()
+    mock_api_call.assert_not_called()
+    cr.call_finished.emit.assert_not_called()
+
+
+def test_APICallRunner_timed_out_while_running(mocker):
+    """
+    If the call timed out while the API was being called, the caller is told
+    so, then told once the API returns.
+    """
+    cr = APICallRunner(lambda: cr.time_out(), None)
+    cr.call_finished = mocker.MagicMock()
+    cr.call_api()
+    assert cr.result is True
+    assert cr.i_timed_out is True
+    assert cr.running is False
+    cr.call_finished.emit.assert_called_once_with()
+
+
+def test_APICallRunnable_run(mocker):
+    mock_runner = mocker.MagicMock()
+    APICallRunnable(mock_runner).run()
+    mock_runner.call_api.assert_called_once_with()
+
+
 def test_Client_init(homedir, config, mocker):
     """
     The passed in gui, app and session instances are correctly referenced and,
@@ -87,26 +123,25 @@ def test_Client_setup(homedir, config, mocker):
     cl.gui.show_login.assert_called_once_with()
 
 
-def test_Client_start_message_thread(homedir, config, mocker):
+def test_Client_start_download_thread(homedir, config, mocker):
     """
-    When starting message-fetching thread, make sure we do a few things.
+    When starting the download thread, make sure we do a few things.
     Using the `config` fixture to ensure the config is written to disk.
     """
     mock_gui = mocker.MagicMock()
     mock_session = mocker.MagicMock()
     cl = Client('http://localhost', mock_gui, mock_session, homedir)
     mock_qthread = mocker.patch('securedrop_client.logic.QThread')
-    mocker.patch('securedrop_client.logic.MessageSync')
-    cl.message_sync = mocker.MagicMock()
-    cl.start_message_thread()
-    cl.message_sync.moveToThread.assert_called_once_with(mock_qthread())
-    cl.message_thread.started.connect.assert_called_once_with(cl.message_sync.run)
-    cl.message_thread.start.assert_called_once_with()
+    cl.download_queue = mocker.MagicMock()
+    cl.start_download_thread()
+    cl.download_queue.moveToThread.assert_called_once_with(mock_qthread())
+    cl.download_thread.started.connect.assert_called_once_with(cl.download_queue.run)
+    cl.download_thread.start.assert_called_once_with()
 
 
-def test_Client_start_message_thread_if_already_running(homedir, config, mocker):
+def test_Client_start_download_thread_if_already_running(homedir, config, mocker):
     """
-    Ensure that when starting the message thread, we don't start another thread
+    Ensure that when starting the download thread, we don't start another thread
     if it's already running. Instead, we just authenticate the existing thread.
     Using the `config` fixture to ensure the config is written to disk.
     """
@@ -114,60 +149,55 @@ def test_Client_start_message_thread_if_already_running(homedir, config, mocker)
     mock_session = mocker.MagicMock()
     cl = Client('http://localhost', mock_gui, mock_session, homedir)
     cl.api = 'api object'
-    cl.message_sync = mocker.MagicMock()
-    cl.message_thread = mocker.MagicMock()
-    cl.message_thread.api = None
-    cl.start_message_thread()
-    cl.message_sync.api = cl.api
-    cl.message_thread.start.assert_not_called()
+    cl.download_queue = mocker.MagicMock()
+    cl.download_thread = mocker.MagicMock()
+    cl.start_download_thread()
+    assert cl.download_queue.api == cl.api
+    cl.download_thread.start.assert_not_called()
 
 
-def test_Client_start_reply_thread(homedir, config, mocker):
+def test_Client_start_purge_thread(homedir, config, mocker):
     """
-    When starting reply-fetching thread, make sure we do a few things.
+    The file-purging thread is started once, and files are purged there.
     Using the `config` fixture to ensure the config is written to disk.
     """
     mock_gui = mocker.MagicMock()
     mock_session = mocker.MagicMock()
     cl = Client('http://localhost', mock_gui, mock_session, homedir)
     mock_qthread = mocker.patch('securedrop_client.logic.QThread')
-    mocker.patch('securedrop_client.logic.ReplySync')
-    cl.reply_sync = mocker.MagicMock()
-    cl.start_reply_thread()
-    cl.reply_sync.moveToThread.assert_called_once_with(mock_qthread())
-    cl.reply_thread.started.connect.assert_called_once_with(
-        cl.reply_sync.run)
-    cl.reply_thread.start.assert_called_once_with()
+    cl.file_purge = mocker.MagicMock()
+    cl.start_purge_thread()
+    cl.start_purge_thread()
+    cl.file_purge.moveToThread.assert_called_once_with(mock_qthread())
+    cl.purge_thread.start.assert_called_once_with()
 
 
-def test_Client_start_reply_thread_if_already_running(homedir, config, mocker):
+def test_Client_start_post_sync_thread(homedir, config, mocker):
     """
-    Ensure that when starting the reply thread, we don't start another thread
-    if it's already running. Instead, we just authenticate the existing thread.
+    The thread storing the result of each sync is started once.
     Using the `config` fixture to ensure the config is written to disk.
     """
     mock_gui = mocker.MagicMock()
     mock_session = mocker.MagicMock()
     cl = Client('http://localhost', mock_gui, mock_session, homedir)
-    cl.api = 'api object'
-    cl.reply_sync = mocker.MagicMock()
-    cl.reply_thread = mocker.MagicMock()
-    cl.reply_thread.api = None
-    cl.start_reply_thread()
-    cl.reply_sync.api = cl.api
-    cl.reply_thread.start.assert_not_called()
+    mock_qthread = mocker.patch('securedrop_client.logic.QThread')
+    cl.post_sync = mocker.MagicMock()
+    cl.start_post_sync_thread()
+    cl.start_post_sync_thread()
+    cl.post_sync.moveToThread.assert_called_once_with(mock_qthread())
+    cl.post_sync_thread.start.assert_called_once_with()
 
 
 def test_Client_call_api(homedir, config, mocker):
     """
-    A new thread and APICallRunner is created / setup.
+    A new APICallRunner is created / setup and run in the API thread pool.
     Using the `config` fixture to ensure the config is written to disk.
     """
     mock_gui = mocker.MagicMock()
     mock_session = mocker.MagicMock()
     cl = Client('http://localhost', mock_gui, mock_session, homedir)
     cl.finish_api_call = mocker.MagicMock()
-    mocker.patch('securedrop_client.logic.QThread')
+    cl.api_pool = mocker.MagicMock()
     mocker.patch('securedrop_client.logic.APICallRunner')
     mocker.patch('securedrop_client.logic.QTimer')
     mock_api_call = mocker.MagicMock()
@@ -178,16 +208,71 @@ def test_Client_call_api(homedir, config, mocker):
 
     assert len(cl.api_threads) == 1
     thread_info = cl.api_threads[list(cl.api_threads.keys())[0]]
-    thread = thread_info['thread']
     runner = thread_info['runner']
     timer = thread_info['timer']
-    thread.started.connect.assert_called_once_with(runner.call_api)
-    thread.start.assert_called_once_with()
-    runner.moveToThread.assert_called_once_with(thread)
+    runnable = cl.api_pool.start.call_args[0][0]
+    assert isinstance(runnable, APICallRunnable)
+    assert runnable.runner == runner
     timer.timeout.connect.call_count == 1
     runner.call_finished.connect.call_count == 1
 
 
+def test_Client_call_api_coalesced(homedir, config, mocker):
+    """
+    A call with the same coalesce_key as a call in progress is not made again:
+    its callbacks and timeouts are attached to the call in progress, once
+    each, and the callbacks are given its result.
+    Using the `config` fixture to ensure the config is written to disk.
+    """
+    mock_gui = mocker.MagicMock()
+    mock_session = mocker.MagicMock()
+    cl = Client('http://localhost', mock_gui, mock_session, homedir)
+    cl.api_pool = mocker.MagicMock()
+    mocker.patch('securedrop_client.logic.APICallRunner')
+    mocker.patch('securedrop_client.logic.QTimer')
+    mock_api_call = mocker.MagicMock()
+    callback_1 = mocker.MagicMock()
+    callback_2 = mocker.MagicMock()
+    mock_timeout = mocker.MagicMock()
+    other_timeout = mocker.MagicMock()
+
+    cl.call_api(mock_api_call, callback_1, mock_timeout, coalesce_key='sync')
+    cl.call_api(mock_api_call, callback_2, mock_timeout, coalesce_key='sync')
+    cl.call_api(mock_api_call, callback_2, other_timeout, coalesce_key='sync')
+
+    assert cl.api_pool.start.call_count == 1
+    assert len(cl.api_threads) == 1
+    thread_id = cl.coalesced_api_calls['sync']
+    thread_info = cl.api_threads[thread_id]
+    assert thread_info['callbacks'] == [callback_1, callback_2]
+    assert thread_info['timeouts'] == [mock_timeout, other_timeout]
+    thread_info['timer'].start.assert_called_once_with(20000)
+
+    thread_info['runner'].result = 'result'
+    thread_info['runner'].current_object = None
+    cl.completed_api_call(thread_id)
+    callback_1.assert_called_once_with('result')
+    callback_2.assert_called_once_with('result')
+    mock_timeout.assert_not_called()
+    other_timeout.assert_not_called()
+    assert cl.coalesced_api_calls == {}
+
+    # Once the call is done, the next one with the key is made.
+    cl.call_api(mock_api_call, callback_1, mock_timeout, coalesce_key='sync')
+    assert cl.api_pool.start.call_count == 2
+
+
+def test_Client_api_pool(homedir, config, mocker):
+    """
+    The threads calling the API are bounded in number and reused.
+    Using the `config` fixture to ensure the config is written to disk.
+    """
+    mock_gui = mocker.MagicMock()
+    mock_session = mocker.MagicMock()
+    cl = Client('http://localhost', mock_gui, mock_session, homedir)
+    assert cl.api_pool.maxThreadCount() == MAX_CONCURRENT_API_CALLS
+
+
 def test_Client_clean_thread_no_thread(homedir, config, mocker):
     """
     The client will ignore an attempt to reset an API call if there's no such
@@ -223,6 +308,26 @@ def test_Client_clean_thread(homedir, config, mocker):
     assert 'foo' not in cl.api_threads
 
 
+def test_Client_clean_thread_coalesced(homedir, config, mocker):
+    """
+    Cleaning up a thread which others may attach to removes its coalesce_key,
+    so that the next call with the key is made.
+    Using the `config` fixture to ensure the config is written to disk.
+    """
+    mock_gui = mocker.MagicMock()
+    mock_session = mocker.MagicMock()
+    cl = Client('http://localhost', mock_gui, mock_session, homedir)
+    cl.api_threads = {
+        'foo': {
+            'timer': mocker.MagicMock(),
+            'coalesce_key': 'sync',
+        }
+    }
+    cl.coalesced_api_calls = {'sync': 'foo'}
+    cl.clean_thread('foo')
+    assert cl.coalesced_api_calls == {}
+
+
 def test_Client_login(homedir, config, mocker):
     """
     Ensures the API is called in the expected manner for logging in the user
@@ -266,12 +371,15 @@ def test_Client_on_authenticate_ok(homedir, config, mocker):
     cl = Client('http://localhost', mock_gui, mock_session, homedir)
     cl.sync_api = mocker.MagicMock()
     cl.api = mocker.MagicMock()
-    cl.start_message_thread = mocker.MagicMock()
-    cl.start_reply_thread = mocker.MagicMock()
+    cl.start_download_thread = mocker.MagicMock()
+    cl.start_purge_thread = mocker.MagicMock()
+    cl.start_post_sync_thread = mocker.MagicMock()
     cl.api.username = 'test'
     cl.on_authenticate(True)
-    cl.sync_api.assert_called_once_with()
-    cl.start_message_thread.assert_called_once_with()
+    cl.sync_api.assert_called_once_with(full=True)
+    cl.start_download_thread.assert_called_once_with()
+    cl.start_purge_thread.assert_called_once_with()
+    cl.start_post_sync_thread.assert_called_once_with()
     cl.gui.set_logged_in_as.assert_called_once_with('test')
     # Error status bar should be cleared
     cl.gui.update_error_status.assert_called_once_with("")
@@ -291,16 +399,18 @@ def test_Client_completed_api_call_without_current_object(homedir, config, mocke
     mock_runner.result = 'result'
     mock_runner.current_object = None
     mock_timer = mocker.MagicMock()
+    mock_user_callback = mocker.MagicMock()
     cl.api_threads = {
         'thread_uuid': {
             'thread': mock_thread,
             'runner': mock_runner,
             'timer': mock_timer,
+            'callbacks': [mock_user_callback],
+            'timeouts': [],
         }
     }
     cl.clean_thread = mocker.MagicMock()
-    mock_user_callback = mocker.MagicMock()
-    cl.completed_api_call('thread_uuid', mock_user_callback)
+    cl.completed_api_call('thread_uuid')
     cl.clean_thread.assert_called_once_with('thread_uuid')
     mock_user_callback.assert_called_once_with('result')
     mock_timer.stop.assert_called_once_with()
@@ -320,16 +430,18 @@ def test_Client_completed_api_call_with_current_object(homedir, config, mocker):
     mock_runner.result = 'result'
     mock_runner.current_object = 'current_object'
     mock_timer = mocker.MagicMock()
+    mock_user_callback = mocker.MagicMock()
     cl.api_threads = {
         'thread_uuid': {
             'thread': mock_thread,
             'runner': mock_runner,
             'timer': mock_timer,
+            'callbacks': [mock_user_callback],
+            'timeouts': [],
         }
     }
     cl.clean_thread = mocker.MagicMock()
-    mock_user_callback = mocker.MagicMock()
-    cl.completed_api_call('thread_uuid', mock_user_callback)
+    cl.completed_api_call('thread_uuid')
     cl.clean_thread.assert_called_once_with('thread_uuid')
     mock_user_callback.assert_called_once_with('result',
                                                current_object='current_object')
@@ -347,18 +459,21 @@ def test_Client_timeout_cleanup_without_current_object(homedir, config, mocker):
     mock_thread = mocker.MagicMock()
     mock_runner = mocker.MagicMock()
     mock_runner.current_object = None
+    mock_runner.time_out.return_value = False
     mock_timer = mocker.MagicMock()
+    mock_user_callback = mocker.MagicMock()
     cl.api_threads = {
         'thread_uuid': {
             'thread': mock_thread,
             'runner': mock_runner,
             'timer': mock_timer,
+            'callbacks': [],
+            'timeouts': [mock_user_callback],
         }
     }
     cl.clean_thread = mocker.MagicMock()
-    mock_user_callback = mocker.MagicMock()
-    cl.timeout_cleanup('thread_uuid', mock_user_callback)
-    assert mock_runner.i_timed_out is True
+    cl.timeout_cleanup('thread_uuid')
+    mock_runner.time_out.assert_called_once_with()
     cl.clean_thread.assert_called_once_with('thread_uuid')
     mock_user_callback.assert_called_once_with()
 
@@ -374,22 +489,144 @@ def test_Client_timeout_cleanup_with_current_object(homedir, config, mocker):
     mock_thread = mocker.MagicMock()
     mock_runner = mocker.MagicMock()
     mock_runner.current_object = 'current_object'
+    mock_runner.time_out.return_value = False
     mock_timer = mocker.MagicMock()
+    mock_user_callback = mocker.MagicMock()
     cl.api_threads = {
         'thread_uuid': {
             'thread': mock_thread,
             'runner': mock_runner,
             'timer': mock_timer,
+            'callbacks': [],
+            'timeouts': [mock_user_callback],
         }
     }
     cl.clean_thread = mocker.MagicMock()
-    mock_user_callback = mocker.MagicMock()
-    cl.timeout_cleanup('thread_uuid', mock_user_callback)
-    assert mock_runner.i_timed_out is True
+    cl.timeout_cleanup('thread_uuid')
+    mock_runner.time_out.assert_called_once_with()
     cl.clean_thread.assert_called_once_with('thread_uuid')
     mock_user_callback.assert_called_once_with(current_object='current_object')
 
 
+def test_Client_timeout_cleanup_while_running(homedir, config, mocker):
+    """
+    If an API call times out while the API is still being called, another
+    thread is allowed in the pool until it returns. Till then, the call stays
+    in progress, so is attached to rather than made again, and only the
+    callbacks attached since it timed out get its result.
+    Using the `config` fixture to ensure the config is written to disk.
+    """
+    mock_gui = mocker.MagicMock()
+    mock_session = mocker.MagicMock()
+    cl = Client('http://localhost', mock_gui, mock_session, homedir)
+    cl.api_pool = mocker.MagicMock()
+    cl.api_pool.maxThreadCount.return_value = MAX_CONCURRENT_API_CALLS
+    mocker.patch('securedrop_client.logic.APICallRunner')
+    mocker.patch('securedrop_client.logic.QTimer')
+    callback_1 = mocker.MagicMock()
+    callback_2 = mocker.MagicMock()
+    timeout_1 = mocker.MagicMock()
+    timeout_2 = mocker.MagicMock()
+
+    cl.call_api(mocker.MagicMock(), callback_1, timeout_1, coalesce_key='sync')
+    thread_id = cl.coalesced_api_calls['sync']
+    thread_info = cl.api_threads[thread_id]
+    thread_info['runner'].current_object = None
+    thread_info['runner'].time_out.return_value = True
+    thread_info['timer'].isActive.return_value = False
+
+    cl.timeout_cleanup(thread_id)
+    timeout_1.assert_called_once_with()
+    cl.api_pool.setMaxThreadCount.assert_called_once_with(MAX_CONCURRENT_API_CALLS + 1)
+    assert cl.coalesced_api_calls == {'sync': thread_id}
+
+    cl.call_api(mocker.MagicMock(), callback_2, timeout_2, coalesce_key='sync')
+    assert cl.api_pool.start.call_count == 1
+    thread_info['timer'].start.assert_called_with(20000)
+    assert thread_info['callbacks'] == [callback_2]
+    assert thread_info['timeouts'] == [timeout_2]
+
+    thread_info['runner'].result = 'result'
+    cl.completed_api_call(thread_id)
+    cl.api_pool.setMaxThreadCount.assert_called_with(MAX_CONCURRENT_API_CALLS - 1)
+    assert cl.api_threads == {}
+    assert cl.coalesced_api_calls == {}
+    callback_1.assert_not_called()
+    callback_2.assert_called_once_with('result')
+    timeout_2.assert_not_called()
+
+
+def test_Client_timeout_cleanup_timed_out_again(homedir, config, mocker):
+    """
+    If a call attached to an API call which timed out times out too, its
+    timeouts are called, and no more threads are allowed in the pool.
+    Using the `config` fixture to ensure the config is written to disk.
+    """
+    mock_gui = mocker.MagicMock()
+    mock_session = mocker.MagicMock()
+    cl = Client('http://localhost', mock_gui, mock_session, homedir)
+    cl.api_pool = mocker.MagicMock()
+    mock_runner = mocker.MagicMock()
+    mock_runner.current_object = None
+    mock_user_callback = mocker.MagicMock()
+    mock_user_timeout = mocker.MagicMock()
+    cl.api_threads = {
+        'thread_uuid': {
+            'runner': mock_runner,
+            'timer': mocker.MagicMock(),
+            'callbacks': [mock_user_callback],
+            'timeouts': [mock_user_timeout],
+            'coalesce_key': 'sync',
+            'timed_out': True,
+        }
+    }
+    cl.coalesced_api_calls = {'sync': 'thread_uuid'}
+    cl.timeout_cleanup('thread_uuid')
+    mock_user_timeout.assert_called_once_with()
+    mock_runner.time_out.assert_not_called()
+    cl.api_pool.setMaxThreadCount.assert_not_called()
+    assert cl.api_threads['thread_uuid']['callbacks'] == []
+    assert cl.coalesced_api_calls == {'sync': 'thread_uuid'}
+
+
+def test_Client_call_api_timed_out_frees_thread(homedir, config, mocker):
+    """
+    API calls which time out while the API hangs no longer hold up the other
+    calls, and their threads are given back once the API returns.
+    Using the `config` fixture to ensure the config is written to disk.
+    """
+    app = QCoreApplication.instance() or QCoreApplication([])
+    mock_gui = mocker.MagicMock()
+    mock_session = mocker.MagicMock()
+    cl = Client('http://localhost', mock_gui, mock_session, homedir)
+    started = threading.Semaphore(0)
+    release = threading.Event()
+
+    def hang():
+        started.release()
+        release.wait(10)
+
+    for i in range(MAX_CONCURRENT_API_CALLS):
+        cl.call_api(hang, mocker.MagicMock(), mocker.MagicMock())
+    for i in range(MAX_CONCURRENT_API_CALLS):
+        assert started.acquire(timeout=5)
+    for thread_id in list(cl.api_threads):
+        cl.timeout_cleanup(thread_id)
+
+    # Every thread of the pool is blocked, yet a new call is made.
+    called = threading.Event()
+    mock_callback = mocker.MagicMock()
+    cl.call_api(called.set, mock_callback, mocker.MagicMock())
+    assert called.wait(5)
+
+    release.set()
+    assert cl.api_pool.waitForDone(5000)
+    app.processEvents()
+    assert cl.api_pool.maxThreadCount() == MAX_CONCURRENT_API_CALLS
+    assert cl.api_threads == {}
+    mock_callback.assert_called_once_with(None)
+
+
 def test_Client_on_sync_timeout(homedir, config, mocker):
     """
     Display error message in status bar if sync times out.
@@ -500,32 +737,89 @@ def test_Client_sync_api(homedir, config, mocker):
     cl.call_api = mocker.MagicMock()
     cl.sync_api()
     cl.call_api.assert_called_once_with(storage.get_remote_data, cl.on_synced,
-                                        cl.on_sync_timeout, cl.api)
+                                        cl.on_sync_timeout, cl.api, None,
+                                        on_source_fetched=mocker.ANY,
+                                        coalesce_key='sync')
 
+    # Fetched sources are handed over to the post sync thread via a signal.
+    cl.source_fetched = mocker.MagicMock()
+    cl.sync_api()
+    on_source_fetched = cl.call_api.call_args[1]['on_source_fetched']
+    assert on_source_fetched == cl.source_fetched.emit
 
-def test_Client_on_synced_remove_stale_sources(homedir, config, mocker):
+
+def test_Client_sync_api_incremental(homedir, config, mocker):
     """
-    On an API sync, if a source no longer exists, remove it from the GUI.
+    Once there has been a sync, only sources which changed since are synced,
+    based on the last_updated timestamps in local storage.
+    Using the `config` fixture to ensure the config is written to disk.
+    """
+    mock_gui = mocker.MagicMock()
+    mock_session = mocker.MagicMock()
+    cl = Client('http://localhost', mock_gui, mock_session, homedir)
+    cl.authenticated = mocker.MagicMock(return_value=True)
+    cl.last_sync = mocker.MagicMock(return_value=arrow.now())
+    cl.call_api = mocker.MagicMock()
+    source = factory.Source()
+    mock_storage = mocker.patch('securedrop_client.logic.storage')
+    mock_storage.get_local_sources.return_value = [source]
+    cl.sync_api()
+    last_updated = {source.uuid: source.last_updated}
+    cl.call_api.assert_called_once_with(mock_storage.get_remote_data,
+                                        cl.on_synced, cl.on_sync_timeout,
+                                        cl.api, last_updated,
+                                        on_source_fetched=mocker.ANY,
+                                        coalesce_key='sync')
+
+
+def test_Client_sync_api_full(homedir, config, mocker):
+    """
+    A full sync fetches the submissions of every source.
+    Using the `config` fixture to ensure the config is written to disk.
+    """
+    mock_gui = mocker.MagicMock()
+    mock_session = mocker.MagicMock()
+    cl = Client('http://localhost', mock_gui, mock_session, homedir)
+    cl.authenticated = mocker.MagicMock(return_value=True)
+    cl.last_sync = mocker.MagicMock(return_value=arrow.now())
+    cl.call_api = mocker.MagicMock()
+    cl.sync_api(full=True)
+    cl.call_api.assert_called_once_with(storage.get_remote_data, cl.on_synced,
+                                        cl.on_sync_timeout, cl.api, None,
+                                        on_source_fetched=mocker.ANY,
+                                        coalesce_key='full sync')
+
+
+def test_Client_on_post_sync_done(homedir, config, mocker):
+    """
+    Once the result of a sync is stored, the files of deleted records are
+    purged, new items are downloaded and the UI is updated. If a source no
+    longer exists, it is removed from the GUI.
     Using the `config` fixture to ensure the config is written to disk.
     """
     mock_source_id = 'abc123'
     mock_conv_wrapper = 'mock'
 
     gui = mocker.Mock()
-    gui.conversations = {mock_source_id: mock_conv_wrapper}
+    gui.conversations = {mock_source_id: mock_conv_wrapper, 'def456': mock_conv_wrapper}
 
     mock_session = mocker.MagicMock()
     cl = Client('http://localhost', gui, mock_session, homedir)
+    cl.purge_requested = mocker.MagicMock()
+    cl.downloads_requested = mocker.MagicMock()
+    cl.update_conversation_views = mocker.MagicMock()
+    cl.update_sources = mocker.MagicMock()
 
-    mock_source = mocker.Mock()
-    mock_source.uuid = mock_source_id
-
-    # not that the first item does *not* have the mock_source
-    api_res = ([], mocker.MagicMock(), mocker.MagicMock())
-    cl.on_synced(api_res)
+    cl.on_post_sync_done(['def456'], ['deleted-file'], {'def456'})
 
     # check that the uuid is not longer in the dict
     assert mock_source_id not in gui.conversations
+    assert 'def456' in gui.conversations
+    cl.purge_requested.emit.assert_called_once_with(['deleted-file'])
+    cl.downloads_requested.emit.assert_called_once_with()
+    mock_session.expire_all.assert_not_called()
+    cl.update_conversation_views.assert_called_once_with({'def456'})
+    cl.update_sources.assert_called_once_with({'def456'})
 
 
 def test_Client_last_sync_with_file(homedir, config, mocker):
@@ -567,111 +861,164 @@ def test_Client_on_synced_no_result(homedir, config, mocker):
     mock_session = mocker.MagicMock()
     cl = Client('http://localhost', mock_gui, mock_session, homedir)
     cl.update_sources = mocker.MagicMock()
+    cl.post_sync_requested = mocker.MagicMock()
     result_data = Exception('Boom')  # Not the expected tuple.
-    mock_storage = mocker.patch('securedrop_client.logic.storage')
     cl.on_synced(result_data)
-    assert mock_storage.update_local_storage.call_count == 0
+    cl.post_sync_requested.emit.assert_not_called()
     cl.update_sources.assert_called_once_with()
 
 
 def test_Client_on_synced_with_result(homedir, config, mocker):
     """
-    If there's a result to syncing, then update local storage.
+    If there's a result to syncing, then update local storage in the
+    background.
     Using the `config` fixture to ensure the config is written to disk.
     """
     mock_gui = mocker.MagicMock()
     mock_session = mocker.MagicMock()
     cl = Client('http://localhost', mock_gui, mock_session, homedir)
     cl.update_sources = mocker.MagicMock()
-    cl.api_runner = mocker.MagicMock()
-    cl.gpg = mocker.MagicMock()
+    cl.post_sync_requested = mocker.MagicMock()
 
-    result_data = ('sources', 'submissions', 'replies')
+    result_data = (['source'], 'submissions', 'replies')
 
-    cl.update_sources = mocker.MagicMock()
-    cl.api_runner = mocker.MagicMock()
+    cl.on_synced(result_data)
+    cl.post_sync_requested.emit.assert_called_once_with(['source'], 'submissions', 'replies')
+    cl.update_sources.assert_not_called()
 
-    mock_source = mocker.MagicMock()
-    mock_source.key = {
-        'type': 'PGP',
-        'public': PUB_KEY,
-    }
 
-    mock_sources = [mock_source]
+def test_Client_on_synced_resync_requested(homedir, config, mocker):
+    """
+    If changes were made on the server during the sync, sync again.
+    Using the `config` fixture to ensure the config is written to disk.
+    """
+    mock_gui = mocker.MagicMock()
+    mock_session = mocker.MagicMock()
+    cl = Client('http://localhost', mock_gui, mock_session, homedir)
+    cl.sync_api = mocker.MagicMock()
+    cl.post_sync_requested = mocker.MagicMock()
+    cl.resync_requested = True
 
-    result_data = (mock_sources, 'submissions', 'replies')
+    cl.on_synced((['source'], 'submissions', 'replies'))
+    cl.sync_api.assert_called_once_with()
+    assert cl.resync_requested is False
 
-    cl.call_reset = mocker.MagicMock()
-    mock_storage = mocker.patch('securedrop_client.logic.storage')
-    cl.on_synced(result_data)
-    mock_storage.update_local_storage. \
-        assert_called_once_with(mock_session, mock_sources, "submissions",
-                                "replies",
-                                os.path.join(homedir, 'data'))
+    cl.on_synced((['source'], 'submissions', 'replies'))
+    assert cl.sync_api.call_count == 1
 
-    cl.update_sources.assert_called_once_with()
+
+def test_Client_request_sync(homedir, config, mocker):
+    """
+    Requests for a sync restart the debounce timer, so that requests in quick
+    succession lead to a single sync.
+    Using the `config` fixture to ensure the config is written to disk.
+    """
+    mock_gui = mocker.MagicMock()
+    mock_session = mocker.MagicMock()
+    cl = Client('http://localhost', mock_gui, mock_session, homedir)
+    cl.sync_debounce = mocker.MagicMock()
+    cl.request_sync()
+    cl.request_sync()
+    cl.sync_debounce.start.assert_called_with(SYNC_DEBOUNCE)
+    assert cl.sync_debounce.start.call_count == 2
 
 
-def test_Client_on_synced_with_non_pgp_key(homedir, config, mocker):
+def test_Client_sync_after_changes(homedir, config, mocker):
     """
-    If there's a result to syncing, then update local storage.
-    This is it to check that we can gracefully handle missing keys.
+    Once the debounce timer fires, sync if no sync is in progress.
     Using the `config` fixture to ensure the config is written to disk.
     """
     mock_gui = mocker.MagicMock()
     mock_session = mocker.MagicMock()
     cl = Client('http://localhost', mock_gui, mock_session, homedir)
-    cl.update_sources = mocker.MagicMock()
-    cl.api_runner = mocker.MagicMock()
+    cl.sync_api = mocker.MagicMock()
+    cl.sync_after_changes()
+    cl.sync_api.assert_called_once_with()
+    assert cl.resync_requested is False
 
-    mock_source = mocker.MagicMock()
-    mock_source.key = {
-        'type': 'PGP',
-    }
 
-    mock_sources = [mock_source]
-    result_data = (mock_sources, 'submissions', 'replies')
+def test_Client_sync_after_changes_sync_in_progress(homedir, config, mocker):
+    """
+    A sync in progress may have started before the changes were made, so
+    sync again once it is done. It is attached to, so that on_synced is called
+    even if it timed out.
+    Using the `config` fixture to ensure the config is written to disk.
+    """
+    mock_gui = mocker.MagicMock()
+    mock_session = mocker.MagicMock()
+    cl = Client('http://localhost', mock_gui, mock_session, homedir)
+    cl.sync_api = mocker.MagicMock()
+    cl.coalesced_api_calls = {'sync': 'thread_uuid'}
+    cl.sync_after_changes()
+    cl.sync_api.assert_called_once_with(full=False)
+    assert cl.resync_requested is True
 
-    cl.call_reset = mocker.MagicMock()
-    mock_storage = mocker.patch('securedrop_client.logic.storage')
-    cl.on_synced(result_data)
-    mock_storage.update_local_storage. \
-        assert_called_once_with(mock_session, mock_sources, "submissions",
-                                "replies",
-                                os.path.join(homedir, 'data'))
-    cl.update_sources.assert_called_once_with()
 
+def test_Client_sync_after_changes_full_sync_in_progress(homedir, config, mocker):
+    """
+    A full sync in progress is attached to rather than a new sync started
+    alongside it.
+    Using the `config` fixture to ensure the config is written to disk.
+    """
+    mock_gui = mocker.MagicMock()
+    mock_session = mocker.MagicMock()
+    cl = Client('http://localhost', mock_gui, mock_session, homedir)
+    cl.sync_api = mocker.MagicMock()
+    cl.coalesced_api_calls = {'full sync': 'thread_uuid'}
+    cl.sync_after_changes()
+    cl.sync_api.assert_called_once_with(full=True)
+    assert cl.resync_requested is True
 
-def test_Client_on_synced_with_key_import_fail(homedir, config, mocker):
+
+def test_Client_source_fetched_stored_in_post_sync(homedir, config, mocker):
     """
-    If there's a result to syncing, then update local storage.
-    This is it to check that we can gracefully handle an import failure.
+    The sources fetched during a sync are stored in the post sync thread, not
+    in the GUI thread.
     Using the `config` fixture to ensure the config is written to disk.
     """
+    mocker.patch('securedrop_client.logic.PostSync')
     mock_gui = mocker.MagicMock()
     mock_session = mocker.MagicMock()
     cl = Client('http://localhost', mock_gui, mock_session, homedir)
-    cl.update_sources = mocker.MagicMock()
-    cl.api_runner = mocker.MagicMock()
+    cl.post_sync.source_stored.connect.assert_called_once_with(cl.on_source_stored)
+    assert cl.receivers(cl.source_fetched) == 1
 
-    mock_source = mocker.MagicMock()
-    mock_source.key = {
-        'type': 'PGP',
-        'public': PUB_KEY,
-    }
 
-    mock_sources = [mock_source]
-    result_data = (mock_sources, 'submissions', 'replies')
+def test_Client_on_source_stored(homedir, config, mocker):
+    """
+    As each source fetched during a sync is stored, the files of its deleted
+    submissions are purged, its new ones downloaded and the progress of the
+    sync is reported.
+    Using the `config` fixture to ensure the config is written to disk.
+    """
+    mock_gui = mocker.MagicMock()
+    mock_session = mocker.MagicMock()
+    cl = Client('http://localhost', mock_gui, mock_session, homedir)
+    cl.sync_progress = mocker.MagicMock()
+    cl.purge_requested = mocker.MagicMock()
+    cl.downloads_requested = mocker.MagicMock()
+    cl.on_source_stored(['deleted-file'], True, 1, 2)
+    cl.sync_progress.emit.assert_called_once_with(1, 2)
+    cl.purge_requested.emit.assert_called_once_with(['deleted-file'])
+    cl.downloads_requested.emit.assert_called_once_with()
+    mock_session.commit.assert_not_called()
 
-    cl.call_reset = mocker.MagicMock()
-    mock_storage = mocker.patch('securedrop_client.logic.storage')
-    mocker.patch.object(cl.gpg, 'import_key', side_effect=CryptoError)
-    cl.on_synced(result_data)
-    mock_storage.update_local_storage. \
-        assert_called_once_with(mock_session, mock_sources, "submissions",
-                                "replies",
-                                os.path.join(homedir, 'data'))
-    cl.update_sources.assert_called_once_with()
+
+def test_Client_on_source_stored_no_submissions(homedir, config, mocker):
+    """
+    If a source stored during a sync has no submissions, there is nothing new
+    to download.
+    Using the `config` fixture to ensure the config is written to disk.
+    """
+    mock_gui = mocker.MagicMock()
+    mock_session = mocker.MagicMock()
+    cl = Client('http://localhost', mock_gui, mock_session, homedir)
+    cl.sync_progress = mocker.MagicMock()
+    cl.purge_requested = mocker.MagicMock()
+    cl.downloads_requested = mocker.MagicMock()
+    cl.on_source_stored([], False, 1, 2)
+    cl.downloads_requested.emit.assert_not_called()
+    cl.sync_progress.emit.assert_called_once_with(1, 2)
 
 
 def test_Client_update_sync(homedir, config, mocker):
@@ -705,6 +1052,42 @@ def test_Client_update_sources(homedir, config, mocker):
     mock_gui.show_sources.assert_called_once_with(source_list)
 
 
+def test_Client_update_sources_changed(homedir, config, mocker):
+    """
+    Ensure only the sources changed by a sync are read again and redrawn.
+    Using the `config` fixture to ensure the config is written to disk.
+    """
+    mock_gui = mocker.MagicMock()
+    mock_session = mocker.MagicMock()
+    cl = Client('http://localhost', mock_gui, mock_session, homedir)
+    mock_storage = mocker.patch('securedrop_client.logic.storage')
+    source = factory.Source()
+    mock_storage.get_local_sources.return_value = [source]
+    cl.update_sources({source.uuid, 'deleted-uuid'})
+    mock_storage.get_local_sources.assert_called_once_with(
+        mock_session, {source.uuid, 'deleted-uuid'})
+    mock_session.refresh.assert_called_once_with(source)
+    mock_gui.show_changed_sources.assert_called_once_with(
+        [source], {source.uuid, 'deleted-uuid'})
+    mock_gui.show_sources.assert_not_called()
+
+
+def test_Client_update_sources_none_changed(homedir, config, mocker):
+    """
+    If no source changed, the list of sources is left as it is.
+    Using the `config` fixture to ensure the config is written to disk.
+    """
+    mock_gui = mocker.MagicMock()
+    mock_session = mocker.MagicMock()
+    cl = Client('http://localhost', mock_gui, mock_session, homedir)
+    mock_storage = mocker.patch('securedrop_client.logic.storage')
+    cl.update_sources(set())
+    mock_storage.get_local_sources.assert_not_called()
+    mock_gui.show_changed_sources.assert_not_called()
+    mock_gui.show_sources.assert_not_called()
+    mock_gui.show_sync.assert_called_once_with(cl.last_sync())
+
+
 def test_Client_update_conversation_views(homedir, config, mocker):
     """
     Ensure the UI displays the latest version of the messages/replies that
@@ -732,6 +1115,27 @@ def test_Client_update_conversation_views(homedir, config, mocker):
     assert mock_update_conversation.called
 
 
+def test_Client_update_conversation_views_changed(homedir, config, mocker):
+    """
+    Ensure only the conversation views of the given sources are updated, with
+    their messages and replies read again.
+    Using the `config` fixture to ensure the config is written to disk.
+    """
+    mock_gui = mocker.Mock()
+    changed_wrapper = mocker.Mock()
+    unchanged_wrapper = mocker.Mock()
+    mock_gui.conversations = {'changed': changed_wrapper, 'unchanged': unchanged_wrapper}
+    mock_session = mocker.MagicMock()
+    cl = Client('http://localhost', mock_gui, mock_session, homedir)
+    cl.update_conversation_views({'changed'})
+    conv = changed_wrapper.conversation
+    mock_session.refresh.assert_called_once_with(conv.source)
+    mock_session.query.assert_any_call(db.Submission)
+    mock_session.query.assert_any_call(db.Reply)
+    conv.update_conversation.assert_called_once_with(conv.source.collection)
+    unchanged_wrapper.conversation.update_conversation.assert_not_called()
+
+
 def test_Client_unstars_a_source_if_starred(homedir, config, mocker):
     """
     Ensure that the client unstars a source if it is starred.
@@ -819,7 +1223,7 @@ def test_Client_sidebar_action_timeout(homedir, config, mocker):
 
 def test_Client_on_update_star_success(homedir, config, mocker):
     """
-    If the starring occurs successfully, then a sync should occur to update
+    If the starring occurs successfully, then a sync is requested to update
     locally.
     Using the `config` fixture to ensure the config is written to disk.
     """
@@ -828,9 +1232,9 @@ def test_Client_on_update_star_success(homedir, config, mocker):
     cl = Client('http://localhost', mock_gui, mock_session, homedir)
     result = True
     cl.call_reset = mocker.MagicMock()
-    cl.sync_api = mocker.MagicMock()
+    cl.request_sync = mocker.MagicMock()
     cl.on_update_star_complete(result)
-    cl.sync_api.assert_called_once_with()
+    cl.request_sync.assert_called_once_with()
     mock_gui.update_error_status.assert_called_once_with("")
 
 
@@ -855,21 +1259,18 @@ def test_Client_on_update_star_failed(homedir, config, mocker):
 def test_Client_logout(homedir, config, mocker):
     """
     The API is reset to None and the UI is set to logged out state.
-    The message and reply threads should also have the
+    The download queue should also have its API reset.
     Using the `config` fixture to ensure the config is written to disk.
     """
     mock_gui = mocker.MagicMock()
     mock_session = mocker.MagicMock()
     cl = Client('http://localhost', mock_gui, mock_session, homedir)
     cl.api = mocker.MagicMock()
-    cl.message_sync = mocker.MagicMock()
-    cl.reply_sync = mocker.MagicMock()
-    cl.message_sync.api = mocker.MagicMock()
-    cl.reply_sync.api = mocker.MagicMock()
+    cl.download_queue = mocker.MagicMock()
+    cl.download_queue.api = mocker.MagicMock()
     cl.logout()
     assert cl.api is None
-    assert cl.message_sync.api is None
-    assert cl.reply_sync.api is None
+    assert cl.download_queue.api is None
     cl.gui.logout.assert_called_once_with()
 
 
@@ -942,8 +1343,7 @@ def test_create_client_dir_permissions(tmpdir, mocker):
 
 def test_Client_on_file_download_Submission(homedir, config, mocker):
     """
-    If the handler is passed a submission, check the download_submission
-    function is the one called against the API.
+    If the handler is passed a submission, it is added to the download queue.
     Using the `config` fixture to ensure the config is written to disk.
     """
     mock_gui = mocker.MagicMock()
@@ -952,155 +1352,128 @@ def test_Client_on_file_download_Submission(homedir, config, mocker):
     source = factory.Source()
     submission = db.Submission(source, 'submission-uuid', 1234,
                                'myfile.doc.gpg', 'http://myserver/myfile')
-    cl.call_api = mocker.MagicMock()
     cl.api = mocker.MagicMock()
-    submission_sdk_object = mocker.MagicMock()
-    mock_submission = mocker.patch('sdclientapi.Submission')
-    mock_submission.return_value = submission_sdk_object
+    cl.set_status = mocker.MagicMock()
+    cl.file_download_requested = mocker.MagicMock()
     cl.on_file_download(source, submission)
-    cl.call_api.assert_called_once_with(
-        cl.api.download_submission, cl.on_file_downloaded,
-        cl.on_download_timeout, submission_sdk_object,
-        cl.data_dir, current_object=submission)
+    cl.set_status.assert_called_once_with('Downloading myfile.doc.gpg')
+    download = cl.file_download_requested.emit.call_args[0][0]
+    assert download.kind == 'file'
+    assert download.uuid == 'submission-uuid'
+    assert download.source_uuid == source.uuid
+    assert download.filename == 'myfile.doc.gpg'
 
 
-def test_Client_on_file_downloaded_success(homedir, config, mocker):
-    '''
+def test_Client_on_file_download_Reply(homedir, config, mocker):
+    """
+    If the handler is passed a reply, it is added to the download queue.
     Using the `config` fixture to ensure the config is written to disk.
-    '''
+    """
     mock_gui = mocker.MagicMock()
     mock_session = mocker.MagicMock()
     cl = Client('http://localhost', mock_gui, mock_session, homedir)
-    cl.update_sources = mocker.MagicMock()
-    cl.api_runner = mocker.MagicMock()
-    test_filename = "my-file-location-msg.gpg"
-    test_object_uuid = 'uuid-of-downloaded-object'
-    cl.call_reset = mocker.MagicMock()
-    result_data = ('this-is-a-sha256-sum', test_filename)
-    submission_db_object = mocker.MagicMock()
-    submission_db_object.uuid = test_object_uuid
-    submission_db_object.filename = test_filename
-    mock_storage = mocker.patch('securedrop_client.logic.storage')
-    mock_gpg = mocker.patch.object(cl.gpg, 'decrypt_submission_or_reply', return_value='filepath')
-    mocker.patch('shutil.move')
-    cl.on_file_downloaded(result_data, current_object=submission_db_object)
-    mock_gpg.call_count == 1
-    mock_storage.mark_file_as_downloaded.assert_called_once_with(
-        test_object_uuid, mock_session)
+    source = factory.Source()
+    journalist = db.User('Testy mcTestface')
+    reply = db.Reply('reply-uuid', journalist, source,
+                     'my-reply.gpg', 123)  # Not a sdclientapi.Submission
+    cl.api = mocker.MagicMock()
+    cl.file_download_requested = mocker.MagicMock()
+    cl.on_file_download(source, reply)
+    download = cl.file_download_requested.emit.call_args[0][0]
+    assert download.kind == 'reply'
+    assert download.uuid == 'reply-uuid'
 
 
-def test_Client_on_file_downloaded_api_failure(homedir, config, mocker):
-    '''
+def test_Client_on_file_download_user_not_signed_in(homedir, config, mocker):
+    """
+    If a user clicks the download button but is not logged in,
+    an error should appear.
     Using the `config` fixture to ensure the config is written to disk.
-    '''
+    """
     mock_gui = mocker.MagicMock()
     mock_session = mocker.MagicMock()
     cl = Client('http://localhost', mock_gui, mock_session, homedir)
-    cl.update_sources = mocker.MagicMock()
-    cl.api_runner = mocker.MagicMock()
-    test_filename = "my-file-location-msg.gpg"
-    cl.api_runner.result = ("", test_filename)
-    cl.call_reset = mocker.MagicMock()
-    cl.set_status = mocker.MagicMock()
-    result_data = Exception('error message')
-    submission_db_object = mocker.MagicMock()
-    submission_db_object.uuid = 'myuuid'
-    submission_db_object.filename = 'filename'
-    cl.on_file_downloaded(result_data, current_object=submission_db_object)
-    cl.set_status.assert_called_once_with(
-        "The file download failed. Please try again.")
+    source = factory.Source()
+    submission = db.Submission(source, 'submission-uuid', 1234,
+                               'myfile.doc.gpg', 'http://myserver/myfile')
+    cl.on_action_requiring_login = mocker.MagicMock()
+    cl.file_download_requested = mocker.MagicMock()
+    cl.api = None
+    cl.on_file_download(source, submission)
+    cl.on_action_requiring_login.assert_called_once_with()
+    cl.file_download_requested.emit.assert_not_called()
 
 
-def test_Client_on_file_downloaded_decrypt_failure(homedir, config, mocker):
-    '''
+def test_Client_set_download_priorities(homedir, config, mocker):
+    """
+    The sources the user is looking at are passed on to the download queue.
     Using the `config` fixture to ensure the config is written to disk.
-    '''
+    """
+    mock_gui = mocker.MagicMock()
+    mock_session = mocker.MagicMock()
+    cl = Client('http://localhost', mock_gui, mock_session, homedir)
+    cl.download_priorities_changed = mocker.MagicMock()
+    cl.set_download_priorities('selected-uuid', ['visible-uuid'])
+    cl.download_priorities_changed.emit.assert_called_once_with('selected-uuid',
+                                                                ['visible-uuid'])
+
+
+def test_Client_on_file_downloaded(homedir, config, mocker):
+    """
+    Once the download queue has downloaded a file, it is reloaded from the
+    database and the user is told.
+    Using the `config` fixture to ensure the config is written to disk.
+    """
     mock_gui = mocker.MagicMock()
     mock_session = mocker.MagicMock()
     cl = Client('http://localhost', mock_gui, mock_session, homedir)
-    cl.update_sources = mocker.MagicMock()
-    cl.api_runner = mocker.MagicMock()
-    test_filename = "my-file-location-msg.gpg"
-    cl.api_runner.result = ("", test_filename)
     cl.set_status = mocker.MagicMock()
-    result_data = ('this-is-a-sha256-sum', test_filename)
-    submission_db_object = mocker.MagicMock()
-    submission_db_object.uuid = 'myuuid'
-    submission_db_object.filename = 'filename'
-    mock_gpg = mocker.patch.object(cl.gpg, 'decrypt_submission_or_reply',
-                                   side_effect=CryptoError())
-    mocker.patch('shutil.move')
-
-    cl.on_file_downloaded(result_data, current_object=submission_db_object)
-    mock_gpg.call_count == 1
+    cl.on_file_downloaded('myuuid', 'my-file-location-doc.gz.gpg')
+    mock_submission = mock_session.query().filter_by().one_or_none()
+    mock_session.refresh.assert_called_once_with(mock_submission)
     cl.set_status.assert_called_once_with(
-        "Failed to download and decrypt file, please try again.")
+        'Finished downloading my-file-location-doc.gz.gpg')
 
 
-def test_Client_on_file_download_user_not_signed_in(homedir, config, mocker):
+def test_Client_on_file_downloaded_deleted(homedir, config, mocker):
     """
-    If a user clicks the download button but is not logged in,
-    an error should appear.
+    If the file was deleted while it was downloading, there is nothing to
+    reload.
     Using the `config` fixture to ensure the config is written to disk.
     """
     mock_gui = mocker.MagicMock()
     mock_session = mocker.MagicMock()
+    mock_session.query().filter_by().one_or_none.return_value = None
     cl = Client('http://localhost', mock_gui, mock_session, homedir)
-    source = factory.Source()
-    submission = db.Submission(source, 'submission-uuid', 1234,
-                               'myfile.doc.gpg', 'http://myserver/myfile')
-    cl.on_action_requiring_login = mocker.MagicMock()
-    cl.api = None
-    submission_sdk_object = mocker.MagicMock()
-    mock_submission = mocker.patch('sdclientapi.Submission')
-    mock_submission.return_value = submission_sdk_object
-    cl.on_file_download(source, submission)
-    cl.on_action_requiring_login.assert_called_once_with()
+    cl.set_status = mocker.MagicMock()
+    cl.on_file_downloaded('myuuid', 'filename')
+    mock_session.refresh.assert_not_called()
 
 
-def test_Client_on_download_timeout(homedir, config, mocker):
+def test_Client_on_file_download_failed_api_failure(homedir, config, mocker):
     '''
     Using the `config` fixture to ensure the config is written to disk.
     '''
     mock_gui = mocker.MagicMock()
     mock_session = mocker.MagicMock()
     cl = Client('http://localhost', mock_gui, mock_session, homedir)
-    cl.update_sources = mocker.MagicMock()
-    cl.api_runner = mocker.MagicMock()
-    current_object = mocker.MagicMock()
-    test_filename = "my-file-location-msg.gpg"
-    cl.api_runner.result = ("", test_filename)
-    cl.call_reset = mocker.MagicMock()
     cl.set_status = mocker.MagicMock()
-    cl.on_download_timeout(current_object)
+    cl.on_file_download_failed('myuuid', 'filename', Exception('error message'))
     cl.set_status.assert_called_once_with(
-        "The connection to the SecureDrop server timed out. Please try again.")
+        "The file download failed. Please try again.")
 
 
-def test_Client_on_file_download_Reply(homedir, config, mocker):
-    """
-    If the handler is passed a reply, check the download_reply
-    function is the one called against the API.
+def test_Client_on_file_download_failed_decrypt_failure(homedir, config, mocker):
+    '''
     Using the `config` fixture to ensure the config is written to disk.
-    """
+    '''
     mock_gui = mocker.MagicMock()
     mock_session = mocker.MagicMock()
     cl = Client('http://localhost', mock_gui, mock_session, homedir)
-    source = factory.Source()
-    journalist = db.User('Testy mcTestface')
-    reply = db.Reply('reply-uuid', journalist, source,
-                     'my-reply.gpg', 123)  # Not a sdclientapi.Submission
-    cl.call_api = mocker.MagicMock()
-    cl.api = mocker.MagicMock()
-    reply_sdk_object = mocker.MagicMock()
-    mock_reply = mocker.patch('sdclientapi.Reply')
-    mock_reply.return_value = reply_sdk_object
-    cl.on_file_download(source, reply)
-    cl.call_api.assert_called_once_with(cl.api.download_reply,
-                                        cl.on_file_downloaded,
-                                        cl.on_download_timeout,
-                                        reply_sdk_object,
-                                        cl.data_dir, current_object=reply)
+    cl.set_status = mocker.MagicMock()
+    cl.on_file_download_failed('myuuid', 'filename', CryptoError())
+    cl.set_status.assert_called_once_with(
+        "Failed to download and decrypt file, please try again.")
 
 
 def test_Client_on_file_open(homedir, config, mocker):
@@ -1142,9 +1515,9 @@ def test_Client_on_delete_source_complete_with_results(homedir, config, mocker):
     mock_gui = mocker.MagicMock()
     mock_session = mocker.MagicMock()
     cl = Client('http://localhost', mock_gui, mock_session, homedir)
-    cl.sync_api = mocker.MagicMock()
+    cl.request_sync = mocker.MagicMock()
     cl._on_delete_source_complete(True)
-    cl.sync_api.assert_called_with()
+    cl.request_sync.assert_called_with()
     cl.gui.update_error_status.assert_called_with("")
 
 
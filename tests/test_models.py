@@ -1,5 +1,36 @@
 from tests import factory
-from securedrop_client.db import Reply, Submission, User
+import threading
+
+from securedrop_client.db import make_engine, make_session_maker, Reply, Submission, User
+
+
+def test_make_engine_pragmas(homedir):
+    engine = make_engine(homedir)
+    assert engine.execute('PRAGMA journal_mode').scalar() == 'wal'
+    assert engine.execute('PRAGMA synchronous').scalar() == 1  # NORMAL
+    assert engine.execute('PRAGMA busy_timeout').scalar() == 5000
+
+
+def test_make_session_maker(homedir):
+    """
+    There is one registry (and so one engine) per database, which gives each
+    thread its own session.
+    """
+    Session = make_session_maker(homedir)
+    assert make_session_maker(homedir) is Session
+
+    sessions = []
+    thread = threading.Thread(target=lambda: sessions.append(Session()))
+    thread.start()
+    thread.join()
+    assert Session() is Session()
+    assert sessions[0] is not Session()
+    assert sessions[0].bind is Session().bind
+
+
+def test_make_engine_without_pragmas(homedir):
+    engine = make_engine(homedir, pragmas=None)
+    assert engine.execute('PRAGMA journal_mode').scalar() == 'delete'
 
 
 def test_string_representation_of_user():
@@ -20,6 +51,18 @@ def test_string_representation_of_submission():
     submission.__repr__()
 
 
+def test_submission_kind():
+    source = factory.Source()
+    message = Submission(source=source, uuid="test", size=123,
+                         filename="1-test-msg.gpg",
+                         download_url='http://test/test')
+    document = Submission(source=source, uuid="test", size=123,
+                          filename="2-test-doc.gz.gpg",
+                          download_url='http://test/test')
+    assert message.kind == 'message'
+    assert document.kind == 'file'
+
+
 def test_string_representation_of_reply():
     user = User('hehe')
     source = factory.Source()
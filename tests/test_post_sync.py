@@ -0,0 +1,184 @@
+"""
+Make sure the work after a sync behaves as expected.
+"""
+import datetime
+import os
+
+from sdclientapi import Reply, Source
+
+from securedrop_client import db, storage
+from securedrop_client.crypto import CryptoError
+from securedrop_client.post_sync import PostSync
+from tests import factory
+
+
+def make_post_sync(homedir, mocker):
+    # don't create a GpgHelper because it will error on missing directories
+    mocker.patch('securedrop_client.post_sync.GpgHelper')
+    mocker.patch('securedrop_client.post_sync.make_session_maker')
+    post_sync = PostSync(homedir, False)
+    post_sync.post_sync_done = mocker.MagicMock()
+    post_sync.source_stored = mocker.MagicMock()
+    return post_sync
+
+
+def test_PostSync_store_source(homedir, mocker):
+    """
+    A source fetched during a sync is stored straight away and the GUI thread
+    told, so that it can purge and download its files.
+    """
+    post_sync = make_post_sync(homedir, mocker)
+    mock_storage = mocker.patch('securedrop_client.post_sync.storage')
+    source = mocker.MagicMock(uuid='source-uuid')
+
+    post_sync.store_source(source, ['submission'], 1, 2)
+
+    mock_storage.update_local_source.assert_called_once_with(
+        source, ['submission'], post_sync.session, os.path.join(homedir, 'data'))
+    post_sync.source_stored.emit.assert_called_once_with(
+        mock_storage.update_local_source.return_value, True, 1, 2)
+    assert post_sync.stored_sources == {'source-uuid'}
+
+
+def test_PostSync_store_source_fail(homedir, mocker):
+    """
+    If a source could not be stored, the failure is logged and the progress of
+    the sync still reported.
+    """
+    post_sync = make_post_sync(homedir, mocker)
+    mock_storage = mocker.patch('securedrop_client.post_sync.storage')
+    mock_storage.update_local_source.side_effect = Exception('Database locked')
+
+    post_sync.store_source(mocker.MagicMock(uuid='source-uuid'), [], 1, 2)
+
+    post_sync.session.rollback.assert_called_once_with()
+    post_sync.source_stored.emit.assert_called_once_with([], False, 1, 2)
+    assert post_sync.stored_sources == set()
+
+
+def test_PostSync_changed_sources(homedir, mocker):
+    """
+    The sources stored during the sync, and those added, changed or deleted
+    by the reconciliation, have changed. The stored sources are forgotten.
+    """
+    post_sync = make_post_sync(homedir, mocker)
+    mock_storage = mocker.patch('securedrop_client.post_sync.storage')
+    mock_storage.get_source_summaries.return_value = {
+        'stored': (('a',), set()),
+        'same': (('b',), {'reply'}),
+        'new-reply': (('c',), {'reply', 'other-reply'}),
+        'added': (('d',), set()),
+    }
+    post_sync.stored_sources = {'stored'}
+
+    changed = post_sync.changed_sources({
+        'stored': (('a',), set()),
+        'same': (('b',), {'reply'}),
+        'new-reply': (('c',), {'reply'}),
+        'deleted': (('e',), set()),
+    })
+
+    assert changed == {'stored', 'new-reply', 'added', 'deleted'}
+    assert post_sync.stored_sources == set()
+
+
+def test_PostSync_run(homedir, mocker):
+    """
+    Local storage is updated, the time of the sync recorded and the keys of
+    the sources imported, then the GUI thread is told what changed.
+    """
+    post_sync = make_post_sync(homedir, mocker)
+    mock_storage = mocker.patch('securedrop_client.post_sync.storage')
+    post_sync.changed_sources = mocker.MagicMock(return_value={'pgp-uuid'})
+    pgp_source = mocker.MagicMock(uuid='pgp-uuid', key={'type': 'PGP', 'public': 'key'})
+    keyless_source = mocker.MagicMock(uuid='keyless-uuid', key={'type': 'PGP'})
+    other_source = mocker.MagicMock(uuid='other-uuid', key={'type': 'other', 'public': 'x'})
+    sources = [pgp_source, keyless_source, other_source]
+
+    post_sync.run(sources, 'submissions', 'replies')
+
+    mock_storage.update_local_storage.assert_called_once_with(
+        post_sync.session, sources, 'submissions', 'replies',
+        os.path.join(homedir, 'data'), refreshed_sources=[], unstored_sources=set())
+    assert os.path.exists(os.path.join(homedir, 'sync_flag'))
+    post_sync.gpg.import_keys.assert_called_once_with({'pgp-uuid': 'key'})
+    post_sync.post_sync_done.emit.assert_called_once_with(
+        ['pgp-uuid', 'keyless-uuid', 'other-uuid'],
+        mock_storage.update_local_storage.return_value, {'pgp-uuid'})
+    post_sync.changed_sources.assert_called_once_with(
+        mock_storage.get_source_summaries.return_value)
+
+
+def test_PostSync_run_key_import_fail(homedir, mocker):
+    """
+    A failure to import keys is logged, and the GUI thread still told.
+    """
+    post_sync = make_post_sync(homedir, mocker)
+    mocker.patch('securedrop_client.post_sync.storage')
+    post_sync.gpg.import_keys.side_effect = CryptoError
+
+    post_sync.run([], 'submissions', 'replies')
+
+    assert post_sync.post_sync_done.emit.call_count == 1
+
+
+def test_PostSync_run_storage_fail(homedir, mocker):
+    """
+    If local storage could not be updated, the sync is not recorded, but the
+    GUI thread is still told.
+    """
+    post_sync = make_post_sync(homedir, mocker)
+    mock_storage = mocker.patch('securedrop_client.post_sync.storage')
+    mock_storage.update_local_storage.side_effect = Exception('Database locked')
+    post_sync.changed_sources = mocker.MagicMock(return_value=set())
+
+    post_sync.run([], 'submissions', 'replies')
+
+    post_sync.session.rollback.assert_called_once_with()
+    assert not os.path.exists(os.path.join(homedir, 'sync_flag'))
+    post_sync.gpg.import_keys.assert_not_called()
+    post_sync.post_sync_done.emit.assert_called_once_with([], [], set())
+
+
+def test_PostSync_run_after_store_source_fail(homedir, session, mocker):
+    """
+    If a source could not be stored during the sync, reconciling after it
+    leaves the source stale, so that the next sync fetches its submissions
+    again. A new source is not added until then, nor its replies.
+    """
+    post_sync = make_post_sync(homedir, mocker)
+    post_sync.session = session
+    local_source = factory.Source(last_updated=datetime.datetime(2019, 1, 1))
+    session.add(local_source)
+    session.commit()
+
+    def make_remote_source(uuid):
+        return Source(add_star_url='foo', interaction_count=1, is_flagged=False,
+                      is_starred=True, journalist_designation='foo',
+                      key={'public': 'bar'}, last_updated='2019-02-01T00:00:00Z',
+                      number_of_documents=1, number_of_messages=1,
+                      remove_star_url='baz', replies_url='qux',
+                      submissions_url='wibble', url='url', uuid=uuid)
+
+    remote_sources = [make_remote_source(local_source.uuid),
+                      make_remote_source('new-source-uuid')]
+    remote_reply = Reply(filename='1-reply.gpg', journalist_uuid='journalist-uuid',
+                         journalist_username='test', is_deleted_by_source=False,
+                         reply_url='test', size=1234,
+                         source_url='/api/v1/sources/new-source-uuid',
+                         uuid='reply-uuid')
+    mocker.patch('securedrop_client.post_sync.storage.update_local_source',
+                 side_effect=Exception('Database locked'))
+    for count, remote_source in enumerate(remote_sources, 1):
+        post_sync.store_source(remote_source, [], count, len(remote_sources))
+
+    post_sync.run(remote_sources, [], [remote_reply])
+
+    local_sources = storage.get_local_sources(session).all()
+    assert local_sources == [local_source]
+    assert local_source.last_updated == datetime.datetime(2019, 1, 1)
+    assert local_source.is_starred is True
+    assert session.query(db.Reply).count() == 0
+    last_updated = {source.uuid: source.last_updated for source in local_sources}
+    assert storage.get_stale_sources(remote_sources, last_updated) == remote_sources
+    assert post_sync.unstored_sources == set()
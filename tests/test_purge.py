@@ -0,0 +1,28 @@
+"""
+Make sure the file purge object behaves as expected.
+"""
+import os
+
+from securedrop_client.purge import FilePurge
+
+
+def test_FilePurge_purge(homedir, mocker):
+    """
+    Files are deleted in batches, reporting progress after each batch, and
+    files which are already gone are skipped.
+    """
+    paths = []
+    for i in range(5):
+        path = os.path.join(homedir, 'data', '{}-foo-msg'.format(i))
+        with open(path, 'w') as f:
+            f.write('I am test content for tests')
+        paths.append(path)
+    paths.append(os.path.join(homedir, 'data', 'missing'))
+
+    fp = FilePurge(batch_size=4)
+    fp.purge_progress = mocker.MagicMock()
+    fp.purge(paths)
+
+    for path in paths:
+        assert not os.path.exists(path)
+    assert fp.purge_progress.emit.call_args_list == [((4, 6), ), ((6, 6), )]
@@ -1,15 +1,21 @@
 """
 Tests for storage sync logic.
 """
+import datetime
 import pytest
 import os
 import uuid
 import securedrop_client.db
+import sqlalchemy
 from dateutil.parser import parse
 from securedrop_client.storage import get_local_sources, get_local_submissions, get_local_replies, \
-    get_remote_data, update_local_storage, update_sources, update_submissions, update_replies, \
-    find_or_create_user, find_new_submissions, find_new_replies, mark_file_as_downloaded, \
-    mark_reply_as_downloaded, delete_single_submission_or_reply_on_disk, get_data
+    get_remote_data, get_stale_sources, update_local_storage, update_local_source, reconcile, \
+    update_sources, update_submissions, update_replies, find_or_create_user, \
+    find_new_submissions, find_new_replies, mark_file_as_downloaded, mark_reply_as_downloaded, \
+    mark_file_download_failed, mark_reply_download_failed, next_download_attempt, \
+    download_backoff, MAX_DOWNLOAD_ATTEMPTS, get_download_state, set_download_state, \
+    get_source_summaries, get_artifact_filenames, delete_files, \
+    delete_single_submission_or_reply_on_disk, get_data
 from securedrop_client import db
 from sdclientapi import Source, Submission, Reply
 
@@ -65,6 +71,40 @@ def test_get_local_sources(mocker):
     mock_session.query.assert_called_once_with(securedrop_client.db.Source)
 
 
+def test_get_local_sources_uuids(session):
+    """
+    Only the sources with the given UUIDs are returned.
+    """
+    wanted = factory.Source()
+    other = factory.Source()
+    session.add_all([wanted, other])
+    session.commit()
+
+    assert get_local_sources(session, [wanted.uuid, 'deleted-uuid']).all() == [wanted]
+
+
+def test_get_source_summaries(session):
+    """
+    The summary of each source holds what is shown of it, including the UUIDs
+    of its replies.
+    """
+    source = factory.Source(journalist_designation='foo',
+                            last_updated=datetime.datetime(2019, 1, 1))
+    quiet_source = factory.Source(journalist_designation='bar', is_starred=True,
+                                  last_updated=datetime.datetime(2019, 1, 2))
+    journalist = db.User('testymctestface')
+    journalist.uuid = 'journalist-uuid'
+    session.add_all([source, quiet_source, journalist])
+    session.commit()
+    session.add(db.Reply('reply-uuid', journalist, source, '1-reply.gpg', 1))
+    session.commit()
+
+    assert get_source_summaries(session) == {
+        source.uuid: (('foo', False, False, datetime.datetime(2019, 1, 1), 0), {'reply-uuid'}),
+        quiet_source.uuid: (('bar', False, True, datetime.datetime(2019, 1, 2), 0), set()),
+    }
+
+
 def test_get_local_submissions(mocker):
     """
     At this moment, just return all submissions.
@@ -113,6 +153,95 @@ def test_get_remote_data(mocker):
     assert replies == [reply, ]
 
 
+def test_get_remote_data_concurrent(mocker):
+    """
+    Submissions fetched concurrently are returned in the order of their
+    sources, and any error fetching them is raised to the caller.
+    """
+    mock_api = mocker.MagicMock()
+    sources = [make_remote_source() for _ in range(10)]
+    mock_api.get_sources.return_value = sources
+    mock_api.get_submissions.side_effect = lambda source: [source.uuid]
+    mock_api.get_all_replies.return_value = []
+    _, submissions, _ = get_remote_data(mock_api, max_workers=3)
+    assert submissions == [source.uuid for source in sources]
+
+    mock_api.get_submissions.side_effect = Exception('BANG!')
+    with pytest.raises(Exception):
+        get_remote_data(mock_api, max_workers=3)
+
+
+def test_get_remote_data_streaming(mocker):
+    """
+    Given a callback, the submissions of each source are passed to it as they
+    arrive, and not kept in the returned tuple. They are still counted.
+    """
+    mock_logger = mocker.patch('securedrop_client.storage.logger')
+    mock_api = mocker.MagicMock()
+    source = make_remote_source()
+    mock_api.get_sources.return_value = [source]
+    mock_api.get_submissions.return_value = ['submission']
+    mock_api.get_all_replies.return_value = []
+    callback = mocker.MagicMock()
+    sources, submissions, replies = get_remote_data(mock_api,
+                                                    on_source_fetched=callback)
+    callback.assert_called_once_with(source, ['submission'], 1, 1)
+    assert sources == [source]
+    assert submissions == []
+    mock_logger.info.assert_any_call('Fetched 1 remote submissions.')
+
+
+def test_get_remote_data_incremental(mocker):
+    """
+    Given local last_updated timestamps, submissions are only fetched for new
+    or changed sources.
+    """
+    mock_api = mocker.MagicMock()
+    unchanged = make_remote_source()
+    changed = make_remote_source()
+    new = make_remote_source()
+    mock_api.get_sources.return_value = [unchanged, changed, new]
+    mock_api.get_all_replies.return_value = []
+    last_updated = {
+        unchanged.uuid: parse(unchanged.last_updated),
+        changed.uuid: parse('2018-01-01T00:00:00.000000Z'),
+    }
+    get_remote_data(mock_api, last_updated)
+    assert mock_api.get_submissions.call_count == 2
+    mock_api.get_submissions.assert_any_call(changed)
+    mock_api.get_submissions.assert_any_call(new)
+
+
+def test_get_stale_sources_naive_timestamps():
+    """
+    Timestamps read back from the database are naive, but still compare equal
+    to the timezone aware timestamps reported by the server.
+    """
+    source = make_remote_source()
+    last_updated = {source.uuid: parse(source.last_updated).replace(tzinfo=None)}
+    assert get_stale_sources([source], last_updated) == []
+    assert get_stale_sources([source]) == [source]
+
+
+def test_reconcile(mocker):
+    """
+    Remote items are classified against local items by UUID in a single pass:
+    matching pairs are updated, unknown remote items are created and unmatched
+    local items are deleted.
+    """
+    remote_update = mocker.MagicMock(uuid='update')
+    remote_create = mocker.MagicMock(uuid='create')
+    local_update = mocker.MagicMock(uuid='update')
+    local_delete = mocker.MagicMock(uuid='delete')
+
+    to_update, to_create, to_delete = reconcile([remote_update, remote_create],
+                                                [local_update, local_delete])
+
+    assert to_update == [(remote_update, local_update)]
+    assert to_create == [remote_create]
+    assert to_delete == [local_delete]
+
+
 def test_update_local_storage(homedir, mocker):
     """
     Assuming no errors getting data, check the expected functions to update
@@ -138,11 +267,95 @@ def test_update_local_storage(homedir, mocker):
     update_local_storage(mock_session, sources, submissions, replies,
                          homedir)
     src_fn.assert_called_once_with([source, ], [local_source, ],
-                                   mock_session, homedir)
+                                   mock_session, homedir, unstored_sources=None)
     rpl_fn.assert_called_once_with([reply, ], [local_replies, ],
                                    mock_session, homedir)
     sub_fn.assert_called_once_with([submission, ], [local_submission, ],
                                    mock_session, homedir)
+    # All changes are committed in a single transaction.
+    mock_session.commit.assert_called_once_with()
+
+
+def test_update_local_storage_single_transaction(homedir, session, mocker):
+    """
+    New sources, submissions, replies and journalists are written to a real
+    database and committed exactly once.
+    """
+    source = make_remote_source()
+    submission = make_remote_submission(source.uuid)
+    reply = make_remote_reply(source.uuid)
+    reply.source_uuid = source.uuid
+    commit = mocker.spy(session, 'commit')
+
+    update_local_storage(session, [source], [submission], [reply], homedir)
+
+    assert commit.call_count == 1
+    local_source = session.query(db.Source).one()
+    assert local_source.uuid == source.uuid
+    assert session.query(db.Submission).one().source_id == local_source.id
+    local_reply = session.query(db.Reply).one()
+    assert local_reply.source_id == local_source.id
+    assert local_reply.journalist_id == session.query(db.User).one().id
+
+
+def test_update_local_storage_refreshed_sources(homedir, session, source):
+    """
+    Local submissions of sources which were not refreshed are not deleted,
+    even though they are missing from the remote submissions. Only those of
+    the refreshed sources are reconciled.
+    """
+    local_source = source['source']
+    submission = db.Submission(source=local_source, uuid=str(uuid.uuid4()),
+                               size=123, filename='1-foo-msg.gpg',
+                               download_url='test')
+    session.add(submission)
+    session.commit()
+    remote_source = make_remote_source()
+    remote_source.uuid = local_source.uuid
+
+    other_source = factory.Source()
+    session.add(other_source)
+    session.commit()
+    session.add(db.Submission(source=other_source, uuid=str(uuid.uuid4()),
+                              size=123, filename='1-bar-msg.gpg',
+                              download_url='test'))
+    session.commit()
+    remote_other_source = make_remote_source()
+    remote_other_source.uuid = other_source.uuid
+    remote_sources = [remote_source, remote_other_source]
+
+    update_local_storage(session, remote_sources, [], [], homedir,
+                         refreshed_sources=[])
+    assert session.query(db.Submission).count() == 2
+
+    update_local_storage(session, remote_sources, [], [], homedir,
+                         refreshed_sources=[remote_source.uuid])
+    assert session.query(db.Submission).one().source_id == other_source.id
+
+
+def test_update_local_source(homedir, session, source):
+    """
+    A single source and its submissions are stored, without touching the
+    submissions of any other source.
+    """
+    other_submission = db.Submission(source=source['source'],
+                                     uuid=str(uuid.uuid4()), size=123,
+                                     filename='1-foo-msg.gpg',
+                                     download_url='test')
+    session.add(other_submission)
+    session.commit()
+    remote_source = make_remote_source()
+    remote_submission = make_remote_submission(remote_source.uuid)
+
+    update_local_source(remote_source, [remote_submission], session, homedir)
+
+    local_source = session.query(db.Source).filter_by(uuid=remote_source.uuid).one()
+    assert [s.uuid for s in local_source.submissions] == [remote_submission.uuid]
+    assert session.query(db.Submission).count() == 2
+
+    update_local_source(remote_source, [], session, homedir)
+    assert local_source.submissions == []
+    assert session.query(db.Submission).count() == 1
 
 
 def test_update_sources(homedir, mocker):
@@ -194,8 +407,8 @@ def test_update_sources(homedir, mocker):
     # Ensure the record for the local source that is missing from the results
     # of the API is deleted.
     mock_session.delete.assert_called_once_with(local_source2)
-    # Session is committed to database.
-    assert mock_session.commit.call_count == 1
+    # Committing is left to update_local_storage.
+    assert mock_session.commit.call_count == 0
 
 
 def add_test_file_to_temp_dir(home_dir, filename):
@@ -242,18 +455,21 @@ def test_update_submissions_deletes_files_associated_with_the_submission(
     local_source.uuid = 'test-source-uuid'
     local_source.id = 666
     mock_session.query().filter_by.return_value = [local_source, ]
-    update_submissions(remote_submissions, local_submissions, mock_session,
-                       homedir)
+    deleted_files = update_submissions(remote_submissions, local_submissions,
+                                       mock_session, homedir)
 
-    # Ensure the files associated with the submission are deleted on disk.
+    # Ensure the files associated with the submission are returned to be
+    # deleted on disk.
+    assert os.path.exists(abs_server_filename)
+    delete_files(deleted_files)
     assert not os.path.exists(abs_server_filename)
     assert not os.path.exists(abs_local_filename)
 
     # Ensure the record for the local submission is gone.
     mock_session.delete.assert_called_once_with(local_submission)
 
-    # Session is committed to database.
-    assert mock_session.commit.call_count == 1
+    # Committing is left to update_local_storage.
+    assert mock_session.commit.call_count == 0
 
 
 def test_update_replies_deletes_files_associated_with_the_reply(
@@ -288,17 +504,21 @@ def test_update_replies_deletes_files_associated_with_the_reply(
     local_source.uuid = 'test-source-uuid'
     local_source.id = 666
     mock_session.query().filter_by.return_value = [local_source, ]
-    update_replies(remote_replies, local_replies, mock_session, homedir)
+    deleted_files = update_replies(remote_replies, local_replies,
+                                   mock_session, homedir)
 
-    # Ensure the files associated with the reply are deleted on disk.
+    # Ensure the files associated with the reply are returned to be deleted on
+    # disk.
+    assert os.path.exists(abs_server_filename)
+    delete_files(deleted_files)
     assert not os.path.exists(abs_server_filename)
     assert not os.path.exists(abs_local_filename)
 
     # Ensure the record for the local reply is gone.
     mock_session.delete.assert_called_once_with(local_reply)
 
-    # Session is committed to database.
-    assert mock_session.commit.call_count == 1
+    # Committing is left to update_local_storage.
+    assert mock_session.commit.call_count == 0
 
 
 def test_update_sources_deletes_files_associated_with_the_source(
@@ -354,9 +574,12 @@ def test_update_sources_deletes_files_associated_with_the_source(
         test_filename_absolute_paths.append(abs_server_filename)
 
     local_sources = [local_source]
-    update_sources(remote_sources, local_sources, mock_session, homedir)
+    deleted_files = update_sources(remote_sources, local_sources, mock_session,
+                                   homedir)
 
-    # Ensure the files associated with the reply are deleted on disk.
+    # Ensure the files associated with the source are returned to be deleted
+    # on disk.
+    delete_files(deleted_files)
     for test_filename in test_filename_absolute_paths:
         assert not os.path.exists(test_filename)
 
@@ -364,8 +587,8 @@ def test_update_sources_deletes_files_associated_with_the_source(
     # related files.
     mock_session.delete.assert_called_with(local_source)
 
-    # Session is committed to database.
-    assert mock_session.commit.call_count == 1
+    # Committing is left to update_local_storage.
+    assert mock_session.commit.call_count == 0
 
 
 def test_update_submissions(homedir, mocker):
@@ -399,7 +622,7 @@ def test_update_submissions(homedir, mocker):
     local_source = mocker.MagicMock()
     local_source.uuid = source.uuid
     local_source.id = 666  # ;-)
-    mock_session.query().filter_by.return_value = [local_source, ]
+    mock_session.query.return_value = [local_source, ]
     update_submissions(remote_submissions, local_submissions, mock_session,
                        homedir)
     # Check the expected local submission object has been updated with values
@@ -408,17 +631,19 @@ def test_update_submissions(homedir, mocker):
     assert local_sub1.size == submission_update.size
     assert local_sub1.is_read == submission_update.is_read
     # Check the expected local source object has been created with values from
-    # the API.
-    assert mock_session.add.call_count == 1
-    new_sub = mock_session.add.call_args_list[0][0][0]
+    # the API in a single bulk insert.
+    assert mock_session.bulk_save_objects.call_count == 1
+    new_subs = mock_session.bulk_save_objects.call_args[0][0]
+    assert len(new_subs) == 1
+    new_sub = new_subs[0]
     assert new_sub.uuid == submission_create.uuid
     assert new_sub.source_id == local_source.id
     assert new_sub.filename == submission_create.filename
     # Ensure the record for the local source that is missing from the results
     # of the API is deleted.
     mock_session.delete.assert_called_once_with(local_sub2)
-    # Session is committed to database.
-    assert mock_session.commit.call_count == 1
+    # Committing is left to update_local_storage.
+    assert mock_session.commit.call_count == 0
 
 
 def test_update_replies(homedir, mocker):
@@ -458,9 +683,7 @@ def test_update_replies(homedir, mocker):
     local_user = mocker.MagicMock()
     local_user.username = reply_create.journalist_username
     local_user.id = 42
-    mock_session.query().filter_by.side_effect = [[local_source, ],
-                                                  [local_user, ],
-                                                  [local_user, ], ]
+    mock_session.query.return_value = [local_source, ]
     mock_focu = mocker.MagicMock(return_value=local_user)
     mocker.patch('securedrop_client.storage.find_or_create_user', mock_focu)
     update_replies(remote_replies, local_replies, mock_session,
@@ -472,8 +695,10 @@ def test_update_replies(homedir, mocker):
     assert local_reply1.size == reply_update.size
     # Check the expected local source object has been created with values from
     # the API.
-    assert mock_session.add.call_count == 1
-    new_reply = mock_session.add.call_args_list[0][0][0]
+    assert mock_session.bulk_save_objects.call_count == 1
+    new_replies = mock_session.bulk_save_objects.call_args[0][0]
+    assert len(new_replies) == 1
+    new_reply = new_replies[0]
     assert new_reply.uuid == reply_create.uuid
     assert new_reply.source_id == local_source.id
     assert new_reply.journalist_id == local_user.id
@@ -482,8 +707,8 @@ def test_update_replies(homedir, mocker):
     # Ensure the record for the local source that is missing from the results
     # of the API is deleted.
     mock_session.delete.assert_called_once_with(local_reply2)
-    # Session is committed to database.
-    assert mock_session.commit.call_count == 1
+    # Committing is left to update_local_storage.
+    assert mock_session.commit.call_count == 0
 
 
 def test_find_or_create_user_existing_uuid(mocker):
@@ -510,7 +735,7 @@ def test_find_or_create_user_existing_username(mocker):
                                mock_session) == mock_user
     assert mock_user.username == 'testymctestface'
     mock_session.add.assert_called_once_with(mock_user)
-    mock_session.commit.assert_called_once_with()
+    assert mock_session.commit.call_count == 0
 
 
 def test_find_or_create_user_new(mocker):
@@ -522,7 +747,42 @@ def test_find_or_create_user_new(mocker):
     new_user = find_or_create_user('uuid', 'unknown', mock_session)
     assert new_user.username == 'unknown'
     mock_session.add.assert_called_once_with(new_user)
-    mock_session.commit.assert_called_once_with()
+    mock_session.flush.assert_called_once_with()
+    assert mock_session.commit.call_count == 0
+
+
+def test_find_or_create_user_cached(mocker):
+    """
+    Given a dict of already loaded users, it is used instead of querying the
+    database and new users are added to it without a flush.
+    """
+    mock_session = mocker.MagicMock()
+    mock_user = mocker.MagicMock()
+    mock_user.username = 'foobar'
+    users = {'uuid': mock_user}
+    assert find_or_create_user('uuid', 'foobar', mock_session, users) == mock_user
+    new_user = find_or_create_user('new-uuid', 'unknown', mock_session, users)
+    assert users['new-uuid'] == new_user
+    assert mock_session.query.call_count == 0
+    assert mock_session.flush.call_count == 0
+
+
+def test_update_replies_loads_users_once(homedir, session, source):
+    """
+    Journalists are resolved with a single query however many replies there
+    are, and new journalists are created once.
+    """
+    remote_replies = [make_remote_reply(source['uuid'], 'journalist-uuid')
+                      for _ in range(3)]
+    for reply in remote_replies:
+        reply.source_uuid = source['uuid']
+
+    update_replies(remote_replies, [], session, homedir)
+    session.commit()
+
+    user = session.query(db.User).one()
+    assert user.uuid == 'journalist-uuid'
+    assert [r.journalist_id for r in session.query(db.Reply)] == [user.id] * 3
 
 
 def test_find_new_submissions(mocker):
@@ -530,10 +790,24 @@ def test_find_new_submissions(mocker):
     mock_submission = mocker.MagicMock()
     mock_submission.is_downloaded = False
     mock_submissions = [mock_submission]
-    mock_session.query().filter_by() \
-                        .filter().all.return_value = mock_submissions
+    mock_session.query().filter_by().filter() \
+                        .all.return_value = mock_submissions
     submissions = find_new_submissions(mock_session)
     assert submissions[0].is_downloaded is False
+    mock_session.query().filter_by.assert_called_with(is_downloaded=False,
+                                                      kind='message')
+
+
+def test_find_new_submissions_only_messages(session, source):
+    """
+    Only messages still to be downloaded are found, not documents.
+    """
+    for filename in ['1-foo-msg.gpg', '2-foo-doc.gz.gpg']:
+        session.add(db.Submission(source=source['source'], uuid=filename,
+                                  size=123, filename=filename,
+                                  download_url='test'))
+    session.commit()
+    assert [s.filename for s in find_new_submissions(session)] == ['1-foo-msg.gpg']
 
 
 def test_find_new_replies(mocker):
@@ -541,7 +815,7 @@ def test_find_new_replies(mocker):
     mock_reply = mocker.MagicMock()
     mock_reply.is_downloaded = False
     mock_replies = [mock_reply]
-    mock_session.query().filter_by() \
+    mock_session.query().filter_by().filter() \
                         .all.return_value = mock_replies
     replies = find_new_replies(mock_session)
     assert replies[0].is_downloaded is False
@@ -554,6 +828,7 @@ def test_mark_file_as_downloaded(mocker):
     mock_session.query().filter_by().one_or_none.return_value = mock_submission
     mark_file_as_downloaded('test-filename', mock_session)
     assert mock_submission.is_downloaded is True
+    assert mock_submission.download_state == db.DECRYPTED
     mock_session.add.assert_called_once_with(mock_submission)
     mock_session.commit.assert_called_once_with()
 
@@ -565,10 +840,129 @@ def test_mark_reply_as_downloaded(mocker):
     mock_session.query().filter_by().one_or_none.return_value = mock_reply
     mark_reply_as_downloaded('test-filename', mock_session)
     assert mock_reply.is_downloaded is True
+    assert mock_reply.download_state == db.DECRYPTED
     mock_session.add.assert_called_once_with(mock_reply)
     mock_session.commit.assert_called_once_with()
 
 
+def test_mark_file_download_failed(session, source):
+    """
+    Each failure is recorded, and the message is not downloaded again until
+    its backoff has passed.
+    """
+    submission = db.Submission(source=source['source'], uuid='msg-uuid', size=123,
+                               filename='1-foo-msg.gpg', download_url='test')
+    session.add(submission)
+    session.commit()
+
+    mark_file_download_failed('msg-uuid', Exception('Boom'), session)
+
+    assert submission.download_attempts == 1
+    assert submission.download_error == 'Boom'
+    assert find_new_submissions(session) == []
+    assert next_download_attempt(session) == submission.download_next_attempt
+    later = submission.download_next_attempt + datetime.timedelta(seconds=1)
+    assert find_new_submissions(session, now=later) == [submission]
+    assert next_download_attempt(session, now=later) is None
+
+
+def test_download_queries_use_partial_indexes(session, mocker):
+    """
+    The queries for items waiting to be downloaded match the WHERE clause of
+    the partial indexes on is_downloaded, so that SQLite uses them.
+    """
+    engine = session.get_bind()
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    sqlalchemy.event.listen(engine, 'before_cursor_execute', record)
+    try:
+        find_new_submissions(session)
+        find_new_replies(session)
+        next_download_attempt(session)
+    finally:
+        sqlalchemy.event.remove(engine, 'before_cursor_execute', record)
+
+    connection = engine.raw_connection()
+    plans = [' '.join(row[-1] for row in connection.execute(
+             'EXPLAIN QUERY PLAN ' + statement, parameters))
+             for statement, parameters in statements]
+    connection.close()
+    assert len(plans) == 4
+    assert 'ix_submissions_kind_not_downloaded' in plans[0]
+    assert 'ix_replies_not_downloaded' in plans[1]
+    assert 'ix_submissions_kind_not_downloaded' in plans[2]
+    assert 'ix_replies_not_downloaded' in plans[3]
+
+
+def test_mark_file_download_failed_gives_up(session, source):
+    """
+    After MAX_DOWNLOAD_ATTEMPTS, a message is no longer downloaded.
+    """
+    submission = db.Submission(source=source['source'], uuid='msg-uuid', size=123,
+                               filename='1-foo-msg.gpg', download_url='test')
+    session.add(submission)
+    session.commit()
+
+    for i in range(MAX_DOWNLOAD_ATTEMPTS):
+        mark_file_download_failed('msg-uuid', Exception('Boom'), session)
+
+    later = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+    assert submission.download_attempts == MAX_DOWNLOAD_ATTEMPTS
+    assert submission.download_next_attempt is None
+    assert find_new_submissions(session, now=later) == []
+    assert next_download_attempt(session) is None
+
+
+def test_mark_file_download_failed_deleted(session):
+    """
+    If the submission was deleted while it was being downloaded, there is
+    nothing to record.
+    """
+    mark_file_download_failed('missing-uuid', Exception('Boom'), session)
+
+
+def test_mark_reply_download_failed(session, source):
+    user = db.User('hehe')
+    user.uuid = 'user-uuid'
+    session.add(user)
+    session.flush()
+    reply = db.Reply('reply-uuid', user, source['source'], '1-foo-reply.gpg', 123)
+    session.add(reply)
+    session.commit()
+
+    mark_reply_download_failed('reply-uuid', Exception('Boom'), session)
+
+    assert reply.download_attempts == 1
+    assert find_new_replies(session) == []
+    assert next_download_attempt(session) == reply.download_next_attempt
+    later = reply.download_next_attempt + datetime.timedelta(seconds=1)
+    assert find_new_replies(session, now=later) == [reply]
+
+
+def test_download_state(session, source):
+    submission = db.Submission(source=source['source'], uuid='msg-uuid', size=123,
+                               filename='1-foo-msg.gpg', download_url='test')
+    session.add(submission)
+    session.commit()
+    assert get_download_state(db.Submission, 'msg-uuid', session) is None
+
+    set_download_state(db.Submission, 'msg-uuid', db.DOWNLOADED, session)
+
+    assert get_download_state(db.Submission, 'msg-uuid', session) == db.DOWNLOADED
+    assert get_download_state(db.Submission, 'missing-uuid', session) is None
+
+
+def test_download_backoff():
+    """
+    The wait doubles with each failure, up to a limit.
+    """
+    assert [download_backoff(n) for n in range(1, 5)] == [5, 10, 20, 40]
+    assert download_backoff(100) == 60 * 60
+
+
 def test_delete_single_submission_or_reply_race_guard(homedir, mocker):
     """
     This test checks that if there is a file is deleted
@@ -586,6 +980,29 @@ def test_delete_single_submission_or_reply_race_guard(homedir, mocker):
     mock_remove.call_count == 1
 
 
+def test_get_artifact_filenames():
+    assert get_artifact_filenames('1-foo-msg.gpg') == \
+        ['1-foo-msg.gpg.part', '1-foo-msg.gpg', '1-foo-msg']
+    assert get_artifact_filenames('1-foo-doc.gz.gpg') == \
+        ['1-foo-doc.gz.gpg.part', '1-foo-doc.gz.gpg', '1-foo-doc.gz', '1-foo-doc']
+
+
+def test_delete_single_submission_or_reply_is_exact(homedir, mocker):
+    """
+    Only the files produced by the deleted submission are removed, not files
+    of other submissions whose names happen to share its prefix.
+    """
+    test_obj = mocker.MagicMock()
+    test_obj.filename = '1-foo-msg.gpg'
+    deleted = add_test_file_to_temp_dir(homedir, '1-foo-msg')
+    kept = add_test_file_to_temp_dir(homedir, '1-foo-msg-bar')
+
+    delete_single_submission_or_reply_on_disk(test_obj, homedir)
+
+    assert not os.path.exists(deleted)
+    assert os.path.exists(kept)
+
+
 def test_get_data_success(homedir):
     orig_filename = 'foo.txt'
     filename, _ = os.path.splitext(orig_filename)